@@ -0,0 +1,271 @@
+################################################################################
+# atd.py - The Unix at scheduler in Python ################ py2/3k version 0.2 #
+################################################################################
+# python -m atd {submit,list,export,import,cancel} ...                         #
+################################################################################
+# export writes the queue as JSON Lines, one job per line, as it reads it, so  #
+# a queue of any size can be exported without holding it in memory. With      #
+# --commands, each job's command, environment and cwd are added, read from     #
+# the spool where possible and otherwise with `at -c`, a few at a time.        #
+#                                                                              #
+# import reads jobs from stdin, as JSON Lines or CSV, and submits them with    #
+# atd.at_many() as it goes. Each job needs a command and a when, which is      #
+# either a timespec or a date and time like export writes, and may have a      #
+# queue and tags. Anything else, like export's environment, is ignored: jobs   #
+# get config.atjob_environment, as with at(). To copy jobs to another host:    #
+#                                                                              #
+#   python -m atd export --commands | ssh there python -m atd import           #
+################################################################################
+##  Written by Fredrick Brennan <copypaste@kittens.ph>. See LICENSE (Expat).  ##
+################################################################################
+
+from __future__ import absolute_import
+from __future__ import print_function
+import argparse
+import collections
+import csv
+import datetime
+import json
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from subprocess import CalledProcessError
+
+from atd import atd
+from atd import atq
+from atd import config
+from atd import engine
+from atd import leveling
+from atd import spawn
+from atd import spool
+from atd import timespec
+
+# How many jobs export --commands loads scripts for at once.
+EXPORT_CHUNK = 256
+
+def _json_default(obj):
+    if isinstance(obj, datetime.datetime):
+        return obj.replace(microsecond = 0).isoformat()
+    raise TypeError('{0!r} is not JSON serializable'.format(obj))
+
+def _dumps(job):
+    return json.dumps(job, default = _json_default, sort_keys = True)
+
+def _parse_when(when):
+    """ A datetime if when is in one of timespec.WHEN_FORMATS, else when, for
+        at() to parse as a timespec. """
+    parsed = timespec.parse_datetime(when)
+    return when if parsed is None else parsed
+
+def _load_script(job, paths):
+    """ Add command, environment and cwd to the job dict job. Returns None if
+        its script couldn't be loaded, usually because it's run since. """
+    try:
+        if config.scheduler_backend == 'engine':
+            parsed = engine.get_engine().get(job['id'])
+            if parsed is None: return None
+        else:
+            if job['id'] in paths:
+                with open(paths[job['id']], 'rb') as f:
+                    script = f.read()
+            else:
+                script = spawn.check_output([config.at_binary, '-c',
+                    str(job['id'])])
+            parsed = spool.parse_job_script(script)
+    except (OSError, IOError, CalledProcessError):
+        return None
+
+    for k in atq.attrs_in_script:
+        job[k] = parsed[k]
+    return job
+
+def iter_scripts(jobs, workers = 8):
+    """ Yield each of the job dicts jobs with its command, environment and cwd
+        added, loading EXPORT_CHUNK at a time with up to workers threads. Jobs
+        whose script couldn't be loaded are left out. """
+    paths = dict()
+    if config.scheduler_backend != 'engine':
+        try:
+            paths = spool.job_script_paths()
+        except OSError:
+            pass
+
+    executor = ThreadPoolExecutor(max_workers = workers)
+    try:
+        chunk = list()
+        for job in jobs:
+            chunk.append(job)
+            if len(chunk) < EXPORT_CHUNK: continue
+
+            for loaded in executor.map(lambda job: _load_script(job, paths),
+                    chunk):
+                if loaded is not None: yield loaded
+            chunk = list()
+
+        for loaded in executor.map(lambda job: _load_script(job, paths),
+                chunk):
+            if loaded is not None: yield loaded
+    finally:
+        executor.shutdown(wait = True)
+
+def read_jobs(lines, format = 'jsonl', errors = None):
+    """ Yield (line number, job) for each job in lines, which are JSON Lines
+        or, if format is 'csv', CSV with a header row. job is a (command, when,
+        queue, tags) tuple, as atd.at_many() takes. Tags in CSV are separated
+        by spaces. Jobs that can't be read are skipped, and (line number,
+        message) is appended to the list errors, if given. """
+    if format == 'csv':
+        reader = csv.DictReader(lines)
+        records = ((reader.line_num, record) for record in reader)
+    else:
+        records = ((number, line) for number, line in enumerate(lines, 1)
+            if line.strip())
+
+    for number, record in records:
+        try:
+            if format == 'csv':
+                tags = (record.get('tags') or '').split() or None
+            else:
+                record = json.loads(record)
+                tags = record.get('tags')
+            job = (record['command'], _parse_when(record['when']),
+                record.get('queue') or config.at_default_queue, tags)
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            if errors is not None:
+                errors.append((number, 'Invalid job: {0}'.format(e)))
+            continue
+        yield number, job
+
+def _list(args, out):
+    for job in atq.iter_queue(args.queue, args.backend):
+        print('{0}\t{1}\t{2}\t{3}'.format(job['id'], job['when'],
+            job['queue'], job['who']), file = out)
+    return 0
+
+def _export(args, out):
+    jobs = atq.iter_queue(args.queue, args.backend)
+    if args.commands:
+        jobs = iter_scripts(jobs, args.workers)
+    for job in jobs:
+        out.write(_dumps(job) + '\n')
+    return 0
+
+def _submit(args, out):
+    command = args.command
+    if command is None:
+        command = sys.stdin.read()
+    job = atd.at(command, _parse_when(' '.join(args.when)),
+        args.queue or config.at_default_queue, args.tag)
+    print(_dumps(dict(id = job.id, when = job.when, queue = job.queue)),
+        file = out)
+    return 0
+
+def _import(args, out):
+    errors = list()
+    numbers = collections.deque()
+
+    def jobs():
+        for number, job in read_jobs(sys.stdin, args.format, errors):
+            numbers.append(number)
+            yield job
+
+    level = None
+    if args.per_minute:
+        level = leveling.Leveler(args.per_minute, args.tolerance)
+
+    failed = 0
+    for result in atd.at_many(jobs(), args.workers, level):
+        number = numbers.popleft()
+        while errors:
+            failed += 1
+            print('line {0}: {1}'.format(*errors.pop(0)), file = sys.stderr)
+        if isinstance(result, Exception):
+            failed += 1
+            print('line {0}: {1}'.format(number, result), file = sys.stderr)
+        else:
+            out.write(_dumps(dict(line = number, id = result.id,
+                when = result.when, queue = result.queue)) + '\n')
+
+    for error in errors:
+        failed += 1
+        print('line {0}: {1}'.format(*error), file = sys.stderr)
+    if level is not None:
+        print('leveled: {jobs} jobs, {moved} moved, {over_budget} over '
+            'budget, at most {max_delay} late and {max_starts} starting a '
+            'minute'.format(**level.report()), file = sys.stderr)
+    return 1 if failed else 0
+
+def _cancel(args, out):
+    if args.ids == ['-']: # Ids, or jobs as export writes them
+        ids = [json.loads(line)['id'] if line.lstrip().startswith('{') else
+            line.strip() for line in sys.stdin if line.strip()]
+    else:
+        ids = args.ids
+    try:
+        ids = [int(id) for id in ids]
+    except ValueError as e:
+        print('Invalid job id: {0}'.format(e), file = sys.stderr)
+        return 2
+
+    report = atd._atrm_ids(ids, args.workers)
+    for id, error in sorted(report.failed.items()):
+        print('{0}: {1}'.format(id, error), file = sys.stderr)
+    return 0 if report else 1
+
+def main(argv = None, out = None):
+    out = out or sys.stdout
+    parser = argparse.ArgumentParser(prog = 'python -m atd',
+        description = 'Schedule, list, export, import and cancel at jobs.')
+    commands = parser.add_subparsers(dest = 'subcommand')
+    commands.required = True
+
+    submit = commands.add_parser('submit', help = 'schedule a command')
+    submit.add_argument('when', nargs = '+', help = 'a timespec, or a date '
+        'and time like 2037-02-07T09:05:00')
+    submit.add_argument('-c', '--command', help = 'the command to run '
+        '(default: read from stdin)')
+    submit.add_argument('-t', '--tag', action = 'append',
+        help = 'tag the job (needs config.registry_path)')
+    submit.set_defaults(run = _submit)
+
+    listing = commands.add_parser('list', help = 'list jobs, like atq')
+    listing.set_defaults(run = _list)
+
+    export = commands.add_parser('export', help = 'write jobs to stdout as '
+        'JSON Lines')
+    export.add_argument('--commands', action = 'store_true',
+        help = 'include each job\'s command, environment and cwd')
+    export.set_defaults(run = _export)
+
+    imports = commands.add_parser('import', help = 'submit jobs read from '
+        'stdin, as JSON Lines or CSV')
+    imports.add_argument('--format', choices = ('jsonl', 'csv'),
+        default = 'jsonl', help = 'format of stdin (default: %(default)s)')
+    imports.add_argument('--per-minute', type = int, help = 'move jobs so '
+        'that at most this many start in a minute of each queue')
+    imports.add_argument('--tolerance', type = float, help = 'move jobs at '
+        'most this many seconds (default: config.leveling_tolerance)')
+    imports.set_defaults(run = _import)
+
+    cancel = commands.add_parser('cancel', help = 'cancel jobs by id')
+    cancel.add_argument('ids', nargs = '+', metavar = 'id',
+        help = 'job ids, or - to read ids or exported jobs from stdin')
+    cancel.set_defaults(run = _cancel)
+
+    for subcommand in (submit, listing, export):
+        subcommand.add_argument('-q', '--queue', help = 'the queue')
+    for subcommand in (listing, export):
+        subcommand.add_argument('--backend', choices = ('atq', 'spool'),
+            help = 'how to read the queue (default: config.atq_backend)')
+    for subcommand in (export, imports, cancel):
+        subcommand.add_argument('--workers', type = int, default = 8,
+            help = 'at most this many `at`s at once (default: %(default)s)')
+
+    args = parser.parse_args(argv)
+    try:
+        return args.run(args, out)
+    except (ValueError, OSError, CalledProcessError) as e:
+        print('{0}: {1}'.format(parser.prog, e), file = sys.stderr)
+        return 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,162 @@
+################################################################################
+# atd.py - The Unix at scheduler in Python ################ py2/3k version 0.2 #
+################################################################################
+# Admission control: hold batch jobs back while the host is busy.              #
+################################################################################
+# atd only starts a batch job once the load average is low, but `batch` takes  #
+# whatever it's given, so thousands of jobs submitted at once sit in the       #
+# queue and are started one after another as soon as the load dips, keeping a  #
+# shared host busy long after. An AdmissionController is asked before each     #
+# job is submitted. It admits it if the 1-minute load average, from            #
+# /proc/loadavg (or os.getloadavg()), is below max_load, and fewer than        #
+# max_depth jobs are waiting in the batch queue. Otherwise it checks again     #
+# every interval seconds, and after timeout seconds the job is deferred.       #
+#                                                                              #
+# The queue is only read with AtQueue every config.admission_depth_ttl seconds #
+# and when it looks full; in between, the jobs admitted are counted onto what  #
+# was read. Jobs admitted but not yet submitted are counted until submitted()  #
+# is called for them. atd.batch_many() takes a controller, and does that.      #
+################################################################################
+##  Written by Fredrick Brennan <copypaste@kittens.ph>. See LICENSE (Expat).  ##
+################################################################################
+
+from __future__ import absolute_import
+import multiprocessing
+import os
+import threading
+import time
+
+# Submodules #
+from atd import atq
+from atd import config
+
+def read_loadavg(path = '/proc/loadavg'):
+    """ The 1-minute load average, from path, or os.getloadavg() where there's
+        no such file. Raises OSError if neither can be read. """
+    try:
+        with open(path) as f:
+            return float(f.read().split()[0])
+    except (IOError, OSError, ValueError, IndexError):
+        return os.getloadavg()[0]
+
+class Deferred(Exception):
+    """ A job that wasn't admitted in time, so wasn't submitted. job is what
+        was given to atd.batch_many() for it. """
+    def __init__(self, job):
+        Exception.__init__(self, 'Deferred: the host is too busy.')
+        self.job = job
+
+class AdmissionController(object):
+    """ Admits batch jobs while the load average is below max_load (by
+        default, config.admission_max_load, or else the number of CPUs), and
+        fewer than max_depth jobs (by default, config.admission_max_depth; None
+        is no limit) are waiting in queue (by default,
+        config.batch_default_queue). load is a function returning the load
+        average, read_loadavg() by default. It's checked every interval
+        seconds (by default, config.admission_interval) while jobs wait.
+
+        It's thread safe. Waiting callers are admitted one at a time, so a job
+        is never admitted on the strength of a check made for another. Call
+        submitted() once each admitted job has been submitted, or has failed
+        to be. """
+    def __init__(self, max_load = None, max_depth = None, queue = None,
+            load = None, interval = None):
+        if max_load is None:
+            max_load = config.admission_max_load
+        if max_load is None:
+            max_load = float(multiprocessing.cpu_count())
+        self.max_load = max_load
+        self.max_depth = config.admission_max_depth if max_depth is None \
+            else max_depth
+        self.queue = queue or config.batch_default_queue
+        self.load = load or read_loadavg
+        self.interval = config.admission_interval if interval is None \
+            else interval
+
+        self.admitted = 0
+        self.throttled = 0 # Jobs that had to wait, admitted or not
+        self.deferred = 0
+        self.waited = 0.0  # Seconds, over every job
+        self._lock = threading.Lock()        # Admits one caller at a time
+        self._count_lock = threading.Lock()  # Guards the counts below
+        self._queued = None # Jobs in the queue when it was last read
+        self._since = 0     # Jobs submitted since then
+        self._in_flight = 0 # Jobs admitted but not submitted yet
+        self._depth_read = 0
+
+    def depth(self):
+        """ How many jobs are waiting in the queue, as far as we know: what
+            AtQueue found last time, and the jobs admitted since. The queue is
+            read again if that's config.admission_depth_ttl seconds old, or
+            says it's full, in case atd has started some. """
+        now = time.time()
+        depth = self._estimate()
+        if depth is None or now - self._depth_read >= \
+                config.admission_depth_ttl or (self.max_depth is not None and
+                depth >= self.max_depth):
+            with self._count_lock:
+                before = self._since # These are in the queue by now.
+            queued = len(atq.AtQueue(self.queue).jobs)
+            with self._count_lock:
+                self._queued = queued
+                self._since -= before
+            self._depth_read = now
+            depth = self._estimate()
+        return depth
+
+    def _estimate(self):
+        with self._count_lock:
+            if self._queued is None:
+                return None
+            return self._queued + self._since + self._in_flight
+
+    def has_room(self):
+        """ True if a job would be admitted now. """
+        if self.load() >= self.max_load:
+            return False
+        return self.max_depth is None or self.depth() < self.max_depth
+
+    def admit(self, timeout = None):
+        """ Wait until there's room for a job, or for timeout seconds (by
+            default, as long as it takes). Returns True if the job was
+            admitted and should be submitted, and False if it was deferred. """
+        started = time.time()
+        deadline = None if timeout is None else started + timeout
+        with self._lock:
+            try:
+                if self.has_room():
+                    self._admitted()
+                    return True
+
+                self.throttled += 1
+                while True:
+                    interval = self.interval
+                    if deadline is not None:
+                        interval = min(interval, deadline - time.time())
+                        if interval <= 0:
+                            self.deferred += 1
+                            return False
+                    time.sleep(interval)
+                    if self.has_room():
+                        self._admitted()
+                        return True
+            finally:
+                self.waited += time.time() - started
+
+    def _admitted(self):
+        self.admitted += 1
+        with self._count_lock:
+            self._in_flight += 1
+
+    def submitted(self):
+        """ Note that a job admit() admitted has been submitted, so is in
+            the queue, or failed to be. """
+        with self._count_lock:
+            self._in_flight = max(self._in_flight - 1, 0)
+            self._since += 1
+
+    def report(self):
+        """ A dict of how many jobs were admitted, throttled (made to wait)
+            and deferred, and how many seconds they waited in all. """
+        return dict(admitted = self.admitted, throttled = self.throttled,
+            deferred = self.deferred, waited = self.waited)
@@ -0,0 +1,245 @@
+################################################################################
+# atd.py - The Unix at scheduler in Python ################ py2/3k version 0.2 #
+################################################################################
+# asyncio versions of at(), atrm(), clear(), wait(), AtQueue.  (Python 3 only) #
+################################################################################
+# These  never  block  the  event loop on a fork+exec or on  waiting  for  the #
+# child. They  share  argument  building and parsing with the blocking API, so #
+# both  behave the same. At most config.aio_max_processes children run at once #
+# per event loop. Every coroutine takes a timeout in seconds; if it runs out,  #
+# or  the  coroutine  is cancelled, the child is killed and reaped before  the #
+# exception propagates.                                                        #
+################################################################################
+##  Written by Fredrick Brennan <copypaste@kittens.ph>. See LICENSE (Expat).  ##
+################################################################################
+
+import asyncio
+import functools
+import weakref
+from subprocess import PIPE, DEVNULL, CalledProcessError
+
+# Submodules #
+from atd import atd
+from atd import atq
+from atd import coalesce
+from atd import completion
+from atd import config
+from atd import metrics
+from atd import watch
+from atd.atq import snapshot_cache
+
+_semaphores = weakref.WeakKeyDictionary()
+
+def _semaphore():
+    """ The semaphore limiting children of the running event loop. """
+    loop = asyncio.get_running_loop()
+    semaphore = _semaphores.get(loop)
+    if semaphore is None:
+        semaphore = _semaphores[loop] = asyncio.Semaphore(
+            config.aio_max_processes)
+    return semaphore
+
+async def _run(args, input = None, timeout = None, env = None):
+    """ Run args, feeding it input. Returns a tuple of (returncode, stdout,
+        stderr). """
+    async with _semaphore():
+        with metrics.call(args) as call:
+            proc = await asyncio.create_subprocess_exec(*args,
+                stdin = DEVNULL if input is None else PIPE, stdout = PIPE,
+                stderr = PIPE, env = env)
+            try:
+                stdout, stderr = await asyncio.wait_for(
+                    proc.communicate(input), timeout)
+            except BaseException:
+                # Timed out or cancelled; don't leave a zombie.
+                if proc.returncode is None:
+                    proc.kill()
+                await proc.wait()
+                raise
+            finally:
+                call.returncode = proc.returncode
+
+            call.output_bytes = len(stdout) + len(stderr)
+
+    return (proc.returncode, stdout, stderr)
+
+async def at(command, when, queue = 'a', tags = None, timeout = None):
+    """ Execute command at when. See atd.at(). """
+    if config.scheduler_backend == 'engine' or config.at_backend == 'spool':
+        # Nothing to fork, but writing the journal or the spool may block.
+        return atd._record(await asyncio.get_running_loop().run_in_executor(
+            None, atd._submit_job, command, when, queue), tags)
+
+    atargs, when, queue = atd._build_at_args(when, queue)
+    token = completion.new_token() if config.completion_log else None
+    returncode, at_stdout, at_stderr = await _run(atargs, (command if token is
+        None else completion.wrap(command, token)).encode("utf-8"), timeout,
+        atd._at_env())
+    snapshot_cache.invalidate()
+    if returncode != 0:
+        raise CalledProcessError(returncode, atargs, at_stdout, at_stderr)
+
+    atjob = atd._atjob_from_submission(at_stderr, command, when, queue)
+    if token is not None:
+        atjob.token = token
+        atd._record_submissions([(token, atjob.id)])
+    return atd._record(atjob, tags)
+
+async def wait(jobs, timeout = None):
+    """ Wait for jobs to run, like atd.completion.wait(), without blocking
+        the event loop. """
+    loop = asyncio.get_running_loop()
+    deadline = None if timeout is None else loop.time() + timeout
+    tracker = completion.get_tracker()
+    while True:
+        done, pending = tracker.wait(jobs, timeout = 0)
+        if not pending or (deadline is not None and loop.time() >= deadline):
+            return (done, pending)
+
+        interval = config.completion_poll_interval
+        if deadline is not None:
+            interval = min(interval, max(deadline - loop.time(), 0))
+        await asyncio.sleep(interval)
+
+async def atrm(*atjobs, timeout = None):
+    """ Cancel one or more AtJobs. See atd.atrm(). Any number may be given;
+        they're split over as many `at -r`s as the system's limit on the
+        length of a command line needs. Raises CalledProcessError if any of
+        them couldn't be canceled, like atd.atrm() does, after canceling the
+        rest. CoalescedJobs may be passed too; only their own command is
+        canceled. """
+    coalesced = [job for job in atjobs
+        if isinstance(job, coalesce.CoalescedJob)]
+    if coalesced:
+        # Marks them canceled, and may atrm() a job all of whose are.
+        await asyncio.get_running_loop().run_in_executor(None,
+            functools.partial(coalesce.cancel, *coalesced))
+        atjobs = [job for job in atjobs if job not in coalesced]
+        if not atjobs: return True
+
+    report = await _atrm_ids([job.id for job in atjobs], None, timeout)
+    if not report:
+        failed = report.failed
+        raise CalledProcessError(1, [config.at_binary, '-r'] +
+            [str(id) for id in sorted(failed)], b'', ''.join(error + '\n'
+            for error in sorted(set(failed.values()))).encode('utf-8'))
+    return True
+
+async def clear(queue = False, timeout = None, workers = 4):
+    """ Cancel all atjobs, or all atjobs in queue. Returns a CancelReport,
+        like atd.clear(). """
+    atjobs = (await AsyncAtQueue.create(queue, timeout = timeout)).jobs
+    return await _atrm_ids([job.id for job in atjobs], workers, timeout)
+
+async def _atrm_ids(ids, workers = None, timeout = None):
+    """ Cancel the jobs with the ids given, like atd._atrm_ids(), in chunks
+        small enough for one command line, and of at most len(ids) / workers
+        ids if workers is given. Returns a CancelReport. """
+    if config.scheduler_backend == 'engine':
+        # Nothing to fork, but writing the journal may block.
+        return await asyncio.get_running_loop().run_in_executor(None,
+            atd._atrm_ids, ids, workers or 1)
+
+    report = atd.CancelReport()
+    if not ids: return report # Nothing to cancel.
+
+    chunks = atd._chunk_ids([config.at_binary, '-r'], ids,
+        workers and -(-len(ids) // workers))
+    try:
+        for chunk_report in await asyncio.gather(*[_atrm_chunk(chunk,
+                timeout) for chunk in chunks]):
+            report.update(chunk_report)
+    finally:
+        snapshot_cache.invalidate()
+
+    atd._forget([atq.AtJob(id) for id in report.canceled])
+    return report
+
+async def _atrm_chunk(ids, timeout = None):
+    """ Run `at -r` on ids, like atd._atrm_chunk(). """
+    atrm_args = [config.at_binary, '-r']
+    atrm_args.extend([str(id) for id in ids])
+    returncode, stdout, stderr = await _run(atrm_args, timeout = timeout)
+    return atd._atrm_report(ids, returncode, stderr)
+
+class AsyncAtQueue(atq.AtQueue):
+    """ An AtQueue whose refresh() is a coroutine. Unlike AtQueue, it starts
+        out empty, so either await refresh() after creating it, or create it
+        with `await AsyncAtQueue.create()`.
+
+        Lazily loaded AtJob attributes, and load_commands(), still block; for
+        those, load everything you need up front. """
+    def __init__(self, queue = False, backend = None, timeout = None,
+            compact = None):
+        self._setup(queue, backend, compact)
+        self.timeout = timeout
+
+    @classmethod
+    async def create(cls, queue = False, backend = None, timeout = None,
+            compact = None):
+        """ Create an AsyncAtQueue and refresh it. """
+        self = cls(queue, backend, timeout, compact)
+        await self.refresh()
+        return self
+
+    async def refresh(self):
+        """ Refresh this AsyncAtQueue. See AtQueue.refresh(). """
+        parsed_jobs = None
+        if config.scheduler_backend == 'engine':
+            parsed_jobs = self._read_listing() # Just a copy, so no waiting.
+        elif self.backend == 'spool':
+            # Scanning a big spool takes a while, so keep it off the loop too.
+            parsed_jobs = await asyncio.get_running_loop().run_in_executor(
+                None, self._read_spool)
+
+        if parsed_jobs is None:
+            atq_args = self._atq_args()
+            returncode, stdout, stderr = await _run(atq_args,
+                timeout = self.timeout)
+            if returncode != 0:
+                raise CalledProcessError(returncode, atq_args, stdout, stderr)
+            parsed_jobs = self._parse_atq(stdout)
+            self.source = 'atq'
+
+        return self._set_jobs(parsed_jobs)
+
+async def awatch(atqueue = None, poll_interval = None):
+    """ An async iterator version of atd.watch.watch(). atqueue defaults to a
+        new AtQueue(backend='spool'). """
+    loop = asyncio.get_running_loop()
+    if atqueue is None:
+        atqueue = await loop.run_in_executor(None,
+            functools.partial(atq.AtQueue, backend = 'spool'))
+
+    watcher = watch.SpoolWatcher(poll_interval = poll_interval)
+    changed = asyncio.Event()
+
+    def readable():
+        # inotify's fd stays readable until it's drained, so drain it here:
+        # left for later, it'd call us nonstop while we update the queue or
+        # the consumer holds on to an event. changed remembers it for us.
+        watcher.changed()
+        changed.set()
+
+    if watcher.inotify:
+        loop.add_reader(watcher.fileno(), readable)
+
+    try:
+        while True:
+            # Updating may mean scanning the spool or running `atq`.
+            for event in await loop.run_in_executor(None, atqueue.update):
+                yield event
+
+            if watcher.inotify:
+                await changed.wait()
+                changed.clear()
+                continue
+
+            while not watcher.changed() and not atqueue._spool_pending:
+                await asyncio.sleep(watcher.poll_interval)
+            if atqueue._spool_pending:
+                await asyncio.sleep(watcher.poll_interval)
+    finally:
+        if watcher.inotify:
+            loop.remove_reader(watcher.fileno())
+        watcher.close()
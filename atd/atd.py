@@ -16,18 +16,27 @@ from __future__ import absolute_import
 import sys
 import os
 import pipes
-from subprocess import Popen, PIPE, check_call
-import tempfile
+from subprocess import CalledProcessError
+import collections
+from concurrent.futures import ThreadPoolExecutor
 import warnings
 import datetime
 import re
 import json
 
 # Submodules #
-from atd.atq import AtQueue, AtJob, _validate_queue
+from atd.atq import AtQueue, AtJob, _validate_queue, snapshot_cache
+from atd import admission
+from atd import coalesce
+from atd import completion
 from atd import config
+from atd import engine
+from atd import registry
+from atd import spawn
+from atd import spool
+from atd import timespec
 
-def at(command, when, queue = 'a'):
+def at(command, when, queue = 'a', tags = None):
     """ Execute command at when.
 
         command may be anything interpreble by /bin/sh. If you need features
@@ -35,8 +44,10 @@ def at(command, when, queue = 'a'):
         <path to shell> <path to script>.
 
         when may be a datetime.timedelta, a datetime.datetime or a timespec str.
-        If a string is provided, it is assumed that it's a valid timespec. See
-        `timespec` doc in `at`'s documentation.
+        See `timespec` doc in `at`'s documentation. Timespecs are parsed by
+        atd.timespec before `at` is run, so an invalid one raises ValueError,
+        and the returned AtJob's when is the datetime it refers to. If when is
+        None, command is a batch job; see batch().
 
         python-atd also has good support for named queues. Both GNU and BSD at
         support the concept of named queues, which allow you to easily separate
@@ -45,38 +56,263 @@ def at(command, when, queue = 'a'):
         24 hours after request, while international wire clearing would go in
         queue "i" 48 hours after request. An unfortunate limitation of `at` is
         that all jobs can only be one letter, A-Z or a-z. This means there are
-        only 52 available queues in both BSD at and GNU at. """
+        only 52 available queues in both BSD at and GNU at.
+
+        If config.registry_path is set, the job is recorded in the registry
+        (see atd.registry) along with tags, an iterable of strings that
+        AtQueue.tagged() finds it by.
+
+        If config.scheduler_backend is 'engine', the job is given to the
+        engine in this process (see atd.engine) instead of `at`. If
+        config.at_backend is 'spool', it's written straight into the spool
+        (see atd.spool.write_jobs()). """
+    return _record(_submit_job(command, when, queue), tags)
+
+def batch(command, queue = None, tags = None):
+    """ Execute command when the system load allows, like `batch` does: atd
+        starts it once the load average drops low enough. queue is
+        config.batch_default_queue by default; atd only holds back jobs in
+        that queue, so jobs in others are run at once.
+
+        batch() submits unconditionally. To keep lots of batch jobs from piling
+        up on a busy host, submit them with batch_many() and an
+        atd.admission.AdmissionController. """
+    return _record(_submit_job(command, None,
+        queue or config.batch_default_queue), tags)
+
+def batch_many(jobs, controller = None, workers = 4, timeout = None):
+    """ Submit many batch jobs. jobs is an iterable of (command, queue, tags)
+        tuples, as the arguments to batch(), or just commands; queue and tags
+        may be omitted.
+
+        If controller, an atd.admission.AdmissionController, is given, each
+        job is held back until it admits it: until the load average, and the
+        number of jobs waiting in the batch queue, are below its limits. A job
+        that isn't admitted within timeout seconds (by default, wait as long as
+        it takes) is deferred, not submitted; after one has been, the rest are
+        only admitted if there's room at once, so a busy host doesn't hold the
+        caller up for timeout seconds per job.
+
+        Like at_many(), this is a generator that keeps up to workers `at`s in
+        flight, and yields, in the same order as jobs, an AtJob, the exception
+        submitting it raised, or an atd.admission.Deferred holding a job that
+        wasn't admitted. """
+    if workers < 1:
+        raise ValueError('workers must be at least 1')
+
+    def submit_one(command, queue = None, tags = None):
+        return batch(command, queue, tags)
+
+    pending = collections.deque()
+    executor = ThreadPoolExecutor(max_workers = workers)
+    wait = timeout
+
+    try:
+        for job in jobs:
+            if isinstance(job, str):
+                job = (job,)
+            if controller is not None and not controller.admit(wait):
+                pending.append(admission.Deferred(job))
+                wait = 0
+            else:
+                future = executor.submit(submit_one, *job)
+                if controller is not None:
+                    future.add_done_callback(lambda future:
+                        controller.submitted())
+                pending.append(future)
+
+            if len(pending) >= workers * 2:
+                yield _pending_result(pending.popleft())
+
+        while pending:
+            yield _pending_result(pending.popleft())
+    finally:
+        for future in pending:
+            if not isinstance(future, admission.Deferred):
+                future.cancel()
+        executor.shutdown(wait = True)
+
+def _pending_result(pending):
+    """ A result for batch_many(): pending is a Deferred, or a future. """
+    if isinstance(pending, admission.Deferred):
+        return pending
+    return _future_result(pending)
+
+def at_many(jobs, workers = 8, level = None):
+    """ Execute many commands, each at its own time. jobs is an iterable of
+        (command, when, queue, tags) tuples, with the same meaning as the
+        arguments to at(). queue and tags may be omitted.
+
+        Up to workers `at` processes are kept in flight at once. This is a
+        generator; it yields results in the same order as jobs. Each result is
+        either an AtJob or, if that submission failed, the exception it raised.
+        A failure doesn't abort the batch, so check results with isinstance()
+        if you need to know which items didn't make it into the queue.
+
+        jobs is consumed lazily, so a very large iterable won't be read into
+        memory all at once.
+
+        With config.at_backend = 'spool', jobs are instead written into the
+        spool SPOOL_BATCH at a time, waking atd once per batch.
+
+        level may be an atd.leveling.Leveler, to move jobs so that no more
+        than its budget start in any minute. Each AtJob's when is where it was
+        put; level.placements says where each was asked for. """
+    if workers < 1:
+        raise ValueError('workers must be at least 1')
+    if level is not None:
+        jobs = level.level(jobs)
+
+    if config.at_backend == 'spool' and config.scheduler_backend != 'engine':
+        for result in _at_many_spool(jobs):
+            yield result
+        return
+
+    def submit_one(command, when, queue = 'a', tags = None):
+        return _record(_submit_job(command, when, queue), tags)
+
+    pending = collections.deque()
+    executor = ThreadPoolExecutor(max_workers = workers)
+
+    try:
+        for job in jobs:
+            pending.append(executor.submit(submit_one, *job))
+
+            # Keep a bounded window of submissions in flight, yielding the
+            # oldest as soon as the window is full to preserve input order.
+            if len(pending) >= workers * 2:
+                yield _future_result(pending.popleft())
+
+        while pending:
+            yield _future_result(pending.popleft())
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait = True)
+
+# How many jobs at_many() writes into the spool at once.
+SPOOL_BATCH = 512
+
+def _at_many_spool(jobs):
+    """ at_many() for the spool backend. """
+    batch = list()
+    for job in jobs:
+        batch.append(job)
+        if len(batch) >= SPOOL_BATCH:
+            for result in _write_batch(batch):
+                yield result
+            batch = list()
+
+    for result in _write_batch(batch):
+        yield result
+
+def _write_batch(batch):
+    """ Write the (command, when, queue, tags) tuples in batch into the
+        spool, returning a list of AtJobs, or the exceptions raised. """
+    results = list()
+    valid = list()
+    for job in batch:
+        try:
+            command, when, queue, tags = _job_tuple(job)
+            when, queue = _build_at_args(when, queue)[1:]
+        except Exception as e:
+            results.append(e)
+            continue
+        token = completion.new_token() if config.completion_log else None
+        results.append((command, when, queue, tags, token))
+        valid.append((command if token is None else
+            completion.wrap(command, token), when, queue))
+
+    error = None
+    try:
+        ids = spool.write_jobs(valid)
+    except Exception as e:
+        # The jobs written before it failed are in the spool; only the rest
+        # get the exception, so retrying those doesn't make duplicates.
+        ids, error = getattr(e, 'written', []), e
+    finally:
+        snapshot_cache.invalidate()
+
+    ids = iter(ids)
+    submissions = list()
+    for i, result in enumerate(results):
+        if isinstance(result, Exception): continue
+        command, when, queue, tags, token = result
+        id = next(ids, None)
+        if id is None:
+            results[i] = error
+            continue
+        try:
+            atjob = _spooled_atjob(id, command, when, queue)
+            if token is not None:
+                atjob.token = token
+                submissions.append((token, atjob.id))
+            results[i] = _record(atjob, tags)
+        except Exception as e:
+            results[i] = e
+
+    if submissions:
+        _record_submissions(submissions)
+    return results
+
+def _spooled_atjob(id, command, when, queue):
+    atjob = AtJob(id)
+    atjob.command = command
+    atjob.when = when
+    atjob.queue = queue
+    atjob.who = os.getenv("LOGNAME")
+    return atjob
 
+def _job_tuple(job):
+    """ job, an item of at_many()'s jobs, as a (command, when, queue, tags)
+        tuple, with the defaults at() has for what's left out. """
+    return (tuple(job) + ('a', None)[len(job) - 2:])[:4]
+
+def _future_result(future):
+    """ Return the result of future, or the exception it raised. """
+    try:
+        return future.result()
+    except Exception as e:
+        return e
+
+def _build_at_args(when, queue):
+    """ Validate when and queue, and build the `at` command line for them.
+        Returns a tuple of (atargs, when, queue), where when has been converted
+        to a datetime if we know what time it refers to. """
     # First build our timespec for `at`...
     posix_time = False
-    # Since timespecs aren't validated/parsed, we can only easily check datetime
-    check_past = False
-    if isinstance(when, datetime.datetime):
-        timespec = convert_datetime(when)
+    now = earliest = datetime.datetime.now()
+    if when is None: # A batch job, which can start from now on.
+        spec = None
+        when = now
+    elif isinstance(when, datetime.datetime):
+        spec = convert_datetime(when)
         posix_time = True
-        check_past = True
     elif isinstance(when, datetime.timedelta):
-        timespec = convert_timedelta(when)
-        when = datetime.datetime.now() + when
-        check_past = True
+        spec = convert_timedelta(when)
+        when = now + when
     elif isinstance(when, str):
-        timespec = when # TODO: Validate timespec?
+        spec = when
+        when = timespec.resolve(spec, now)
+        # `at` ignores seconds, so "now" is the start of this minute.
+        earliest = now.replace(second = 0, microsecond = 0)
     else:
         raise NotImplementedError('I don\'t support the class you pass'+
                 'ed to schedule(). Try the builtin datetime.')
 
-    if check_past:
-        if (when < datetime.datetime.now()):
-            raise ValueError('`when` must be at a time in the future, never in'+
-                ' the past')
+    if (when < earliest):
+        raise ValueError('`when` must be at a time in the future, never in'+
+            ' the past')
 
     # Build our `at` command line arguments...
     atargs = list([config.at_binary])
     queue = _validate_queue(queue)
-    if posix_time:
-        atargs.append('-t')
-
-    atargs.extend(timespec.split(" "))
+    if spec is None:
+        atargs.append('-b')
+    else:
+        if posix_time:
+            atargs.append('-t')
+        atargs.extend(spec.split(" "))
 
     if config.always_send_mail:
         atargs.append('-m')
@@ -86,22 +322,72 @@ def at(command, when, queue = 'a'):
     atargs.append('-q')
     atargs.append(queue)
 
-    # Prevent creation of a needless subprocess by using a temporary file.
-    # StringIO cannot be used due to Popen's use of fileno().
-    at_stdin = tempfile.TemporaryFile('w')
-    at_stdin.write(command)
-    at_stdin.seek(0)
-
-    # Build our Popen keyword arguments...
-    atkwargs = dict(stdin=at_stdin, stdout=PIPE, stderr=PIPE)
-    if not config.inherit_env:
-        atkwargs['env'] = config.atjob_environment
-
-    sp = Popen(atargs, **atkwargs)
-    (at_stdout, at_stderr) = sp.communicate()
-    at_stdin.close()
+    return (atargs, when, queue)
+
+def _submit_job(command, when, queue):
+    """ Schedule command with `at` or the engine, and return its AtJob. If
+        config.completion_log is set, command is wrapped to log its
+        completion (see atd.completion), and the AtJob gets a token. """
+    token = None
+    if config.completion_log:
+        token = completion.new_token()
+    atjob = _schedule(command if token is None else
+        completion.wrap(command, token), when, queue)
+    if token is not None:
+        atjob.command = command
+        atjob.token = token
+        _record_submissions([(token, atjob.id)])
+    return atjob
 
-    # Build our AtJob object for user consumption...
+def _record_submissions(submissions):
+    """ Note which job each token is in the completion log. A job that's
+        been submitted already mustn't be lost if that fails, so it warns. """
+    try:
+        completion.record_submissions(submissions)
+    except (IOError, OSError) as e:
+        warnings.warn('Couldn\'t write to the completion log: {0}'.format(e))
+
+def _schedule(command, when, queue):
+    """ _submit_job() without completion tracking. """
+    atargs, when, queue = _build_at_args(when, queue)
+    if config.scheduler_backend == 'engine':
+        job = engine.get_engine().submit(command, when, queue,
+            environment = None if config.inherit_env else
+            config.atjob_environment)
+        snapshot_cache.invalidate()
+
+        atjob = AtJob(job['id'])
+        for k in ('command', 'when', 'queue', 'who'):
+            setattr(atjob, k, job[k])
+        return atjob
+    elif config.at_backend == 'spool':
+        id = spool.write_jobs([(command, when, queue)])[0]
+        snapshot_cache.invalidate()
+        return _spooled_atjob(id, command, when, queue)
+
+    at_stderr = _submit(atargs, command)
+    snapshot_cache.invalidate()
+    return _atjob_from_submission(at_stderr, command, when, queue)
+
+def _submit(atargs, command):
+    """ Run `at` with atargs, feeding it command on stdin. Returns `at`'s
+        stderr, which is where it tells us the new job's id. Raises
+        CalledProcessError, with `at`'s stderr, if it fails. """
+    (returncode, at_stdout, at_stderr) = spawn.run(atargs,
+        command.encode("utf-8"), _at_env())
+
+    if returncode != 0:
+        raise CalledProcessError(returncode, atargs, at_stdout, at_stderr)
+    return at_stderr
+
+def _at_env():
+    """ The environment to run `at` in, or None to inherit ours. """
+    if config.inherit_env:
+        return None
+    return config.atjob_environment
+
+def _atjob_from_submission(at_stderr, command, when, queue):
+    """ Build our AtJob object for user consumption... """
     atjob = AtJob()
     atjob.from_at_stderr(at_stderr)
     atjob.command = command
@@ -111,20 +397,181 @@ def at(command, when, queue = 'a'):
 
     return atjob
 
+def _record(atjob, tags):
+    """ Record atjob in the registry, if there is one, and return it. """
+    reg = registry.get_registry()
+    if reg is not None:
+        reg.record(atjob, tags)
+    return atjob
+
+def _forget(atjobs):
+    """ Forget canceled atjobs in the registry, if there is one. """
+    reg = registry.get_registry()
+    if reg is not None:
+        reg.forget(*[job.id for job in atjobs])
+
 def atrm(*atjobs):
     """ Cancel one or more AtJobs. Takes an AtJob instance returned by at().
         You may also choose to save the at job ID in a database, and pass its ID
-        to cancel(). """
+        to cancel(). CoalescedJobs (see atd.coalesce) may be passed too; only
+        their own command is canceled. """
+    coalesced = [job for job in atjobs
+        if isinstance(job, coalesce.CoalescedJob)]
+    if coalesced:
+        coalesce.cancel(*coalesced)
+        atjobs = [job for job in atjobs if job not in coalesced]
+        if not atjobs: return True
     atrm_args = [config.at_binary, '-r']
     atrm_args.extend([str(job.id) for job in atjobs])
 
-    return (check_call(atrm_args) == 0)
+    try:
+        returncode, stdout, stderr = _run_atrm(atrm_args)
+    finally:
+        snapshot_cache.invalidate()
+
+    if returncode != 0:
+        raise CalledProcessError(returncode, atrm_args, stdout, stderr)
+
+    _forget(atjobs)
+    return True
+
+class CancelReport(dict):
+    """ What atrm_where() and clear() did: a dict of job id -> None if the job
+        was canceled, or the error `at -r` gave for it if it wasn't. A report
+        is true if every job was canceled, including when there were none. """
+    @property
+    def canceled(self):
+        """ A list of the ids that were canceled. """
+        return sorted(id for id, error in self.items() if error is None)
+
+    @property
+    def failed(self):
+        """ A dict of id -> error for the ids that weren't canceled. """
+        return dict((id, error) for id, error in self.items()
+            if error is not None)
+
+    def __bool__(self):
+        return all(error is None for error in self.values())
+    __nonzero__ = __bool__
+
+def atrm_where(predicate = None, queue = False, before = None, after = None,
+        workers = 4):
+    """ Cancel every job that matches all of the conditions given: in queue,
+        due before (but not at) the datetime before, due at or after the
+        datetime after, and for which predicate(job) is true. With no
+        conditions, every job is canceled.
+
+        Unlike atrm(), this never puts more ids on one `at -r` command line
+        than the system allows, so it works for any number of jobs. The ids
+        are split into chunks and up to workers `at -r`s run at once. Returns
+        a CancelReport instead of raising if some jobs couldn't be canceled. """
+    if workers < 1:
+        raise ValueError('workers must be at least 1')
+
+    ids = list()
+    for job in AtQueue(queue).jobs:
+        if before is not None and not job.when < before: continue
+        if after is not None and not job.when >= after: continue
+        if predicate is not None and not predicate(job): continue
+        ids.append(job.id)
+
+    return _atrm_ids(ids, workers)
+
+def _atrm_ids(ids, workers = 4):
+    """ Cancel the jobs with the ids given, as atrm_where() does. """
+    report = CancelReport()
+    if not ids: return report # Nothing to cancel.
 
-def clear(queue = False):
-    """ Cancel all atjobs. """
-    atjobs = AtQueue(queue).jobs
-    if not atjobs: return True # No jobs, queue already clear.
-    return atrm(*atjobs)
+    atrm_args = [config.at_binary, '-r']
+    chunks = _chunk_ids(atrm_args, ids, -(-len(ids) // workers))
+    executor = ThreadPoolExecutor(max_workers = workers)
+    try:
+        for chunk_report in executor.map(_atrm_chunk, chunks):
+            report.update(chunk_report)
+    finally:
+        executor.shutdown(wait = True)
+        snapshot_cache.invalidate()
+
+    _forget([AtJob(id) for id in report.canceled])
+    return report
+
+def _arg_max():
+    """ How many bytes of arguments we can give a child. It's shared with its
+        environment, and we leave some room to spare, like xargs does. """
+    try:
+        arg_max = os.sysconf('SC_ARG_MAX')
+    except (ValueError, OSError):
+        arg_max = -1
+    if arg_max <= 0:
+        arg_max = 4096 # The least POSIX allows.
+
+    environ = sum(len(k) + len(v) + 2 + 8 for k, v in os.environ.items())
+    return max(arg_max - environ - 2048, 1024)
+
+def _chunk_ids(args, ids, most = None, limit = None):
+    """ Split ids into lists small enough to append to args without the
+        command line getting longer than limit bytes (by default, _arg_max())
+        or having more than most ids. """
+    limit = limit or _arg_max()
+    base = sum(len(arg) + 1 + 8 for arg in args) + 8
+    chunks = [[]]
+    size = base
+
+    for id in ids:
+        cost = len(str(id)) + 1 + 8 # The string, its NUL and its pointer
+        if chunks[-1] and (size + cost > limit or
+                (most and len(chunks[-1]) >= most)):
+            chunks.append([])
+            size = base
+        chunks[-1].append(id)
+        size += cost
+
+    return chunks
+
+def _atrm_chunk(ids):
+    """ Run `at -r` on ids. Returns a dict of id -> None, or the line of
+        `at`'s stderr that mentions it if it couldn't be canceled. """
+    atrm_args = [config.at_binary, '-r']
+    atrm_args.extend([str(id) for id in ids])
+    returncode, at_stdout, at_stderr = _run_atrm(atrm_args)
+    return _atrm_report(ids, returncode, at_stderr)
+
+def _atrm_report(ids, returncode, at_stderr):
+    """ The dict _atrm_chunk() returns, from how `at -r` on ids went. """
+    report = dict((id, None) for id in ids)
+    if returncode == 0:
+        return report
+
+    # `at -r` carries on past jobs it can't cancel, and names them on stderr.
+    errors = at_stderr.decode("utf-8", "replace").strip() or \
+        'at -r exited with status {0}'.format(returncode)
+    named = False
+    for line in errors.splitlines():
+        for word in re.findall(r'\d+', line):
+            if int(word) in report:
+                report[int(word)] = line
+                named = True
+
+    if not named:
+        report = dict((id, errors) for id in ids)
+    return report
+
+def _run_atrm(atrm_args):
+    """ Run atrm_args, or cancel its ids in the engine if that's the
+        scheduler backend, answering like `at -r` would. Returns a tuple of
+        (returncode, stdout, stderr). """
+    if config.scheduler_backend != 'engine':
+        return spawn.run(atrm_args)
+
+    report = engine.get_engine().remove(*[int(id) for id in atrm_args[2:]])
+    errors = [error for error in report.values() if error is not None]
+    return (1 if errors else 0, b'', ''.join(error + '\n'
+        for error in errors).encode('utf-8'))
+
+def clear(queue = False, workers = 4):
+    """ Cancel all atjobs, or all atjobs in queue. Returns a CancelReport; see
+        atrm_where(). """
+    return atrm_where(queue = queue, workers = workers)
 
 def _can_read_file(filename):
     """ On many installations, at.allow and at.deny are not readable by non-root
@@ -209,18 +656,4 @@ if __name__ == "__main__":
     print('Poof!')
     print([str(job) for job in atq.jobs])
 
-    #print 'All right, let\'s have some more fun. Performance test, create'+\
-        #' 1,024 jobs.'
-
-    #for i in xrange(1,1024):
-        #at("echo lol >> /tmp/lolol", "now + 24 hours")
-
-    #print 'Created 1,024 jobs.'
-
-    #atq.refresh()
-
-    #print 'Counted {0} jobs.'.format(len(atq.jobs))
-
-    #for job in atq.jobs: atrm(job)
-
-    #print 'Deleted {0} jobs.'.format(len(atq.jobs))
+    # For performance tests, see atd.benchmarks.
@@ -13,18 +13,65 @@
 ################################################################################
 
 from __future__ import absolute_import
-from subprocess import check_output
+from subprocess import CalledProcessError, Popen, PIPE
+from concurrent.futures import ThreadPoolExecutor
+import array
+import bisect
 import datetime
 import re
 import json
 import string
+import threading
+import time
 
 # Submodules #
 from atd import config
+from atd import engine
+from atd import metrics
+from atd import registry
+from atd import spawn
+from atd import spool
 
 AT_OUTPUT_DATETIME_FORMAT = '%a %b %d %H:%M:%S %Y'
 AT_OUTPUT_DATETIME_FORMAT_BSD = '%a %b %d %H:%M:%S %Z %Y'
 
+BSD_ATQ_HEADER = "Date\t\t\t\tOwner\t\tQueue\tJob#"
+
+# For parsing `atq`'s dates without strptime, which is slow. `atq` prints them
+# in the C locale; anything else falls back to strptime.
+MONTHS = dict((month, i) for i, month in enumerate(['Jan', 'Feb', 'Mar',
+    'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'], 1))
+
+# Jobs are often due at the same few times, so recently parsed dates are
+# remembered, up to this many.
+ATQ_WHEN_MEMO_SIZE = 4096
+_atq_when_memo = dict()
+
+def _atq_when(month, day, hms, year, fields, fmt):
+    """ The datetime for the date fields of an `atq` line. fields and fmt are
+        what to give strptime if the fast path can't parse it. """
+    key = (month, day, hms, year)
+    when = _atq_when_memo.get(key)
+    if when is not None:
+        return when
+
+    try:
+        if len(hms) != 8: raise ValueError(hms)
+        when = datetime.datetime(int(year), MONTHS[month], int(day),
+            int(hms[0:2]), int(hms[3:5]), int(hms[6:8]))
+    except (KeyError, ValueError):
+        when = datetime.datetime.strptime(' '.join(fields), fmt)
+
+    if len(_atq_when_memo) >= ATQ_WHEN_MEMO_SIZE:
+        _atq_when_memo.clear()
+    _atq_when_memo[key] = when
+    return when
+
+# Events returned by AtQueue.update() and yielded by atd.watch.watch().
+JOB_ADDED = 'added'
+JOB_REMOVED = 'removed'
+JOB_EXECUTED = 'executed'
+
 def _validate_queue(queue):
     valid = (len(queue) == 1 and queue in (string.ascii_lowercase + \
             string.ascii_uppercase))
@@ -34,79 +81,588 @@ def _validate_queue(queue):
     else:
         raise ValueError('Invalid queue. Queues must match regex ^[A-Za-z]$')
 
+def iter_queue(queue = False, backend = None):
+    """ Yield a dict with the keys id, when, queue and who for each job in
+        queue (or every queue), like AtQueue(queue, backend) would read them,
+        but one at a time, so that big queues needn't fit in memory. """
+    listing = AtQueue.__new__(AtQueue)
+    listing._setup(queue, backend)
+    if config.scheduler_backend == 'engine':
+        return iter(engine.get_engine().list(listing.queue))
+
+    if listing.backend == 'spool':
+        try:
+            return spool.iter_spool(queue = listing.queue)
+        except OSError:
+            pass # Let `atq` try, like AtQueue does.
+    return listing.iter_jobs()
+
 class AtQueue(object):
     """ The AtQueue class represents the state of the `at` queue at the time 
         when it was initialized. Jobs are stored as a list in AtQueue.jobs. """
-    def __init__(self, queue = False):
+    def __init__(self, queue = False, backend = None, compact = None):
         """ AtQueue gets you a list of all jobs currently in the queue. Jobs 
-            fall out of the queue as they are executed or canceled by you. """
+            fall out of the queue as they are executed or canceled by you.
+
+            backend is 'atq' to run `atq`, or 'spool' to read the spool
+            directory directly, falling back to `atq` if the spool can't be
+            read. It defaults to config.atq_backend.
+
+            If compact is True (by default, config.compact_queues), jobs is a
+            JobColumns instead of a list of AtJobs. It behaves the same for
+            reading, but takes a fraction of the memory for big queues. It's
+            read-only, though: append(), remove(), sort() and friends raise
+            TypeError. Use list(queue.jobs) for a list you can change. """
+        self._setup(queue, backend, compact)
+        self.refresh()
+
+    def _setup(self, queue, backend, compact = None):
+        """ Validate and set everything refresh() needs. """
         self.queue = _validate_queue(queue) if queue else False
+        self.backend = backend or config.atq_backend
+        if self.backend not in ('atq', 'spool'):
+            raise ValueError('Invalid backend. Use \'atq\' or \'spool\'.')
+        self.compact = config.compact_queues if compact is None else compact
         self.bsd = False
-        self.refresh()
+        self.jobs = JobColumns(()) if self.compact else list()
+        self._spool_names = None
+        self._spool_pending = 0
+        self._index()
 
     def _atq_line(self, line):
         """ Parse one line of `atq` output. """
         split = str(line).split()
-        return dict(id = int(split[0]), 
-            when = datetime.datetime.strptime(
-                (' ').join(split[1:6]),
-                AT_OUTPUT_DATETIME_FORMAT),
+        return dict(id = int(split[0]),
+            when = _atq_when(split[2], split[3], split[4], split[5],
+                split[1:6], AT_OUTPUT_DATETIME_FORMAT),
             queue = split[6],
             who = split[7])
 
     def _atq_bsd_line(self, line):
         """ Parse one line of `atq` output. (BSD) """
         split = line.split()
-        return dict(when = \
-            datetime.datetime.strptime(
-                (' ').join(split[0:6]),
-                AT_OUTPUT_DATETIME_FORMAT_BSD), 
+        return dict(when = _atq_when(split[1], split[2], split[3], split[5],
+                split[0:6], AT_OUTPUT_DATETIME_FORMAT_BSD),
             who = split[6],
             queue = split[7],
-            id = split[8])
+            id = int(split[8]))
 
     def refresh(self):
-        """ Refresh this AtQueue, reading from `atq` again.
-            This is automatically called on instantiation.
-            self.jobs becomes a list of AtJob objects. """
-        if self.queue: 
+        """ Refresh this AtQueue, reading from `atq` (or the spool, or the
+            engine) again. This is automatically called on instantiation.
+            self.jobs becomes a list of AtJob objects. self.source says which
+            backend the jobs actually came from. """
+        if self.queue:
             _validate_queue(self.queue)
-            atq_args = ['atq', '-q', self.queue]
-        else:
-            atq_args = ['atq']
 
-        atq_out = self.raw = check_output(atq_args)
-        atqlines = atq_out.decode("utf-8").splitlines()
+        parsed_jobs = None
+        if self.backend == 'spool' and config.scheduler_backend != 'engine':
+            parsed_jobs = self._read_spool()
+
+        if parsed_jobs is None:
+            parsed_jobs = self._read_listing()
+
+        return self._set_jobs(parsed_jobs)
+
+    def _read_listing(self):
+        """ Read the whole queue from `atq`, or from the engine if
+            config.scheduler_backend is 'engine', and set self.source. """
+        if config.scheduler_backend == 'engine':
+            self.raw = None
+            self.source = 'engine'
+            return engine.get_engine().list(self.queue)
+
+        parsed_jobs = self._read_atq()
+        self.source = 'atq'
+        return parsed_jobs
+
+    def _read_spool(self):
+        """ Read the spool, returning a list of dicts like _read_atq(), or None
+            if the spool can't be read. """
+        started = metrics.clock()
+        try:
+            parsed_jobs = spool.read_spool(queue = self.queue)
+        except OSError:
+            return None # Usually EACCES. `atq` is setuid, so let it try.
+        metrics.emit(metrics.PARSE, kind = 'spool',
+            seconds = metrics.clock() - started, jobs = len(parsed_jobs))
+
+        self.raw = None
+        self.source = 'spool'
+        return parsed_jobs
+
+    def _set_jobs(self, parsed_jobs):
+        """ Make self.jobs a list of AtJob objects from parsed_jobs. """
+        self._spool_names = None
+        if self.compact:
+            self.jobs = JobColumns(parsed_jobs)
+            return self.jobs
 
         atqueue = list()
-        
-        for line in atqlines:
-            # The format of BSD atq differs...
-            if line.strip() == "Date\t\t\t\tOwner\t\tQueue\tJob#":
-                self.bsd = True
-                continue
 
-            if self.bsd:
-                parsed = self._atq_bsd_line(line)
-            else:
-                parsed = self._atq_line(line)
-
-            atjob = AtJob()
-            for k, v in parsed.items():
-                setattr(atjob, k, v)
-            atqueue.append(atjob)
+        for parsed in parsed_jobs:
+            atqueue.append(self._make_job(parsed))
 
         self.jobs = atqueue
+        self._index()
         return atqueue
 
-    def find_job_by_id(self, id):
-        """ Simply iterate through AtQueue.jobs and return the job with the
-            given id. Raise ValueError if no job in AtQueue. """
+    def _make_job(self, parsed):
+        """ Make an AtJob from one parsed line of `atq` or the spool. """
+        atjob = AtJob()
+        for k, v in parsed.items():
+            setattr(atjob, k, v)
+        return atjob
+
+    def update(self):
+        """ Bring this AtQueue up to date like refresh() does, but only apply
+            what changed since the last refresh() or update(). With the spool
+            backend, only new files in the spool are looked at.
+
+            Returns a list of (event, job) tuples, where event is JOB_ADDED,
+            JOB_REMOVED or JOB_EXECUTED. A job counts as executed once atd has
+            started running it (and its queue becomes '='), or if it vanished
+            after it was due.
+
+            Compact AtQueues can't be changed in place, so for them this
+            re-reads the whole queue, though it still only returns what
+            changed. """
+        if self.compact:
+            return self._update_compact()
+
+        changed = None
+        if self.backend == 'spool' and config.scheduler_backend != 'engine':
+            changed = self._spool_changes()
+
+        if changed is None:
+            current = dict((int(parsed['id']), parsed)
+                for parsed in self._read_listing())
+            self._spool_names = None
+            self._spool_pending = 0
+            changed = dict((id, parsed) for id, parsed in current.items()
+                if id not in self._by_id or
+                (self._by_id[id].queue, self._by_id[id].when) !=
+                (parsed['queue'], parsed['when']))
+            gone = [id for id in self._by_id if id not in current]
+        else:
+            changed, gone = changed
+
+        events = list()
+        now = datetime.datetime.now()
+
+        for id in gone:
+            job = self._by_id[id]
+            self._remove_job(job)
+            if job.queue == '=':
+                continue # Already reported as executed.
+            events.append((JOB_EXECUTED if job.when <= now else JOB_REMOVED,
+                job))
+
+        for id, parsed in changed.items():
+            job = self._by_id.get(id)
+            if job is None:
+                job = self._make_job(parsed)
+                self._add_job(job)
+                events.append((JOB_ADDED, job))
+                continue
+
+            self._remove_job(job)
+            for k, v in parsed.items():
+                setattr(job, k, v)
+            self._add_job(job)
+            if job.queue == '=':
+                events.append((JOB_EXECUTED, job))
+
+        return events
+
+    def _update_compact(self):
+        """ update() for compact AtQueues. """
+        old = self.jobs
+        self.refresh()
+        new = self.jobs
+        events = list()
+        now = time.time()
+        executing = ord('=')
+
+        for row, id in enumerate(old.ids):
+            if new.row_of(id) is not None or old.queues[row] == executing:
+                continue
+            events.append((JOB_EXECUTED if old.whens[row] <= now
+                else JOB_REMOVED, old[row]))
+
+        for row, id in enumerate(new.ids):
+            old_row = old.row_of(id)
+            if old_row is None:
+                events.append((JOB_ADDED, new[row]))
+            elif new.queues[row] == executing != old.queues[old_row]:
+                events.append((JOB_EXECUTED, new[row]))
+
+        return events
+
+    def _spool_changes(self):
+        """ Compare the spool with what this AtQueue knows. Returns a tuple of
+            (dict of id -> parsed job, for new or changed jobs, list of ids of
+            jobs no longer there), or None if the spool can't be read. """
+        try:
+            names = spool.spool_names(queue = self.queue)
+        except OSError:
+            return None
+
+        if self._spool_names is None or self.source != 'spool':
+            self._spool_names = dict((spool.spool_name(job.queue, job.id,
+                job.when), int(job.id)) for job in self.jobs)
+            self.source = 'spool'
+
+        known = self._spool_names
+        changed = dict()
+        owners = spool._Owners()
+
+        for id, name in names.items():
+            if name in known:
+                continue
+
+            # New or renamed. Files still being written come back as None, and
+            # are looked at again next time.
+            try:
+                parsed = spool.read_spool_entry(name, owners = owners)
+            except OSError:
+                continue # Gone again already
+            if parsed:
+                changed[id] = parsed
+
+        current = set(names.values())
+        gone = [id for name, id in known.items()
+            if name not in current and id not in changed]
+
+        for name in [name for name in known if name not in current]:
+            del known[name]
+        for id, parsed in changed.items():
+            known[names[id]] = id
+
+        # Files we saw but couldn't add yet, usually because `at` is still
+        # writing them.
+        self._spool_pending = len(names) - len(known)
+        return (changed, gone)
+
+    def _add_job(self, job):
+        """ Add job to self.jobs and the indexes. """
+        self.jobs.append(job)
+        self._by_id[int(job.id)] = job
+        self._by_queue.setdefault(job.queue, []).append(job)
+        self._by_owner.setdefault(job.who, []).append(job)
+
+        i = bisect.bisect_right(self._when_keys, job.when)
+        self._when_keys.insert(i, job.when)
+        self._by_when.insert(i, job)
+
+    def _remove_job(self, job):
+        """ Remove job from self.jobs and the indexes. """
+        self.jobs.remove(job)
+        del self._by_id[int(job.id)]
+        for index, key in ((self._by_queue, job.queue),
+                (self._by_owner, job.who)):
+            index[key].remove(job)
+            if not index[key]:
+                del index[key]
+
+        i = bisect.bisect_left(self._when_keys, job.when)
+        while self._by_when[i] is not job:
+            i += 1
+        del self._when_keys[i]
+        del self._by_when[i]
+
+    def _index(self):
+        """ Build the indexes behind find_job_by_id() and the query methods
+            from self.jobs. Compact AtQueues' JobColumns index themselves. """
+        if self.compact:
+            return
+
+        self._by_id = dict()
+        self._by_queue = dict()
+        self._by_owner = dict()
+
         for job in self.jobs:
-            if job.id == id:
+            self._by_id[int(job.id)] = job
+            self._by_queue.setdefault(job.queue, []).append(job)
+            self._by_owner.setdefault(job.who, []).append(job)
+
+        self._by_when = sorted(self.jobs, key = lambda job: job.when)
+        self._when_keys = [job.when for job in self._by_when]
+
+    def _atq_args(self):
+        """ The `atq` command line for this AtQueue. """
+        if self.queue:
+            return [config.atq_binary, '-q', self.queue]
+        else:
+            return [config.atq_binary]
+
+    def _read_atq(self):
+        """ Run `atq`, returning a list of dicts, one per parsed line. """
+        return list(self.iter_jobs())
+
+    def iter_jobs(self):
+        """ Run `atq` and yield a dict with the keys id, when, queue and who
+            for each job, as `atq` prints it, without waiting for the rest of
+            its output. Raises CalledProcessError if `atq` fails. self.raw is
+            set to all of the output once it's been read.
+
+            Only the popen spawn backend can stream; with the others, `atq`'s
+            output is parsed once it's all been read. """
+        atq_args = self._atq_args()
+        if config.spawn_backend != 'popen':
+            for parsed in self._parse_atq(spawn.check_output(atq_args)):
+                yield parsed
+            return
+
+        raw = list()
+
+        with metrics.call(atq_args) as call:
+            proc = Popen(atq_args, stdout = PIPE)
+
+            def lines():
+                for line in proc.stdout:
+                    raw.append(line)
+                    yield line
+
+            try:
+                for parsed in self._iter_parse(lines()):
+                    yield parsed
+            finally:
+                proc.stdout.close()
+                call.returncode = proc.wait()
+
+            self.raw = b''.join(raw)
+            call.output_bytes = len(self.raw)
+            if call.returncode != 0:
+                raise CalledProcessError(call.returncode, atq_args, self.raw)
+
+    def _iter_parse(self, lines):
+        """ Parse lines of `atq` output (as bytes), yielding a dict per job.
+            Whether it's BSD `atq` is decided once, from the first line. """
+        timed = metrics.enabled()
+        seconds = 0.0
+        jobs = 0
+        parse = None
+
+        for line in lines:
+            if timed: started = metrics.clock()
+            line = line.decode("utf-8")
+            if not line.strip():
+                continue
+
+            if parse is None:
+                # The format of BSD atq differs...
+                if line.strip() == BSD_ATQ_HEADER:
+                    self.bsd = True
+                parse = self._atq_bsd_line if self.bsd else self._atq_line
+                if self.bsd: continue
+
+            parsed = parse(line)
+            jobs += 1
+            if timed: seconds += metrics.clock() - started
+            yield parsed
+
+        if timed:
+            metrics.emit(metrics.PARSE, kind = 'atq', seconds = seconds,
+                jobs = jobs)
+
+    def _parse_atq(self, atq_out):
+        """ Parse the output of `atq` into a list of dicts, one per line. """
+        self.raw = atq_out
+        return list(self._iter_parse(atq_out.splitlines()))
+
+    def find_job_by_id(self, id):
+        """ Return the job with the given id. Raise ValueError if no job in
+            AtQueue. """
+        if self.compact:
+            return self.jobs.find_job_by_id(id)
+        try:
+            return self._by_id[int(id)]
+        except KeyError:
+            raise ValueError('Could not find a job with that ID.')
+
+    def due_between(self, start, end):
+        """ Return a list of jobs due at or after start, and before end, in the
+            order they're due. """
+        if self.compact:
+            return self.jobs.due_between(start, end)
+        first = bisect.bisect_left(self._when_keys, start)
+        last = bisect.bisect_left(self._when_keys, end)
+        return self._by_when[first:last]
+
+    def next_due(self, n = 1, now = None):
+        """ Return a list of the next n jobs due at or after now (by default,
+            datetime.datetime.now()), in the order they're due. """
+        now = now or datetime.datetime.now()
+        if self.compact:
+            return self.jobs.next_due(n, now)
+        first = bisect.bisect_left(self._when_keys, now)
+        return self._by_when[first:first + n]
+
+    def in_queue(self, queue):
+        """ Return a list of jobs in queue. """
+        if self.compact:
+            return self.jobs.in_queue(queue)
+        return list(self._by_queue.get(queue, ()))
+
+    def owned_by(self, who):
+        """ Return a list of jobs owned by the user named who. """
+        if self.compact:
+            return self.jobs.owned_by(who)
+        return list(self._by_owner.get(who, ()))
+
+    def tagged(self, tag):
+        """ Return a list of jobs that at() was given tag for, answered from
+            the registry (see atd.registry). Without one, nothing is tagged. """
+        reg = registry.get_registry()
+        if reg is None:
+            return []
+
+        jobs = list()
+        for id in reg.tagged(tag):
+            try:
+                jobs.append(self.find_job_by_id(id))
+            except ValueError:
+                pass # Not in this AtQueue's queue, or not any more.
+        return jobs
+
+    def load_commands(self, workers = 8):
+        """ Load command, environment and cwd for every job in this AtQueue
+            at once, instead of running `at -c` for each job as it's accessed.
+            Scripts are read straight from the spool if it's readable, and
+            otherwise fetched with up to workers `at -c`s at a time.
+
+            Jobs whose script couldn't be loaded, usually because they ran or
+            were canceled in the meantime, are returned as a list. Their
+            attributes are left to be lazy-loaded as usual. """
+        if config.scheduler_backend == 'engine':
+            failed = list()
+            for job in self.jobs:
+                loaded = engine.get_engine().get(job.id)
+                if loaded is None:
+                    failed.append(job)
+                else:
+                    job._set_script(loaded)
+            return failed
+
+        try:
+            paths = spool.job_script_paths()
+        except OSError:
+            paths = dict()
+
+        def load_one(job):
+            try:
+                if int(job.id) in paths:
+                    with open(paths[int(job.id)], 'rb') as f:
+                        script = f.read()
+                else:
+                    script = spawn.check_output([config.at_binary, '-c',
+                        str(job.id)])
+            except (OSError, IOError, CalledProcessError):
                 return job
 
-        raise ValueError('Could not find a job with that ID.')
+            job.from_script(script)
+            return None
+
+        executor = ThreadPoolExecutor(max_workers = workers)
+        try:
+            failed = executor.map(load_one, self.jobs)
+            return [job for job in failed if job is not None]
+        finally:
+            executor.shutdown(wait = True)
+
+    def diff(self, other):
+        """ Compare this AtQueue with other, an earlier AtQueue, in one pass
+            over each. Returns a QueueDiff of the ids of jobs added since
+            other, removed since and changed since, which means their when,
+            queue or owner is different. """
+        before = other._keyed()
+        after = self._keyed()
+        return QueueDiff(
+            added = set(id for id in after if id not in before),
+            removed = set(id for id in before if id not in after),
+            changed = set(id for id, key in after.items()
+                if id in before and before[id] != key))
+
+    def _keyed(self):
+        """ A dict of job id -> (when, queue, who). """
+        if self.compact:
+            jobs = self.jobs
+            return dict((jobs.ids[row], (jobs.whens[row], jobs.queues[row],
+                jobs.owners[jobs.owner_ids[row]])) for row in range(len(jobs)))
+        return dict((int(job.id), (int(spool._timestamp(job.when)),
+            ord(job.queue), job.who)) for job in self.jobs)
+
+class QueueDiff(object):
+    """ What AtQueue.diff() found: added, removed and changed are sets of job
+        ids. A QueueDiff is true if anything changed. """
+    __slots__ = ('added', 'removed', 'changed')
+
+    def __init__(self, added, removed, changed):
+        self.added = added
+        self.removed = removed
+        self.changed = changed
+
+    def __bool__(self):
+        return bool(self.added or self.removed or self.changed)
+    __nonzero__ = __bool__
+
+    def __repr__(self):
+        return '<QueueDiff +{0} -{1} ~{2}>'.format(len(self.added),
+            len(self.removed), len(self.changed))
+
+class SnapshotCache(object):
+    """ A process-wide snapshot of the whole `at` queue, shared by every lazy
+        AtJob lookup so that reading attributes of many jobs costs one `atq`
+        instead of one per job. Snapshots are reused for ttl seconds, or
+        config.snapshot_cache_ttl if ttl is None. A ttl of 0 disables caching.
+
+        atd.at(), atd.atrm() and atd.clear() invalidate the cache, since they
+        know the queue just changed. hits and misses count lookups answered
+        from a cached snapshot and those which had to run `atq`. """
+    def __init__(self, ttl = None):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self.invalidate()
+
+    def invalidate(self):
+        """ Throw away the current snapshot. The next lookup runs `atq`. """
+        self._snapshot = None
+        self._taken = 0
+
+    def _expired(self):
+        ttl = config.snapshot_cache_ttl if self.ttl is None else self.ttl
+        return (self._snapshot is None or
+            time.time() - self._taken >= ttl)
+
+    def get(self):
+        """ Return an AtQueue of all jobs, refreshing it if it's stale. """
+        with self._lock:
+            if self._expired():
+                self.misses += 1
+                metrics.emit(metrics.CACHE, cache = 'snapshot', hit = False)
+                self._snapshot = AtQueue()
+                self._taken = time.time()
+            else:
+                self.hits += 1
+                metrics.emit(metrics.CACHE, cache = 'snapshot', hit = True)
+
+            return self._snapshot
+
+    def find_job_by_id(self, id):
+        """ Like AtQueue.find_job_by_id, answered from the snapshot. Raise
+            ValueError if no such job in the snapshot. """
+        return self.get().find_job_by_id(id)
+
+snapshot_cache = SnapshotCache()
+
+# Attributes of AtJob that are lazy-loaded from `atq` and `at -c`, respectively.
+attrs_in_atq = ['when', 'who', 'queue']
+attrs_in_script = ['command', 'environment', 'cwd']
+# ...and those that are looked up in the registry first, if there is one.
+attrs_in_registry = ['when', 'who', 'queue', 'command']
 
 class AtJob(object):
     def __init__(self, jobid = 0, load = False):
@@ -145,38 +701,57 @@ class AtJob(object):
             raise ValueError('You tried to get info about a null ('+
             'non-existent) job. Set AtJob.id first.')
 
-        attrs_in_atq = ['when', 'who', 'queue']
+        if name in attrs_in_registry and registry.get_registry():
+            recorded = registry.get_registry().get(self.id)
+            if recorded is not None and recorded[name] is not None:
+                metrics.emit(metrics.LAZY_LOAD, attribute = name,
+                    source = 'registry')
+                setattr(self, name, recorded[name])
+                return recorded[name]
 
         if name in attrs_in_atq:
-            atq = AtQueue()
-            job = atq.find_job_by_id(self.id)
+            metrics.emit(metrics.LAZY_LOAD, attribute = name, source = 'atq')
+            job = snapshot_cache.find_job_by_id(self.id)
             for k in attrs_in_atq:
                 setattr(self, k, getattr(job, k))
 
-            return job.name
+            return getattr(self, name)
 
         # NOTE: Getting the command again after calling `at` is not
         # straightforward. This is because `at` doesn't just save the command,
         # it actually creates an entire shell script based on the command you
-        # gave it to run. I decided to just take the last non-empty line of the
-        # file, but if your command contained any newlines it won't work.
-        # Consider (1) using semicolons and not \n or (2) not needing to get
-        # the command after saving an AtJob.
-        elif name == "command":
-            atcat = check_output([config.at_binary, '-c', 
-                str(self.id)])
+        # gave it to run, which restores the environment and working directory
+        # it was submitted from. spool.parse_job_script() takes it apart again.
+        # If you need the command of many jobs, AtQueue.load_commands() gets
+        # them all at once.
+        elif name in attrs_in_script and config.scheduler_backend == 'engine':
+            metrics.emit(metrics.LAZY_LOAD, attribute = name, source = 'engine')
+            loaded = engine.get_engine().get(self.id)
+            if loaded is None:
+                raise ValueError('No job {0} in the engine.'.format(self.id))
+            self._set_script(loaded)
+
+            return getattr(self, name)
+
+        elif name in attrs_in_script:
+            metrics.emit(metrics.LAZY_LOAD, attribute = name, source = 'at -c')
+            self.from_script(spawn.check_output([config.at_binary, '-c',
+                str(self.id)]))
+
+            return getattr(self, name)
 
-            atcatlines = atcat.splitlines()
+        return None
 
-            for line in atcatlines:
-                if line and line not in list('[]{}()'): 
-                    lastline = line
+    def from_script(self, script):
+        """ Set command, environment and cwd from the job's script, as printed
+            by `at -c`. """
+        self._set_script(spool.parse_job_script(script))
 
-            self.command = lastline
-            return lastline
+    def _set_script(self, parsed):
+        """ Set command, environment and cwd from the dict parsed. """
+        for k in attrs_in_script:
+            setattr(self, k, parsed[k])
 
-        return None
-    
     def load(self):
         """ For performance reasons, information about atjobs is lazy-loaded on
         request (see __get__()). However, you can force load all of it with
@@ -191,7 +766,8 @@ class AtJob(object):
         """ Called by atd.at(), it creates an AtJob from `at`'s stderr. """
         self.raw_stderr = stderr
         stderr = stderr.decode("utf-8")
-        match = re.match('.*job (?P<atjob_id>\d+).*', stderr, re.M|re.S)
+        # GNU at says "job 1 at ...", BSD at says "Job 1 will be executed..."
+        match = re.match(r'.*job (?P<atjob_id>\d+).*', stderr, re.M|re.S|re.I)
 
         if not match:
             raise NotImplementedError('python-atd doesn\'t seem to'+
@@ -201,3 +777,165 @@ class AtJob(object):
         atjob_id = self.id = int(match.group('atjob_id'))
         return atjob_id
 
+
+class AtJobView(AtJob):
+    """ A read-only AtJob for one row of a JobColumns. id, when, queue and who
+        are read straight from the columns; command, environment and cwd are
+        lazy-loaded like any AtJob's, but kept in the columns so they outlive
+        the view. """
+    __slots__ = ('_columns', '_row')
+
+    def __init__(self, columns, row):
+        self._columns = columns
+        self._row = row
+
+    @property
+    def id(self):
+        return self._columns.ids[self._row]
+
+    @property
+    def when(self):
+        return datetime.datetime.fromtimestamp(self._columns.whens[self._row])
+
+    @property
+    def queue(self):
+        return chr(self._columns.queues[self._row])
+
+    @property
+    def who(self):
+        columns = self._columns
+        return columns.owners[columns.owner_ids[self._row]]
+
+    def __getattr__(self, name):
+        loaded = self._columns.scripts.get(self._row)
+        if loaded is not None and name in loaded:
+            return loaded[name]
+        return AtJob.__getattr__(self, name)
+
+    def __repr__(self):
+        attrs = dict(id = self.id, when = self.when, queue = self.queue,
+            who = self.who)
+        attrs.update(self._columns.scripts.get(self._row, ()))
+        attrs.update(self.__dict__)
+        return json.dumps(attrs, default=self._json_default)
+
+    def _set_script(self, parsed):
+        self._columns.scripts[self._row] = dict((k, parsed[k])
+            for k in attrs_in_script)
+
+class JobColumns(object):
+    """ The jobs of a compact AtQueue. Rather than one AtJob per job, ids, due
+        times (as POSIX timestamps), queue letters and owners are kept in
+        parallel arrays, with owner names interned. It behaves like the list
+        of AtJobs it replaces, but an AtJobView is only made for a job when
+        it's looked at. It also carries the indexes AtQueue's queries use.
+
+        Views point at rows, so unlike a list, JobColumns is read-only: its
+        mutating methods raise TypeError. Copy it with list() to change it. """
+    def __init__(self, parsed_jobs):
+        self.ids = array.array('l')
+        self.whens = array.array('q')
+        self.queues = bytearray()
+        self.owner_ids = array.array('l')
+        self.owners = list()
+        self.scripts = dict()
+        owner_ids = dict()
+
+        for parsed in parsed_jobs:
+            who = parsed['who']
+            if who not in owner_ids:
+                owner_ids[who] = len(self.owners)
+                self.owners.append(who)
+
+            self.ids.append(int(parsed['id']))
+            self.whens.append(int(spool._timestamp(parsed['when'])))
+            self.queues.append(ord(parsed['queue']))
+            self.owner_ids.append(owner_ids[who])
+
+        self._index()
+
+    def _index(self):
+        rows = range(len(self.ids))
+        self._id_order = array.array('l', sorted(rows,
+            key = self.ids.__getitem__))
+        self._sorted_ids = array.array('l',
+            [self.ids[row] for row in self._id_order])
+        self._when_order = array.array('l', sorted(rows,
+            key = self.whens.__getitem__))
+        self._sorted_whens = array.array('q',
+            [self.whens[row] for row in self._when_order])
+
+        self._by_queue = dict()
+        self._by_owner = dict()
+        for row in rows:
+            self._by_queue.setdefault(self.queues[row],
+                array.array('l')).append(row)
+            self._by_owner.setdefault(self.owner_ids[row],
+                array.array('l')).append(row)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [AtJobView(self, row)
+                for row in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('job index out of range')
+        return AtJobView(self, i)
+
+    def __iter__(self):
+        for row in range(len(self)):
+            yield AtJobView(self, row)
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError('A compact AtQueue\'s jobs are read-only. Use '+
+            'list(queue.jobs) for a copy you can change.')
+
+    __setitem__ = __delitem__ = __iadd__ = _read_only
+    append = extend = insert = remove = pop = clear = sort = reverse = \
+        _read_only
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def row_of(self, id):
+        """ The row holding job id, or None. """
+        i = bisect.bisect_left(self._sorted_ids, id)
+        if i < len(self._sorted_ids) and self._sorted_ids[i] == id:
+            return self._id_order[i]
+        return None
+
+    def _rows(self, rows):
+        return [AtJobView(self, row) for row in rows]
+
+    def find_job_by_id(self, id):
+        row = self.row_of(int(id))
+        if row is None:
+            raise ValueError('Could not find a job with that ID.')
+        return AtJobView(self, row)
+
+    def due_between(self, start, end):
+        first = bisect.bisect_left(self._sorted_whens, spool._timestamp(start))
+        last = bisect.bisect_left(self._sorted_whens, spool._timestamp(end))
+        return self._rows(self._when_order[first:last])
+
+    def next_due(self, n, now):
+        first = bisect.bisect_left(self._sorted_whens, spool._timestamp(now))
+        return self._rows(self._when_order[first:first + n])
+
+    def in_queue(self, queue):
+        return self._rows(self._by_queue.get(ord(queue), ()))
+
+    def owned_by(self, who):
+        if who not in self.owners:
+            return []
+        return self._rows(self._by_owner.get(self.owners.index(who), ()))
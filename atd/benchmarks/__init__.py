@@ -0,0 +1,615 @@
+################################################################################
+# atd.py - The Unix at scheduler in Python ################ py2/3k version 0.2 #
+################################################################################
+# Benchmarks for python-atd...                                                 #
+################################################################################
+# Every benchmark runs against the stand-ins for `at` and `atq` in  fake.py,   #
+# in either their GNU or BSD flavor (see stand_ins()), with a spool in a       #
+# temporary  directory that's filled with some number of jobs  first.          #
+# Nothing touches the system's real queue, and results are reproducible.       #
+#                                                                              #
+# Because the stand-ins are Python scripts, they start up slower than the      #
+# real `at`. Compare results with each other, not with the real thing.         #
+#                                                                              #
+# Run the suite with:                                 python -m atd.benchmarks #
+################################################################################
+##  Written by Fredrick Brennan <copypaste@kittens.ph>. See LICENSE (Expat).  ##
+################################################################################
+
+from __future__ import absolute_import
+from __future__ import print_function
+import contextlib
+import datetime
+import math
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from atd import admission
+from atd import atd, atq, coalesce, completion, config, engine, leveling
+from atd import metrics
+from atd import reconcile, registry, spawn, spool, timespec
+from atd.benchmarks import fake
+
+BENCH_QUEUE = 'Z'
+
+SIZES = (1000, 10000, 100000)
+
+# A job the spool is pre-filled with. It's what the stand-in `at` would write.
+FILL_SCRIPT = '''#!/bin/sh
+# atrun uid=0 gid=0
+# mail nobody 0
+umask 22
+PATH=/bin:/usr/bin; export PATH
+cd / || {
+\t echo 'Execution directory inaccessible' >&2
+\t exit 1
+}
+${SHELL:-/bin/sh} << 'marcinDELIMITER00000000'
+true
+marcinDELIMITER00000000
+'''
+
+def _timed(func, *args, **kwargs):
+    """ Run func, returning a tuple of (seconds elapsed, return value). """
+    start = time.time()
+    ret = func(*args, **kwargs)
+    return (time.time() - start, ret)
+
+def _result(benchmark, variant, n, ops, seconds):
+    """ One machine-readable benchmark result. """
+    return dict(benchmark = benchmark, variant = variant, flavor = None,
+        jobs = n, ops = ops, seconds = seconds,
+        ops_per_second = (ops / seconds) if seconds else None)
+
+def _fill_spool(directory, n, queue = 'a'):
+    """ Write n jobs straight into the spool, one minute apart, starting a day
+        from now. """
+    start = datetime.datetime.now().replace(second = 0, microsecond = 0) + \
+        datetime.timedelta(days = 1)
+    for i in range(1, n + 1):
+        path = os.path.join(directory, spool.spool_name(queue, i,
+            start + datetime.timedelta(minutes = i)))
+        with open(path, 'w') as f:
+            f.write(FILL_SCRIPT)
+        os.chmod(path, 0o700)
+
+    with open(os.path.join(directory, '.SEQ'), 'w') as f:
+        f.write('{0:05x}\n'.format(n))
+
+_STAND_IN_SETTINGS = ('at_binary', 'atq_binary', 'atjobs_dir')
+
+@contextlib.contextmanager
+def stand_ins(flavor = 'gnu', n = 0):
+    """ Point atd.config at the stand-ins for `at` and `atq` for the duration
+        of a with block, with n jobs already in their spool. """
+    directory = tempfile.mkdtemp()
+    real = dict((k, getattr(config, k)) for k in _STAND_IN_SETTINGS)
+    try:
+        paths = fake.install(directory, flavor)
+        _fill_spool(paths['atjobs_dir'], n)
+        for k in _STAND_IN_SETTINGS:
+            setattr(config, k, paths[k])
+        atq.snapshot_cache.invalidate()
+        yield paths
+    finally:
+        for k, v in real.items():
+            setattr(config, k, v)
+        atq.snapshot_cache.invalidate()
+        shutil.rmtree(directory)
+
+def bench_submission(n, ops, workers = 8):
+    """ Submit ops jobs with at() one after another, and with at_many(), by
+        running `at` and by writing the spool. """
+    def serial():
+        return [atd.at("true", "now + 24 hours", BENCH_QUEUE)
+            for i in range(ops)]
+
+    def many():
+        jobs = list(atd.at_many((("true", "now + 24 hours", BENCH_QUEUE)
+            for i in range(ops)), workers = workers))
+        failures = [job for job in jobs if isinstance(job, Exception)]
+        if failures:
+            raise failures[0]
+        return jobs
+
+    results = []
+    real = (config.at_backend, config.atd_pid_file)
+    try:
+        # Don't wake the real atd.
+        config.atd_pid_file = os.path.join(config.atjobs_dir, 'atd.pid')
+        for backend in ('at', 'spool'):
+            config.at_backend = backend
+            for variant, func in (('at', serial),
+                    ('at_many(workers={0})'.format(workers), many)):
+                elapsed, jobs = _timed(func)
+                atd.atrm(*jobs)
+                if backend == 'spool':
+                    variant = 'spool ' + variant
+                results.append(_result('submission', variant, n, ops,
+                    elapsed))
+    finally:
+        config.at_backend, config.atd_pid_file = real
+    return results
+
+def bench_refresh(n, ops, repeat = 3):
+    """ Time AtQueue.refresh() with the 'atq' and 'spool' backends. The best of
+        repeat runs is reported. """
+    results = []
+    for backend in ('atq', 'spool'):
+        q = atd.AtQueue(backend = backend)
+        assert q.source == backend and len(q.jobs) == n
+        elapsed = min(_timed(q.refresh)[0] for i in range(repeat))
+        results.append(_result('refresh', backend, n, 1, elapsed))
+    return results
+
+def bench_lazy(n, ops):
+    """ Time lazily loading AtJob.when, both with a fresh snapshot every time
+        (as python-atd used to) and with the shared snapshot cache, and
+        AtJob.command, both one `at -c` at a time and with
+        AtQueue.load_commands(). """
+    ids = [(i * 7919) % n + 1 for i in range(ops)]
+    results = []
+
+    real_ttl = config.snapshot_cache_ttl
+    try:
+        for variant, ttl in (('when uncached', 0), ('when cached', 60)):
+            config.snapshot_cache_ttl = ttl
+            atq.snapshot_cache.invalidate()
+            elapsed = _timed(lambda: [atd.AtJob(id).when for id in ids])[0]
+            results.append(_result('lazy', variant, n, ops, elapsed))
+    finally:
+        config.snapshot_cache_ttl = real_ttl
+
+    elapsed = _timed(lambda: [atd.AtJob(id).command for id in ids])[0]
+    results.append(_result('lazy', 'command', n, ops, elapsed))
+
+    q = atd.AtQueue()
+    elapsed = _timed(q.load_commands)[0]
+    results.append(_result('lazy', 'load_commands', n, n, elapsed))
+    return results
+
+def bench_cancel(n, ops):
+    """ Cancel ops jobs with one atrm() each, with a single atrm(), and with
+        atrm_where(). """
+    results = []
+    for variant in ('atrm each', 'atrm all', 'atrm_where'):
+        jobs = list(atd.at_many(("true", "now + 24 hours", BENCH_QUEUE)
+            for i in range(ops)))
+        if variant == 'atrm each':
+            elapsed = _timed(lambda: [atd.atrm(job) for job in jobs])[0]
+        elif variant == 'atrm all':
+            elapsed = _timed(atd.atrm, *jobs)[0]
+        else:
+            elapsed, report = _timed(atd.atrm_where, queue = BENCH_QUEUE)
+            assert report and len(report) == ops
+        results.append(_result('cancel', variant, n, ops, elapsed))
+    return results
+
+def bench_queries(n, ops):
+    """ Time looking up ops jobs by id, and ops time ranges, both with
+        AtQueue's indexes and with a linear scan of AtQueue.jobs. """
+    q = atd.AtQueue(backend = 'spool')
+
+    ids = [(i * 7919) % n + 1 for i in range(ops)]
+    ranges = [(q.find_job_by_id(id).when, q.find_job_by_id(id).when +
+        datetime.timedelta(minutes = 10)) for id in ids]
+
+    def indexed():
+        for id in ids:
+            q.find_job_by_id(id)
+        for start, end in ranges:
+            q.due_between(start, end)
+
+    def linear():
+        for id in ids:
+            [job for job in q.jobs if job.id == id]
+        for start, end in ranges:
+            [job for job in q.jobs if start <= job.when < end]
+
+    return [_result('queries', 'indexed', n, ops * 2, _timed(indexed)[0]),
+        _result('queries', 'linear', n, ops * 2, _timed(linear)[0])]
+
+def bench_registry(n, ops):
+    """ Time looking up the commands of ops jobs made with at(), with `at -c`
+        and from the registry. """
+    directory = tempfile.mkdtemp()
+    real_path = config.registry_path
+    try:
+        config.registry_path = os.path.join(directory, 'registry.db')
+        jobs = list(atd.at_many(("true", "now + 24 hours", BENCH_QUEUE,
+            ['bench']) for i in range(ops)))
+        ids = [job.id for job in jobs]
+
+        results = []
+        for variant, path in (('at -c', None), ('registry',
+                config.registry_path)):
+            config.registry_path = path
+            elapsed = _timed(lambda: [atd.AtJob(id).command for id in ids])[0]
+            results.append(_result('registry', variant, n, ops, elapsed))
+
+        atd.atrm(*jobs)
+        return results
+    finally:
+        if registry.get_registry():
+            registry.get_registry().close()
+        config.registry_path = real_path
+        shutil.rmtree(directory)
+
+def bench_metrics(n, ops, repeat = 3):
+    """ Time refreshing an AtQueue and reading ops lazy attributes, with and
+        without a metrics Collector observing. """
+    ids = [(i * 7919) % n + 1 for i in range(ops)]
+
+    def work():
+        atq.snapshot_cache.invalidate()
+        atd.AtQueue().refresh()
+        for id in ids:
+            atd.AtJob(id).when
+
+    results = []
+    collector = metrics.Collector()
+    for variant in ('no observers', 'collector'):
+        if variant == 'collector':
+            metrics.add_observer(collector)
+        try:
+            elapsed = min(_timed(work)[0] for i in range(repeat))
+        finally:
+            if variant == 'collector':
+                metrics.remove_observer(collector)
+        results.append(_result('metrics', variant, n, ops, elapsed))
+    return results
+
+def bench_spawn(n, ops, heap_mb = 1024):
+    """ Time ops `at -c`s with each spawn backend, with heap_mb more memory in
+        use by this process, like a big web worker has. The stand-ins take a
+        while to start, so ops `true`s are timed too, which shows the cost of
+        spawning by itself. """
+    ballast = bytearray(heap_mb * 1024 * 1024)
+    ballast[::4096] = b'\x01' * len(range(0, len(ballast), 4096)) # Touch it
+    ids = [(i * 7919) % n + 1 for i in range(ops)]
+
+    results = []
+    real_backend = config.spawn_backend
+    try:
+        for backend in spawn.BACKENDS:
+            config.spawn_backend = backend
+            spawn.run(['true']) # Start the helpers outside the timing.
+            elapsed = _timed(lambda: [spawn.check_output([config.at_binary,
+                '-c', str(id)]) for id in ids])[0]
+            results.append(_result('spawn', backend, n, ops, elapsed))
+            elapsed = _timed(lambda: [spawn.run(['true']) for id in ids])[0]
+            results.append(_result('spawn', backend + ' true', n, ops,
+                elapsed))
+    finally:
+        config.spawn_backend = real_backend
+        spawn.get_pool().close()
+        del ballast
+    return results
+
+def bench_coalesce(n, ops):
+    """ Submit ops commands due in the same minute one at a time with at(),
+        and coalesced into one job. """
+    directory = tempfile.mkdtemp()
+    try:
+        elapsed, jobs = _timed(lambda: [atd.at("true", "now + 24 hours",
+            BENCH_QUEUE) for i in range(ops)])
+        atd.atrm(*jobs)
+        results = [_result('coalesce', 'at', n, ops, elapsed)]
+
+        def coalesced():
+            with coalesce.Coalescer(directory = directory) as coalescer:
+                jobs = [coalescer.at("true", "now + 24 hours", BENCH_QUEUE)
+                    for i in range(ops)]
+            return jobs
+
+        elapsed, jobs = _timed(coalesced)
+        atd.atrm(*jobs)
+        results.append(_result('coalesce', 'coalesced', n, ops, elapsed))
+        return results
+    finally:
+        shutil.rmtree(directory)
+
+def bench_leveling(n, ops):
+    """ Level n jobs all due in the same minute, ten to a minute, so each
+        one has to skip past the minutes filled before it. Counting the n jobs
+        already in the queue is included. """
+    when = datetime.datetime.now() + datetime.timedelta(days = 1)
+
+    def level():
+        leveler = leveling.Leveler(10, tolerance = n * 60)
+        for i in range(n):
+            leveler.place(when, BENCH_QUEUE)
+        return leveler
+
+    elapsed, leveler = _timed(level)
+    return [_result('leveling', 'place', n, n, elapsed)]
+
+def bench_reconcile(n, ops):
+    """ Diff two snapshots of the queue of n jobs, and plan reconciling it
+        with a list of the same n jobs, ops of them due a minute later. """
+    before = atq.AtQueue()
+    after = atq.AtQueue()
+    results = [_result('reconcile', 'diff', n, n,
+        _timed(lambda: after.diff(before))[0])]
+
+    expected = [dict(id = job.id, command = 'true', when = job.when,
+        queue = job.queue) for job in after.jobs]
+    for job in expected[:ops]:
+        job['when'] += datetime.timedelta(minutes = 1)
+    elapsed, planned = _timed(lambda: reconcile.plan(expected))
+    results.append(_result('reconcile', 'plan', n, n, elapsed))
+    return results
+
+def bench_completion(n, ops):
+    """ Read a completion log of n jobs, then check whether ops jobs have
+        run, over and over, with a Tracker and by refreshing an AtQueue, the
+        way you'd find out without one. That's slow, so it's only done a
+        tenth as many times. """
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'completions')
+        with open(path, 'w') as f:
+            for i in range(1, n + 1):
+                f.write('{{"token": "{0}", "id": {0}}}\n{{"token": "{0}", '
+                    '"started": 0, "ended": 1, "status": 0, "output_bytes": '
+                    '0}}\n'.format(i))
+
+        tracker = completion.Tracker(path)
+        results = [_result('completion', 'read', n, n,
+            _timed(tracker.poll)[0])]
+
+        jobs = [atq.AtJob(i) for i in range(1, ops + 1)]
+        results.append(_result('completion', 'wait', n, ops, _timed(
+            lambda: [tracker.wait(jobs, timeout = 0) for i in range(ops)])[0]))
+
+        checks = max(ops // 10, 1)
+        def refresh():
+            for i in range(checks):
+                ids = set(job.id for job in atq.AtQueue().jobs)
+                [job for job in jobs if job.id in ids]
+        results.append(_result('completion', 'refresh', n, checks,
+            _timed(refresh)[0]))
+        return results
+    finally:
+        shutil.rmtree(directory)
+
+class SimulatedLoad(object):
+    """ A load average for bench_batch(), to use as an AdmissionController's
+        load. Every `at` it observes (add observe() with
+        metrics.add_observer()) starts a job that pushes it up by per_job, and
+        it decays back to base, halving every half_life seconds. peak is the
+        highest it's been. """
+    def __init__(self, base = 0.2, per_job = 0.5, half_life = 0.2):
+        self.base = base
+        self.per_job = per_job
+        self.half_life = half_life
+        self.value = self.peak = base
+        self._lock = threading.Lock()
+        self._updated = time.time()
+
+    def _decay(self):
+        now = time.time()
+        self.value = self.base + (self.value - self.base) * \
+            math.pow(0.5, (now - self._updated) / self.half_life)
+        self._updated = now
+
+    def __call__(self):
+        with self._lock:
+            self._decay()
+            return self.value
+
+    def observe(self, event):
+        if event['event'] != metrics.SUBPROCESS or event['kind'] != 'at':
+            return
+        with self._lock:
+            self._decay()
+            self.value += self.per_job
+            self.peak = max(self.peak, self.value)
+
+def bench_batch(n, ops, max_load = 1.0):
+    """ Submit ops batch jobs (at most 25, since admitting them takes a
+        while) with batch_many(), all at once and with an AdmissionController
+        holding the simulated load below max_load. The rate shows what
+        admission costs, and each result's peak_load what it buys. One `at`
+        runs at a time, so the load each job adds is seen soon after it's
+        admitted. The n jobs are in another queue, so don't count towards its
+        depth. """
+    ops = min(ops, 25)
+
+    def submit(controller):
+        return list(atd.batch_many((("true", BENCH_QUEUE)
+            for i in range(ops)), controller, workers = 1))
+
+    results = []
+    for variant in ('unthrottled', 'admitted'):
+        load = SimulatedLoad()
+        controller = None
+        if variant == 'admitted':
+            controller = admission.AdmissionController(max_load,
+                queue = BENCH_QUEUE, load = load, interval = 0.005)
+        metrics.add_observer(load.observe)
+        try:
+            elapsed, jobs = _timed(submit, controller)
+        finally:
+            metrics.remove_observer(load.observe)
+
+        result = _result('batch', variant, n, ops, elapsed)
+        result['peak_load'] = load.peak
+        results.append(result)
+        atd._atrm_ids([job.id for job in jobs
+            if not isinstance(job, Exception)])
+    return results
+
+def bench_engine(n, ops, workers = 8):
+    """ Submit ops jobs with at() and with at_many(), then cancel them, with
+        the stand-in `at` and with the engine. The engine starts out empty, in
+        a temporary directory, whatever n is. at_many() shows how much the
+        engine's fsync() batching helps concurrent submitters. """
+    def serial():
+        return [atd.at("true", "now + 24 hours", BENCH_QUEUE)
+            for i in range(ops)]
+
+    def many():
+        return list(atd.at_many((("true", "now + 24 hours", BENCH_QUEUE)
+            for i in range(ops)), workers = workers))
+
+    directory = tempfile.mkdtemp()
+    real = (config.scheduler_backend, config.engine_dir)
+    results = []
+    try:
+        config.engine_dir = directory
+        for backend in ('at', 'engine'):
+            config.scheduler_backend = backend
+            for variant, func in (('at', serial), ('at_many', many)):
+                elapsed, jobs = _timed(func)
+                results.append(_result('engine', '{0} {1}'.format(backend,
+                    variant), n, ops, elapsed))
+                elapsed = _timed(atd.atrm, *jobs)[0]
+                results.append(_result('engine', '{0} atrm ({1})'.format(
+                    backend, variant), n, ops, elapsed))
+    finally:
+        if config.scheduler_backend == 'engine':
+            engine.get_engine().close()
+        config.scheduler_backend, config.engine_dir = real
+        shutil.rmtree(directory)
+    return results
+
+TIMESPECS = ('now + 24 hours', 'teatime tomorrow', 'noon dec 25, 2038',
+    '10:30 pm + 2 days', '2038-01-01', 'midnight next week')
+
+def bench_timespec(n, ops, repeat = 3):
+    """ Time resolving ops timespecs, parsing each one afresh and with parses
+        memoized. The best of repeat runs is reported. """
+    specs = [TIMESPECS[i % len(TIMESPECS)] for i in range(ops)]
+
+    def cold():
+        for spec in specs:
+            timespec._memo.clear()
+            timespec.resolve(spec)
+
+    def memoized():
+        for spec in specs:
+            timespec.resolve(spec)
+
+    return [_result('timespec', variant, n, ops,
+        min(_timed(func)[0] for i in range(repeat)))
+        for variant, func in (('parse', cold), ('memoized', memoized))]
+
+def _parse_atq_strptime(atq_out):
+    """ How AtQueue parsed `atq` output before iter_jobs(): everything at
+        once, with strptime on every line. """
+    jobs = []
+    bsd = False
+    for line in atq_out.decode("utf-8").splitlines():
+        if line.strip() == atq.BSD_ATQ_HEADER:
+            bsd = True
+            continue
+        split = line.split()
+        if bsd:
+            jobs.append(dict(when = datetime.datetime.strptime(
+                ' '.join(split[0:6]), atq.AT_OUTPUT_DATETIME_FORMAT_BSD),
+                who = split[6], queue = split[7], id = int(split[8])))
+        else:
+            jobs.append(dict(id = int(split[0]),
+                when = datetime.datetime.strptime(' '.join(split[1:6]),
+                atq.AT_OUTPUT_DATETIME_FORMAT), queue = split[6],
+                who = split[7]))
+    return jobs
+
+def bench_parse(n, ops, repeat = 3):
+    """ Time parsing `atq` output for the whole queue with strptime on every
+        line, as python-atd used to, and with AtQueue's parser. Neither runs
+        `atq`; the best of repeat runs is reported. """
+    atq_out = subprocess.check_output([config.atq_binary])
+    q = atd.AtQueue(backend = 'spool')
+
+    def fast():
+        atq._atq_when_memo.clear()
+        return q._parse_atq(atq_out)
+
+    assert fast() == _parse_atq_strptime(atq_out)
+    return [_result('parse', variant, n, n,
+        min(_timed(func)[0] for i in range(repeat)))
+        for variant, func in (('strptime', lambda:
+            _parse_atq_strptime(atq_out)), ('iter_jobs', fast))]
+
+def bench_memory(n, ops):
+    """ Measure how much memory a refreshed AtQueue holds, with one AtJob per
+        job and with compact columns, and how long refreshing takes. Memory is
+        reported in bytes in the result's memory key. """
+    results = []
+    for variant, compact in (('objects', False), ('compact', True)):
+        tracemalloc.start()
+        try:
+            elapsed, q = _timed(atd.AtQueue, backend = 'spool',
+                compact = compact)
+            memory = tracemalloc.get_traced_memory()[0]
+        finally:
+            tracemalloc.stop()
+        assert len(q.jobs) == n
+        result = _result('memory', variant, n, 1, elapsed)
+        result['memory'] = memory
+        results.append(result)
+    return results
+
+BENCHMARKS = dict(submission = bench_submission, refresh = bench_refresh,
+    lazy = bench_lazy, cancel = bench_cancel, queries = bench_queries,
+    memory = bench_memory, parse = bench_parse, registry = bench_registry,
+    metrics = bench_metrics, spawn = bench_spawn, engine = bench_engine,
+    timespec = bench_timespec, coalesce = bench_coalesce,
+    leveling = bench_leveling, reconcile = bench_reconcile,
+    completion = bench_completion, batch = bench_batch)
+
+def run_suite(sizes = SIZES, ops = 100, flavors = fake.FLAVORS,
+        benchmarks = None):
+    """ Run benchmarks (by default, all of BENCHMARKS) against a queue of each
+        size in sizes, with each flavor of stand-in. Yields result dicts as
+        they're ready.
+
+        ops is how many operations each benchmark performs; refresh always
+        works on the whole queue. """
+    for flavor in flavors:
+        for n in sizes:
+            with stand_ins(flavor, n):
+                for name in (benchmarks or sorted(BENCHMARKS)):
+                    for result in BENCHMARKS[name](n, min(ops, n)):
+                        result['flavor'] = flavor
+                        yield result
+
+def format_result(result):
+    """ A human-readable line for one result dict. """
+    rate = result['ops_per_second']
+    line = '{0:<10} {1:<20} {2:<3} {3:>7} jobs: {4:9.4f}s for {5} ops ' \
+        '({6}/s)'.format(result['benchmark'], result['variant'],
+        result['flavor'], result['jobs'], result['seconds'], result['ops'],
+        '{0:.1f}'.format(rate) if rate else '-')
+    if 'memory' in result:
+        line += ', {0:.1f} KiB'.format(result['memory'] / 1024.0)
+    if 'peak_load' in result:
+        line += ', peak load {0:.2f}'.format(result['peak_load'])
+    return line
+
+def compare(results, baseline, threshold = 0.25):
+    """ Return a list of (result, baseline result) pairs for results that are
+        more than threshold (as a fraction) slower than the matching result in
+        baseline. Results are matched on benchmark, variant, flavor and
+        jobs. """
+    def key(result):
+        return (result['benchmark'], result['variant'], result['flavor'],
+            result['jobs'])
+
+    by_key = dict((key(result), result) for result in baseline)
+    regressions = []
+    for result in results:
+        old = by_key.get(key(result))
+        if not old or not old['ops_per_second'] or \
+                not result['ops_per_second']:
+            continue
+        if result['ops_per_second'] < old['ops_per_second'] * (1 - threshold):
+            regressions.append((result, old))
+    return regressions
@@ -0,0 +1,69 @@
+################################################################################
+# atd.py - The Unix at scheduler in Python ################ py2/3k version 0.2 #
+################################################################################
+# python -m atd.benchmarks [--sizes 1000,10000] [--output results.json] ...    #
+################################################################################
+##  Written by Fredrick Brennan <copypaste@kittens.ph>. See LICENSE (Expat).  ##
+################################################################################
+
+from __future__ import absolute_import
+from __future__ import print_function
+import argparse
+import json
+import platform
+import sys
+import time
+
+from atd import benchmarks
+from atd.benchmarks import fake
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(prog = 'python -m atd.benchmarks',
+        description = 'Benchmark python-atd against stand-ins for at and atq.')
+    parser.add_argument('--sizes', default = ','.join(str(n) for n in
+        benchmarks.SIZES), help = 'comma-separated queue sizes '
+        '(default: %(default)s)')
+    parser.add_argument('--ops', type = int, default = 100,
+        help = 'operations per benchmark (default: %(default)s)')
+    parser.add_argument('--flavor', action = 'append', choices = fake.FLAVORS,
+        help = 'at flavor to emulate (default: all)')
+    parser.add_argument('--benchmark', action = 'append',
+        choices = sorted(benchmarks.BENCHMARKS),
+        help = 'benchmark to run (default: all)')
+    parser.add_argument('--output', help = 'write results to this JSON file')
+    parser.add_argument('--compare', help = 'compare results with this JSON '
+        'file, from --output, and exit 1 if any regressed')
+    parser.add_argument('--threshold', type = float, default = 0.25,
+        help = 'slowdown, as a fraction, that counts as a regression '
+        '(default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    results = []
+    for result in benchmarks.run_suite(
+            sizes = [int(n) for n in args.sizes.split(',')], ops = args.ops,
+            flavors = args.flavor or fake.FLAVORS,
+            benchmarks = args.benchmark):
+        print(benchmarks.format_result(result))
+        sys.stdout.flush()
+        results.append(result)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(dict(python = platform.python_version(),
+                platform = platform.platform(), time = time.time(),
+                results = results), f, indent = 1)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        regressions = benchmarks.compare(results, baseline, args.threshold)
+        for result, old in regressions:
+            print('REGRESSION: {0} (was {1:.1f}/s)'.format(
+                benchmarks.format_result(result), old['ops_per_second']))
+        if regressions:
+            return 1
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,220 @@
+################################################################################
+# atd.py - The Unix at scheduler in Python ################ py2/3k version 0.2 #
+################################################################################
+# Stand-ins for `at` and `atq`, for benchmarks and tests.                      #
+################################################################################
+# They keep a real spool in a directory of your choosing, in the same format   #
+# as GNU at, and print what either GNU or BSD `at` would. Use install() to     #
+# create them, and point config.at_binary, config.atq_binary and               #
+# config.atjobs_dir at what it returns.                                        #
+#                                                                              #
+# This file is run as a script by the stand-ins, so it must not import         #
+# anything from atd. It's also why spool_name() is repeated here.              #
+################################################################################
+##  Written by Fredrick Brennan <copypaste@kittens.ph>. See LICENSE (Expat).  ##
+################################################################################
+
+from __future__ import absolute_import
+from __future__ import print_function
+import binascii
+import datetime
+import fcntl
+import os
+import pwd
+import re
+import sys
+import time
+
+FLAVORS = ('gnu', 'bsd')
+
+STAND_IN = '''#!{python} -S
+import sys
+sys.path.insert(0, {here!r})
+import fake
+sys.exit(fake.main({prog!r}, {flavor!r}, {spool!r}, sys.argv[1:]))
+'''
+
+def install(directory, flavor = 'gnu'):
+    """ Create the stand-ins in directory, with their spool in
+        directory/atjobs. Returns a dict with the keys at_binary, atq_binary and
+        atjobs_dir, which are the config settings that select them. """
+    if flavor not in FLAVORS:
+        raise ValueError('Invalid flavor. Use one of {0}.'.format(FLAVORS))
+
+    spool = os.path.join(directory, 'atjobs')
+    if not os.path.isdir(spool):
+        os.mkdir(spool)
+
+    paths = dict(atjobs_dir = spool)
+    for prog in ('at', 'atq'):
+        path = os.path.join(directory, prog)
+        with open(path, 'w') as f:
+            f.write(STAND_IN.format(python = sys.executable,
+                here = os.path.dirname(os.path.abspath(__file__)),
+                prog = prog, flavor = flavor, spool = spool))
+        os.chmod(path, 0o755)
+        paths[prog + '_binary'] = path
+
+    return paths
+
+def spool_name(queue, id, minutes):
+    return '{0}{1:05x}{2:08x}'.format(queue, id, minutes)
+
+SPOOL_NAME = re.compile(r'^([A-Za-z=])([0-9a-f]{5})([0-9a-f]{8})$')
+
+def _jobs(spool, queue = None):
+    """ Yield (id, queue, minutes, path) for every job in spool. """
+    for name in os.listdir(spool):
+        match = SPOOL_NAME.match(name)
+        if not match or (queue and match.group(1) != queue):
+            continue
+        yield (int(match.group(2), 16), match.group(1),
+            int(match.group(3), 16), os.path.join(spool, name))
+
+def _find(spool, id):
+    for job in _jobs(spool):
+        if job[0] == id:
+            return job[3]
+    return None
+
+def _next_id(spool):
+    """ Allocate a job number from spool/.SEQ, like GNU at does. """
+    with open(os.path.join(spool, '.SEQ'), 'a+') as seq:
+        fcntl.flock(seq, fcntl.LOCK_EX)
+        seq.seek(0)
+        last = seq.read().strip()
+        id = (int(last, 16) if last else 0) + 1
+        seq.seek(0)
+        seq.truncate()
+        seq.write('{0:05x}\n'.format(id))
+        return id
+
+_UNITS = dict(minute = 1, hour = 60, day = 24 * 60, week = 7 * 24 * 60)
+
+def _parse_when(args):
+    """ Return (minutes since the epoch, remaining args), or raise ValueError.
+        Only -t and `now + N units` are understood. """
+    now = int(time.time()) // 60
+    if args[0] == '-t':
+        stamp = args[1].split('.')[0]
+        fmt = {8: '%m%d%H%M', 10: '%y%m%d%H%M', 12: '%Y%m%d%H%M'}[len(stamp)]
+        dt = datetime.datetime.strptime(stamp, fmt)
+        return (int(time.mktime(dt.timetuple())) // 60, args[2:])
+
+    words = []
+    while args and not args[0].startswith('-'):
+        words.append(args.pop(0))
+    if words == ['now']:
+        return (now, args)
+    if len(words) == 4 and words[:2] == ['now', '+']:
+        unit = words[3].rstrip('s')
+        return (now + int(words[2]) * _UNITS[unit], args)
+    raise ValueError(' '.join(words))
+
+def _submit(flavor, spool, args):
+    queue = 'a' if flavor == 'gnu' else 'c'
+    if args and args[0] == '-b': # batch, due now
+        queue = 'b' if flavor == 'gnu' else 'E'
+        args = ['now'] + list(args[1:])
+    try:
+        minutes, args = _parse_when(list(args))
+    except (ValueError, KeyError, IndexError):
+        sys.stderr.write('syntax error. Last token seen: {0}\n'
+            'Garbled time\n'.format(' '.join(args)))
+        return 1
+    while args:
+        arg = args.pop(0)
+        if arg == '-q':
+            queue = args.pop(0)
+
+    command = sys.stdin.read()
+    if not command.endswith('\n'):
+        command += '\n'
+    delimiter = 'marcinDELIMITER' + binascii.hexlify(os.urandom(4)).decode()
+
+    script = ['#!/bin/sh',
+        '# atrun uid={0} gid={1}'.format(os.getuid(), os.getgid()),
+        '# mail {0} 0'.format(pwd.getpwuid(os.getuid()).pw_name),
+        'umask 22']
+    for k, v in sorted(os.environ.items()):
+        script.append('{0}={1}; export {0}'.format(k,
+            re.sub(r'([^-_/:=.,+@%A-Za-z0-9])', r'\\\1', v)))
+    script.extend(["cd {0} || {{".format(os.getcwd()),
+        "\t echo 'Execution directory inaccessible' >&2",
+        '\t exit 1', '}',
+        "${{SHELL:-/bin/sh}} << '{0}'".format(delimiter)])
+
+    id = _next_id(spool)
+    path = os.path.join(spool, spool_name(queue, id, minutes))
+    with open(path, 'w') as f:
+        f.write('\n'.join(script) + '\n' + command + delimiter + '\n')
+    os.chmod(path, 0o700)
+
+    when = time.localtime(minutes * 60)
+    if flavor == 'gnu':
+        sys.stderr.write('warning: commands will be executed using /bin/sh\n'
+            'job {0} at {1}\n'.format(id,
+            time.strftime('%a %b %e %H:%M:%S %Y', when)))
+    else:
+        sys.stderr.write('Job {0} will be executed using /bin/sh\n'.format(id))
+    return 0
+
+def _list(flavor, spool, args):
+    queue = args[1] if args[:1] == ['-q'] else None
+    jobs = sorted(_jobs(spool, queue))
+    owners = dict()
+    out = []
+
+    if flavor == 'bsd' and jobs:
+        out.append('Date\t\t\t\tOwner\t\tQueue\tJob#')
+
+    for id, job_queue, minutes, path in jobs:
+        uid = os.stat(path).st_uid
+        if uid not in owners:
+            owners[uid] = pwd.getpwuid(uid).pw_name
+        when = time.localtime(minutes * 60)
+        if flavor == 'gnu':
+            out.append('{0}\t{1} {2} {3}'.format(id,
+                time.strftime('%a %b %e %H:%M:%S %Y', when), job_queue,
+                owners[uid]))
+        else:
+            out.append('{0}\t{1:<16}{2}\t{3}'.format(
+                time.strftime('%a %b %e %H:%M:%S %Z %Y', when), owners[uid],
+                job_queue, id))
+
+    if out:
+        sys.stdout.write('\n'.join(out) + '\n')
+    return 0
+
+def _cat(spool, ids):
+    for id in ids:
+        path = _find(spool, int(id))
+        if not path:
+            sys.stderr.write('Cannot find jobid {0}\n'.format(id))
+            return 1
+        with open(path) as f:
+            sys.stdout.write(f.read())
+    return 0
+
+def _remove(spool, ids):
+    status = 0
+    wanted = set(int(id) for id in ids)
+    for id, queue, minutes, path in _jobs(spool):
+        if id in wanted:
+            os.remove(path)
+            wanted.discard(id)
+    for id in sorted(wanted):
+        sys.stderr.write('Cannot find jobid {0}\n'.format(id))
+        status = 1
+    return status
+
+def main(prog, flavor, spool, args):
+    if prog == 'atq':
+        return _list(flavor, spool, args)
+    elif args[:1] == ['-c']:
+        return _cat(spool, args[1:])
+    elif args[:1] == ['-r']:
+        return _remove(spool, args[1:])
+    elif args[:1] == ['-l']:
+        return _list(flavor, spool, args[1:])
+    return _submit(flavor, spool, args)
@@ -0,0 +1,292 @@
+################################################################################
+# atd.py - The Unix at scheduler in Python ################ py2/3k version 0.2 #
+################################################################################
+# Coalescing: one `at` job for many commands due in the same minute.           #
+################################################################################
+# `at` only knows minutes, so programs that schedule lots of commands often    #
+# schedule hundreds for the same minute, each with its own `at`, spool file    #
+# and shell. A Coalescer holds on to what it's given for                       #
+# config.coalesce_window seconds, then submits one job for each queue and      #
+# minute, which runs every command in its own shell, with stdin from           #
+# /dev/null, one after another.                                                #
+#                                                                              #
+# Each command gets a CoalescedJob back. Its exit status is written to a file  #
+# in config.coalesce_dir when it runs, where status() finds it. atd.atrm() of  #
+# a CoalescedJob cancels only that command, by leaving a file there that the   #
+# job checks first; once every command in a job is canceled, the job itself is #
+# removed with atrm().                                                         #
+#                                                                              #
+# A job's files are removed once status() has read the status of each of its   #
+# commands that wasn't canceled, or once the whole job is canceled. Files left #
+# behind by processes that exited first are removed by prune().                #
+################################################################################
+##  Written by Fredrick Brennan <copypaste@kittens.ph>. See LICENSE (Expat).  ##
+################################################################################
+
+from __future__ import absolute_import
+import datetime
+import os
+import shlex
+import threading
+import time
+import uuid
+
+# Submodules #
+from atd import atd
+from atd import config
+
+class CoalescedJob(object):
+    """ One command given to a Coalescer. atjob is the AtJob it was coalesced
+        into, once it's been submitted, and error the exception submitting it
+        raised, if any. """
+    def __init__(self, group, index, command, when, tags):
+        self.group = group
+        self.index = index
+        self.command = command
+        self.when = when
+        self.tags = tags
+        self.atjob = None
+        self.error = None
+        self.submitted = threading.Event()
+        self._status = None
+
+    @property
+    def queue(self):
+        return self.group.queue
+
+    @property
+    def canceled(self):
+        return self.index in self.group.canceled
+
+    @property
+    def id(self):
+        """ '<id of the AtJob>.<index in it>', or None before it's
+            submitted. """
+        if self.atjob is None:
+            return None
+        return '{0}.{1}'.format(self.atjob.id, self.index)
+
+    def __repr__(self):
+        return '<CoalescedJob {0} `{1}` at {2}>'.format(self.id, self.command,
+            self.when)
+
+    def result(self, timeout = None):
+        """ Wait for this command's job to be submitted, and return its AtJob,
+            or raise what submitting it raised. """
+        if not self.submitted.wait(timeout):
+            raise RuntimeError('Not submitted yet.')
+        if self.canceled and self.atjob is None:
+            raise ValueError('Canceled before it was submitted.')
+        if self.error is not None:
+            raise self.error
+        return self.atjob
+
+    def status(self):
+        """ The command's exit status if it has run, or else None. """
+        if self._status is None:
+            try:
+                with open(self.group.path(self.index, 'status')) as f:
+                    self._status = int(f.read().strip())
+            except (IOError, OSError, ValueError):
+                return None
+            self.group.collected(self)
+        return self._status
+
+class _Group(object):
+    """ The commands that share one `at` job. """
+    def __init__(self, coalescer, queue, minute):
+        self.coalescer = coalescer
+        self.queue = queue
+        self.minute = minute
+        self.token = uuid.uuid4().hex
+        self.directory = coalescer.directory
+        self.jobs = list()
+        self.canceled = set()
+        self._collected = set()
+        self.atjob = None
+
+    def path(self, index, kind):
+        return os.path.join(self.directory, '{0}.{1}.{2}'.format(self.token,
+            index, kind))
+
+    def pending(self):
+        """ The jobs that haven't been canceled. """
+        return [job for job in self.jobs if job.index not in self.canceled]
+
+    def collected(self, job):
+        """ Note that job's status has been read. Once every pending job's
+            has, the job has run, so its files aren't needed any more. """
+        self._collected.add(job.index)
+        if all(job.index in self._collected for job in self.pending()):
+            self.remove_files()
+
+    def remove_files(self):
+        for job in self.jobs:
+            for kind in ('status', 'canceled'):
+                try:
+                    os.unlink(self.path(job.index, kind))
+                except OSError:
+                    pass
+
+    def script(self):
+        """ The command for the coalesced job. Each command is run with
+            `$SHELL -c`, in a shell of its own, so one can't break or exit the
+            others. """
+        lines = ['# {0} commands coalesced by python-atd'.format(
+            len(self.pending()))]
+        for job in self.pending():
+            lines.append('[ -e {0} ] || {{ ${{SHELL:-/bin/sh}} -c {1} '
+                '</dev/null; echo $? > {2}; }}'.format(
+                shlex.quote(self.path(job.index, 'canceled')),
+                shlex.quote(job.command),
+                shlex.quote(self.path(job.index, 'status'))))
+        return '\n'.join(lines)
+
+    def tags(self):
+        return sorted(set(tag for job in self.pending()
+            for tag in job.tags or ()))
+
+    def when(self):
+        """ When to submit the job for: the latest of its commands, or
+            'now' if that's passed. A timespec like 'now' is resolved to the
+            start of its minute, which has always passed by the time it's
+            submitted, and at() doesn't take times in the past. """
+        when = max(job.when for job in self.pending())
+        return 'now' if when <= datetime.datetime.now() else when
+
+class Coalescer(object):
+    """ Coalesces the commands given to at() for window seconds (by default,
+        config.coalesce_window) after the first one, then submits them with
+        atd.at_many(), one job per queue and minute. Use it as a context
+        manager, or call flush() or close(), to submit what's left. """
+    def __init__(self, window = None, directory = None):
+        self.window = config.coalesce_window if window is None else window
+        self.directory = os.path.abspath(os.path.expanduser(directory or
+            config.coalesce_dir))
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory, 0o700)
+        self._lock = threading.Lock()
+        self._groups = dict() # (queue, minute) -> _Group
+        self._timer = None
+
+    def at(self, command, when, queue = 'a', tags = None):
+        """ Like atd.at(), but returns a CoalescedJob at once. when and queue
+            are checked right away, so invalid ones raise here. """
+        when, queue = atd._build_at_args(when, queue)[1:]
+        minute = when.replace(second = 0, microsecond = 0)
+
+        with self._lock:
+            group = self._groups.get((queue, minute))
+            if group is None:
+                group = self._groups[(queue, minute)] = _Group(self, queue,
+                    minute)
+            job = CoalescedJob(group, len(group.jobs), command, when, tags)
+            group.jobs.append(job)
+
+            if self._timer is None:
+                self._timer = threading.Timer(self.window, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        return job
+
+    def flush(self):
+        """ Submit everything waiting now. Returns a list of the AtJobs made,
+            or the exceptions raised, one per queue and minute. """
+        with self._lock:
+            groups = list(self._groups.values())
+            self._groups = dict()
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+        for group in groups:
+            if not group.pending(): # All canceled already
+                for job in group.jobs:
+                    job.submitted.set()
+        groups = [group for group in groups if group.pending()]
+
+        results = list(atd.at_many((group.script(), group.when(),
+            group.queue, group.tags()) for group in groups))
+
+        for group, result in zip(groups, results):
+            for job in group.jobs:
+                if isinstance(result, Exception):
+                    job.error = result
+                elif not job.canceled:
+                    group.atjob = job.atjob = result
+                job.submitted.set()
+        return results
+
+    def cancel(self, job):
+        """ Cancel the command job, without touching the rest of its AtJob.
+            If it hasn't been submitted yet, it never will be. """
+        group = job.group
+        with self._lock:
+            if self._groups.get((group.queue, group.minute)) is group:
+                group.canceled.add(job.index) # Still waiting; leave it out.
+                return True
+
+        with open(group.path(job.index, 'canceled'), 'w'):
+            pass
+        group.canceled.add(job.index)
+        if len(group.canceled) == len(group.jobs) and group.atjob is not None:
+            atd.atrm(group.atjob)
+            group.remove_files()
+        return True
+
+    def close(self):
+        """ Submit everything waiting, and stop. """
+        return self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+def cancel(*jobs):
+    """ Cancel the CoalescedJobs jobs. atd.atrm() calls this for them. """
+    for job in jobs:
+        job.group.coalescer.cancel(job)
+    return True
+
+def prune(older_than, directory = None):
+    """ Remove the files in directory (by default, config.coalesce_dir) that
+        are more than older_than seconds old, and return how many there were.
+        A canceled command's file must outlive its job, or the command runs
+        after all, so older_than must be more than how far ahead jobs are
+        coalesced for. """
+    directory = os.path.expanduser(directory or config.coalesce_dir)
+    oldest = time.time() - older_than
+    removed = 0
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return 0 # Nothing's been coalesced yet.
+
+    for name in names:
+        if not name.endswith(('.status', '.canceled')): continue
+        path = os.path.join(directory, name)
+        try:
+            if os.stat(path).st_mtime < oldest:
+                os.unlink(path)
+                removed += 1
+        except OSError:
+            pass # Removed by someone else meanwhile
+    return removed
+
+_coalescer = None
+_coalescer_lock = threading.Lock()
+
+def get_coalescer():
+    """ The Coalescer shared by at(), made with the config settings. """
+    global _coalescer
+    with _coalescer_lock:
+        if _coalescer is None:
+            _coalescer = Coalescer()
+        return _coalescer
+
+def at(command, when, queue = 'a', tags = None):
+    """ Coalesce command with the shared Coalescer. See Coalescer.at(). """
+    return get_coalescer().at(command, when, queue, tags)
@@ -0,0 +1,226 @@
+################################################################################
+# atd.py - The Unix at scheduler in Python ################ py2/3k version 0.2 #
+################################################################################
+# Completion tracking: find out when jobs ran, and how, without `atq`.         #
+################################################################################
+# The queue only tells you a job has gone, not when it ran or whether it       #
+# worked. With config.completion_log set to a file name, at() and at_many()    #
+# wrap each command so that, when atd runs it, a line like                     #
+#                                                                              #
+#   {"token": "...", "started": 1700000000, "ended": 1700000002,               #
+#    "status": 0, "output_bytes": 12}                                          #
+#                                                                              #
+# is appended to the log. The command runs in a shell of its own, with stdin   #
+# from /dev/null; its output is passed on, so atd still mails it. Every job    #
+# gets a token, and a {"token": "...", "id": 7} line is appended when it's     #
+# submitted, to tie the two together.                                          #
+#                                                                              #
+# A Tracker reads the log as it grows, from where it left off, so one of them  #
+# can answer any number of waiters at the cost of a stat() every               #
+# config.completion_poll_interval seconds. Lines are JSON, and short enough to #
+# be appended atomically, so jobs running at once can share one log.           #
+################################################################################
+##  Written by Fredrick Brennan <copypaste@kittens.ph>. See LICENSE (Expat).  ##
+################################################################################
+
+from __future__ import absolute_import
+import datetime
+import json
+import os
+import shlex
+import threading
+import time
+import uuid
+
+# Submodules #
+from atd import config
+
+WRAPPER = '''__atd_started=$(date +%s)
+__atd_output=$(mktemp 2>/dev/null) || __atd_output=/dev/null
+${{SHELL:-/bin/sh}} -c {command} </dev/null >"$__atd_output" 2>&1
+__atd_status=$?
+__atd_ended=$(date +%s)
+__atd_bytes=$(wc -c <"$__atd_output" | tr -d ' ')
+cat "$__atd_output"
+[ "$__atd_output" = /dev/null ] || rm -f "$__atd_output"
+__atd_format='{{"token": "%s", "started": %s, "ended": %s, "status": %s, '
+__atd_format="$__atd_format"'"output_bytes": %s}}\\n'
+printf "$__atd_format" {token} "$__atd_started" "$__atd_ended" \\
+    "$__atd_status" "${{__atd_bytes:-0}}" >> {log}
+exit $__atd_status'''
+
+def log_path(path = None):
+    """ The absolute path of the completion log: path, or
+        config.completion_log. """
+    return os.path.abspath(os.path.expanduser(path or config.completion_log))
+
+def new_token():
+    return uuid.uuid4().hex
+
+def wrap(command, token, path = None):
+    """ command, wrapped to append its completion, under token, to the log
+        at path (by default, config.completion_log) when it's run. """
+    return WRAPPER.format(command = shlex.quote(command), token = token,
+        log = shlex.quote(log_path(path)))
+
+def record_submissions(submissions, path = None):
+    """ Append an (token, job id) pair for each of submissions to the log,
+        with one write. """
+    lines = ''.join(json.dumps(dict(token = token, id = int(id))) + '\n'
+        for token, id in submissions)
+    if not lines:
+        return
+    fd = os.open(log_path(path), os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+        0o600)
+    try:
+        os.write(fd, lines.encode('utf-8'))
+    finally:
+        os.close(fd)
+
+class Completion(object):
+    """ One job that ran. started and ended are datetimes, to the second,
+        status is its exit status and output_bytes how much it printed. id is
+        None if the line saying what it was submitted as hasn't been read. """
+    __slots__ = ('token', 'id', 'started', 'ended', 'status', 'output_bytes')
+
+    def __init__(self, token, id, started, ended, status, output_bytes):
+        self.token = token
+        self.id = id
+        self.started = started
+        self.ended = ended
+        self.status = status
+        self.output_bytes = output_bytes
+
+    @property
+    def succeeded(self):
+        return self.status == 0
+
+    def __repr__(self):
+        return '<Completion of job {0}: exit status {1} at {2}>'.format(
+            self.id, self.status, self.ended)
+
+class Tracker(object):
+    """ Reads the completion log at path (by default, config.completion_log)
+        as it grows. It's thread safe, and shared by any number of waiters. """
+    def __init__(self, path = None):
+        self.path = log_path(path)
+        self.completions = list() # In the order they were logged
+        self._lock = threading.Lock()
+        self._offset = 0
+        self._size = -1
+        self._ids = dict()        # token -> id, until it completes
+        self._by_token = dict()
+        self._by_id = dict()
+
+    def poll(self):
+        """ Read whatever's been added to the log since last time. Returns how
+            many completions that found. """
+        with self._lock:
+            try:
+                size = os.stat(self.path).st_size
+            except OSError:
+                return 0 # Nothing's been logged yet.
+            if size == self._size:
+                return 0
+            if size < self._offset:
+                self._offset = 0 # Truncated, so start again.
+            self._size = size
+
+            with open(self.path, 'rb') as f:
+                f.seek(self._offset)
+                data = f.read(size - self._offset)
+            end = data.rfind(b'\n') + 1 # Leave a partly written line be.
+            self._offset += end
+
+            found = 0
+            for line in data[:end].decode('utf-8', 'replace').splitlines():
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if 'status' in record:
+                    self._add(record)
+                    found += 1
+                else:
+                    self._submitted(record['token'], record['id'])
+            return found
+
+    def _add(self, record):
+        completion = Completion(record['token'],
+            self._ids.pop(record['token'], None),
+            datetime.datetime.fromtimestamp(record['started']),
+            datetime.datetime.fromtimestamp(record['ended']),
+            record['status'], record['output_bytes'])
+        self.completions.append(completion)
+        self._by_token[completion.token] = completion
+        if completion.id is not None:
+            self._by_id[completion.id] = completion
+
+    def _submitted(self, token, id):
+        completion = self._by_token.get(token)
+        if completion is None:
+            self._ids[token] = id
+        else: # It ran before we were told what it was.
+            completion.id = id
+            self._by_id[id] = completion
+
+    def get(self, job):
+        """ The Completion of the AtJob job, or None if it hasn't run (or
+            isn't tracked). """
+        token = getattr(job, 'token', None)
+        if token is not None:
+            return self._by_token.get(token)
+        return self._by_id.get(int(job.id))
+
+    def completed_since(self, cursor = 0):
+        """ Return a list of the Completions logged since cursor, and the
+            cursor to pass next time. Start with 0. """
+        self.poll()
+        with self._lock:
+            return (self.completions[cursor:], len(self.completions))
+
+    def wait(self, jobs, timeout = None):
+        """ Wait until every one of the AtJobs jobs has run, or for timeout
+            seconds. Returns a tuple of (list of the Completions of the jobs
+            that ran, list of the jobs that haven't yet). """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            self.poll()
+            done = list()
+            pending = list()
+            for job in jobs:
+                completion = self.get(job)
+                if completion is None:
+                    pending.append(job)
+                else:
+                    done.append(completion)
+
+            if not pending or (deadline is not None and
+                    time.time() >= deadline):
+                return (done, pending)
+
+            interval = config.completion_poll_interval
+            if deadline is not None:
+                interval = min(interval, max(deadline - time.time(), 0))
+            time.sleep(interval)
+
+_tracker = None
+_tracker_lock = threading.Lock()
+
+def get_tracker():
+    """ The Tracker of config.completion_log, shared by the whole process. """
+    global _tracker
+    path = log_path()
+    with _tracker_lock:
+        if _tracker is None or _tracker.path != path:
+            _tracker = Tracker(path)
+        return _tracker
+
+def wait(jobs, timeout = None):
+    """ Wait for jobs with the shared Tracker. See Tracker.wait(). """
+    return get_tracker().wait(jobs, timeout)
+
+def completed_since(cursor = 0):
+    """ Completions since cursor, from the shared Tracker. See
+        Tracker.completed_since(). """
+    return get_tracker().completed_since(cursor)
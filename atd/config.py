@@ -13,15 +13,32 @@ sys.platform.startswith('cygwin'):
 	at_deny_file = '/etc/at.deny'
 	at_default_queue = 'a'
 	batch_default_queue = 'b'
+	# Debian and friends. Red Hat and friends use /var/spool/at.
+	atjobs_dir = '/var/spool/cron/atjobs'
 else: # freebsd and darwin (OS X)
 	at_allow_file = '/var/at/at.allow'
 	at_deny_file = '/var/at/at.deny'
 	at_default_queue = 'c'
 	batch_default_queue = 'E'
+	atjobs_dir = '/var/at/jobs'
 
 at_binary = '/usr/bin/at'
 atq_binary = '/usr/bin/atq'
 
+# How AtQueue learns what's in the queue. 'atq' runs `atq`, which works for
+# everyone. 'spool' reads atjobs_dir directly, which is much faster but usually
+# needs root (or membership in atd's group); if the spool can't be read AtQueue
+# falls back to running `atq`.
+atq_backend = 'atq'
+
+# How at() submits jobs. 'at' runs `at`. 'spool' writes them straight into
+# atjobs_dir, the way GNU at does, which is much faster for many jobs but needs
+# write access to the spool (root, or atd's user) and skips at.allow and
+# at.deny. Jobs are owned by whoever this process runs as. atd is woken once
+# per batch with a SIGHUP to the pid in atd_pid_file. See atd.spool.
+at_backend = 'at'
+atd_pid_file = '/var/run/atd.pid'
+
 always_send_mail = False
 never_send_mail = False
 
@@ -38,3 +55,83 @@ inherit_env = False
 #     "Explicit is better than implicit." ~ The Zen of Python
 #
 atjob_environment = dict(PATH = "/bin:/usr/bin")
+
+# AtJob attributes that come from `atq` (when, who and queue) are looked up in a
+# snapshot of the queue that's shared by the whole process. Snapshots are reused
+# for this many seconds, unless at(), atrm() or clear() changes the queue first.
+# Set it to 0 to run `atq` for every lookup.
+#
+snapshot_cache_ttl = 5
+
+# The most `at`, `atq` and `atrm` processes atd.aio will run at once, per event
+# loop. Coroutines past this limit wait their turn.
+#
+aio_max_processes = 8
+
+# Where inotify isn't available, atd.watch looks at the spool directory's mtime
+# this often, in seconds.
+#
+watch_poll_interval = 1.0
+
+# Keep AtQueue's jobs in compact columns (see atq.JobColumns) rather than one
+# AtJob object per job. Worth it for queues of tens of thousands of jobs.
+#
+compact_queues = False
+
+# Record every job made with at() in a local SQLite file (see atd.registry), so
+# its command, due time and owner can be looked up without running `atq` or
+# `at -c`. None turns the registry off. The registry is checked against the
+# live queue every registry_reconcile_interval seconds.
+#
+registry_path = None
+registry_reconcile_interval = 300
+
+# How `at`, `atq` and `at -r` are started: 'popen', 'posix_spawn' or 'helper'.
+# The last two are worth it when this process is big, since forking it gets
+# slower the more memory it has. See atd.spawn. spawn_helpers is how many helper
+# processes the 'helper' backend may run at once.
+#
+spawn_backend = 'popen'
+spawn_helpers = 2
+
+# atd.coalesce waits this many seconds after a command is given to it before
+# submitting, so commands due in the same minute can share one job. Their exit
+# statuses, and which were canceled, are kept in coalesce_dir.
+#
+coalesce_window = 0.5
+coalesce_dir = '~/.python-atd/coalesce'
+
+# If completion_log is a file name, at() and at_many() wrap each command so that
+# when it runs, its start and end times, exit status and output size are logged
+# there, for atd.completion's wait() and completed_since() to find without
+# running `atq`. They look at the log every completion_poll_interval seconds.
+#
+completion_log = None
+completion_poll_interval = 0.2
+
+# The most seconds atd.leveling may move a job later than it was asked for, to
+# keep the number of jobs starting in a minute within budget.
+#
+leveling_tolerance = 3600
+
+# atd.admission holds batch jobs back while the load average is at least
+# admission_max_load (None is the number of CPUs), or at least
+# admission_max_depth jobs (None is no limit) wait in the batch queue, checking
+# again every admission_interval seconds. The queue is read with AtQueue at most
+# every admission_depth_ttl seconds; in between, the jobs admitted are counted.
+#
+admission_max_load = None
+admission_max_depth = None
+admission_interval = 1.0
+admission_depth_ttl = 5
+
+# Which scheduler at(), atrm(), clear() and AtQueue use: 'at', the system's `at`
+# and atd, or 'engine', a scheduler running inside this process (see
+# atd.engine) that keeps its jobs in engine_dir and runs up to engine_workers
+# at once. The engine waits up to engine_fsync_interval seconds to write more
+# changes with each fsync().
+#
+scheduler_backend = 'at'
+engine_dir = '~/.python-atd/engine'
+engine_workers = 4
+engine_fsync_interval = 0.0
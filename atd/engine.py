@@ -0,0 +1,373 @@
+################################################################################
+# atd.py - The Unix at scheduler in Python ################ py2/3k version 0.2 #
+################################################################################
+# A scheduler in pure Python, for where there's no atd, or it's too slow.      #
+################################################################################
+# Set config.scheduler_backend = 'engine', and at(), atrm(), clear() and       #
+# AtQueue use an Engine running in this process instead of `at` and `atq`.     #
+# Jobs are due to the second, not the minute, and run as soon as they're due,  #
+# on a pool of at most config.engine_workers threads. Like with `at`, each     #
+# job's command is given to /bin/sh, in the environment and directory it was   #
+# submitted from. Its output is thrown away.                                   #
+#                                                                              #
+# Every change is appended to a journal in config.engine_dir and fsync()ed     #
+# before it's acknowledged; changes made at about the same time share one      #
+# fsync(). When the engine starts, it replays the journal, and jobs that fell  #
+# due while it wasn't running run at once, like atd runs them late. A job is   #
+# marked as started in the journal before it runs, so a crash never runs a     #
+# job twice. Only one process may run the engine in a directory at a time.     #
+################################################################################
+##  Written by Fredrick Brennan <copypaste@kittens.ph>. See LICENSE (Expat).  ##
+################################################################################
+
+from __future__ import absolute_import
+import datetime
+import errno
+import fcntl
+import heapq
+import json
+import os
+import pwd
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from subprocess import Popen, PIPE, DEVNULL
+
+# Submodules #
+from atd import config
+from atd import spool
+from atd import timespec
+
+JOURNAL = 'journal'
+
+# The journal is rewritten with only the live jobs once it has this many
+# records, and at least four times as many as there are jobs.
+COMPACT_AFTER = 1000
+
+def resolve_when(when):
+    """ The datetime when refers to. when may be a datetime, a timedelta from
+        now, or a timespec (see atd.timespec). """
+    if isinstance(when, datetime.datetime):
+        return when
+    elif isinstance(when, datetime.timedelta):
+        return datetime.datetime.now() + when
+    return timespec.resolve(when)
+
+class Engine(object):
+    """ A scheduler that keeps its jobs in directory (by default,
+        config.engine_dir), and runs them on up to workers threads (by default,
+        config.engine_workers). It starts running as soon as it's made. """
+    def __init__(self, directory = None, workers = None,
+            fsync_interval = None):
+        self.directory = os.path.expanduser(directory or config.engine_dir)
+        self.workers = workers or config.engine_workers
+        self.fsync_interval = (config.engine_fsync_interval
+            if fsync_interval is None else fsync_interval)
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory, 0o700)
+
+        self._lockfile = open(os.path.join(self.directory, 'lock'), 'a')
+        try:
+            fcntl.flock(self._lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            self._lockfile.close()
+            raise OSError(errno.EBUSY, 'Another process is running the '
+                'engine in {0}.'.format(self.directory))
+
+        self._cond = threading.Condition() # Guards _jobs, _heap and _next_id.
+        self._jobs = dict()
+        self._heap = list()
+        self._next_id = 1
+        self._closed = False
+
+        # What's in the journal, as replaying it would give.
+        self._durable = dict()
+        self._durable_next_id = 1
+        self._journal_cond = threading.Condition()
+        self._pending = list()
+        self._queued = 0
+        self._written = 0
+        self._journal_records = 0
+        self._writer_error = None
+
+        self._recover()
+        self._journal = open(self._path(JOURNAL), 'ab')
+        self._executor = ThreadPoolExecutor(max_workers = self.workers)
+        self._threads = [threading.Thread(target = target, name = name)
+            for target, name in ((self._writer, 'atd-engine-journal'),
+            (self._scheduler, 'atd-engine-scheduler'))]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _recover(self):
+        """ Rebuild our jobs from the journal. A record cut short by a crash,
+            and anything after it, is dropped. """
+        try:
+            journal = open(self._path(JOURNAL), 'rb')
+        except IOError as e:
+            if e.errno == errno.ENOENT: return
+            raise
+
+        good = 0
+        with journal:
+            for line in journal:
+                try:
+                    if not line.endswith(b'\n'): raise ValueError(line)
+                    record = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    break
+                good += len(line)
+                self._apply(record)
+                self._journal_records += 1
+
+        if good < os.path.getsize(self._path(JOURNAL)):
+            with open(self._path(JOURNAL), 'ab') as journal:
+                journal.truncate(good)
+
+        self._next_id = self._durable_next_id
+        for id, record in self._durable.items():
+            self._jobs[id] = self._job(record)
+            self._heap.append((record['when'], id))
+        heapq.heapify(self._heap)
+
+    def _apply(self, record):
+        """ Apply a journal record to self._durable. """
+        op = record['op']
+        if op == 'add':
+            self._durable[record['id']] = record
+            self._durable_next_id = max(self._durable_next_id,
+                record['id'] + 1)
+        elif op == 'seq':
+            self._durable_next_id = max(self._durable_next_id,
+                record['next_id'])
+        else: # remove, start and done
+            self._durable.pop(record['id'], None)
+
+    @staticmethod
+    def _job(record):
+        job = dict(record)
+        del job['op']
+        job['running'] = False
+        return job
+
+    def _log(self, *records, **kwargs):
+        """ Append records to the journal. Unless wait=False, returns once
+            they're on disk. """
+        with self._journal_cond:
+            if self._writer_error is not None:
+                raise self._writer_error
+            self._pending.extend(records)
+            self._queued += len(records)
+            seq = self._queued
+            self._journal_cond.notify_all()
+
+            if kwargs.get('wait', True):
+                while self._written < seq and self._writer_error is None:
+                    self._journal_cond.wait()
+                if self._writer_error is not None:
+                    raise self._writer_error
+
+    def _writer(self):
+        """ Write and fsync() what _log() queued, a batch at a time. """
+        while True:
+            with self._journal_cond:
+                while not self._pending and not self._closed:
+                    self._journal_cond.wait()
+                if not self._pending:
+                    return
+
+            if self.fsync_interval:
+                time.sleep(self.fsync_interval) # Let more records pile up.
+
+            with self._journal_cond:
+                batch, self._pending = self._pending, list()
+
+            try:
+                self._journal.write(b''.join(json.dumps(record).encode(
+                    'utf-8') + b'\n' for record in batch))
+                self._journal.flush()
+                os.fsync(self._journal.fileno())
+                for record in batch:
+                    self._apply(record)
+                self._journal_records += len(batch)
+                self._compact_if_due()
+            except (IOError, OSError) as e:
+                with self._journal_cond:
+                    self._writer_error = e
+                    self._journal_cond.notify_all()
+                return
+
+            with self._journal_cond:
+                self._written += len(batch)
+                self._journal_cond.notify_all()
+
+    def _compact_if_due(self):
+        if self._journal_records < max(COMPACT_AFTER,
+                len(self._durable) * 4):
+            return
+
+        records = [dict(op = 'seq', next_id = self._durable_next_id)]
+        records.extend(self._durable[id] for id in sorted(self._durable))
+        with open(self._path(JOURNAL + '.new'), 'wb') as journal:
+            journal.write(b''.join(json.dumps(record).encode('utf-8') + b'\n'
+                for record in records))
+            journal.flush()
+            os.fsync(journal.fileno())
+        os.rename(self._path(JOURNAL + '.new'), self._path(JOURNAL))
+        directory = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+        self._journal.close()
+        self._journal = open(self._path(JOURNAL), 'ab')
+        self._journal_records = len(records)
+
+    def _scheduler(self):
+        """ Hand jobs to the executor as they fall due. """
+        while True:
+            due = list()
+            with self._cond:
+                while not self._closed:
+                    now = time.time()
+                    while self._heap and self._heap[0][0] <= now:
+                        when, id = heapq.heappop(self._heap)
+                        job = self._jobs.get(id)
+                        if job is not None and job['when'] == when and \
+                                not job['running']:
+                            job['running'] = True
+                            due.append(job)
+                    if due:
+                        break
+                    self._cond.wait(self._heap[0][0] - now if self._heap
+                        else None)
+                if self._closed:
+                    return
+
+            self._log(*[dict(op = 'start', id = job['id']) for job in due])
+            for job in due:
+                self._executor.submit(self._execute, job)
+
+    def _execute(self, job):
+        returncode = None
+        try:
+            proc = Popen(['/bin/sh'], stdin = PIPE, stdout = DEVNULL,
+                stderr = DEVNULL, env = job['environment'], cwd = job['cwd'])
+            proc.communicate(job['command'].encode('utf-8'))
+            returncode = proc.returncode
+        except OSError: # Usually that the directory is gone.
+            returncode = 1
+        finally:
+            with self._cond:
+                self._jobs.pop(job['id'], None)
+            if not self._closed:
+                self._log(dict(op = 'done', id = job['id'],
+                    returncode = returncode), wait = False)
+
+    def submit(self, command, when, queue = 'a', environment = None,
+            cwd = None):
+        """ Schedule command for when (see resolve_when()) in queue, and return
+            the new job as a dict like get() does. environment defaults to
+            ours, and cwd to our working directory. """
+        when = spool._timestamp(resolve_when(when))
+        with self._cond:
+            id = self._next_id
+            self._next_id += 1
+
+        record = dict(op = 'add', id = id, when = when, queue = queue,
+            command = command, environment = dict(os.environ if environment
+            is None else environment), cwd = cwd or os.getcwd(),
+            who = pwd.getpwuid(os.getuid()).pw_name, created = time.time())
+        self._log(record)
+
+        job = self._job(record)
+        with self._cond:
+            self._jobs[id] = job
+            heapq.heappush(self._heap, (when, id))
+            self._cond.notify_all()
+        return self._public(job, True)
+
+    def remove(self, *ids):
+        """ Cancel the jobs with ids. Returns a dict of id -> None if it was
+            canceled, or an error like `at -r` would print if it wasn't. Jobs
+            that have started running can't be canceled. """
+        report = dict()
+        removed = list()
+        with self._cond:
+            for id in ids:
+                job = self._jobs.get(int(id))
+                if job is None or job['running']:
+                    report[id] = 'Cannot find jobid {0}'.format(id)
+                else:
+                    del self._jobs[int(id)]
+                    removed.append(int(id))
+                    report[id] = None
+
+        if removed:
+            self._log(*[dict(op = 'remove', id = id) for id in removed])
+        return report
+
+    def list(self, queue = False):
+        """ Return a list of dicts with the keys id, when, queue and who for
+            every job, or every job in queue, like AtQueue parses from `atq`.
+            Running jobs are in the queue '='. """
+        with self._cond:
+            jobs = [self._public(job) for job in self._jobs.values()]
+        if queue:
+            jobs = [job for job in jobs if job['queue'] == queue]
+        return sorted(jobs, key = lambda job: job['id'])
+
+    def get(self, id):
+        """ Return a dict with the keys id, when, queue, who, command,
+            environment, cwd and created for job id, or None if there's no
+            such job. """
+        with self._cond:
+            job = self._jobs.get(int(id))
+            return None if job is None else self._public(job, True)
+
+    @staticmethod
+    def _public(job, full = False):
+        public = dict(id = job['id'],
+            when = datetime.datetime.fromtimestamp(job['when']),
+            queue = '=' if job['running'] else job['queue'], who = job['who'])
+        if full:
+            public.update(command = job['command'],
+                environment = dict(job['environment']), cwd = job['cwd'],
+                created = datetime.datetime.fromtimestamp(job['created']))
+        return public
+
+    def close(self, wait = True):
+        """ Stop scheduling jobs. If wait, wait for running jobs to finish
+            first. Jobs that didn't start run when the engine next starts. """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._threads[1].join()
+        self._executor.shutdown(wait = wait)
+
+        with self._journal_cond:
+            self._journal_cond.notify_all()
+        self._threads[0].join()
+        self._journal.close()
+        self._lockfile.close() # Releases the lock.
+
+_engine = None
+_engine_lock = threading.Lock()
+
+def get_engine():
+    """ The Engine for config.engine_dir, started the first time it's
+        needed. """
+    global _engine
+    directory = os.path.expanduser(config.engine_dir)
+    with _engine_lock:
+        if _engine is None or _engine._closed or \
+                _engine.directory != directory:
+            if _engine is not None and not _engine._closed:
+                _engine.close()
+            _engine = Engine(directory)
+        return _engine
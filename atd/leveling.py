@@ -0,0 +1,166 @@
+################################################################################
+# atd.py - The Unix at scheduler in Python ################ py2/3k version 0.2 #
+################################################################################
+# Load leveling: spread jobs that would all start in the same minute.          #
+################################################################################
+# atd starts every job that's due in a minute at once, so scheduling thousands #
+# of jobs for "24 hours from now" means thousands of jobs starting together    #
+# tomorrow. A Leveler is given a budget of starts per minute for each queue.   #
+# It counts the jobs already in the queue, and moves each job it's given to    #
+# the first minute at or after its own that still has room, as long as that's  #
+# within tolerance of when it was asked for. If no minute is, the job goes in  #
+# the least busy minute within tolerance, over budget, so a job is never later #
+# than tolerance.                                                              #
+#                                                                              #
+# Pass a Leveler to atd.at_many() as level to level what it submits. Every     #
+# job it moved, and by how much, is in its placements; report() sums them up. #
+################################################################################
+##  Written by Fredrick Brennan <copypaste@kittens.ph>. See LICENSE (Expat).  ##
+################################################################################
+
+from __future__ import absolute_import
+import collections
+import datetime
+
+# Submodules #
+from atd import atd
+from atd import config
+
+MINUTE = datetime.timedelta(minutes = 1)
+
+class Placement(object):
+    """ Where a Leveler put one job: requested is the datetime it was asked
+        for, when the one it was given. over_budget is True if every minute
+        within tolerance was already full. """
+    __slots__ = ('requested', 'when', 'queue', 'over_budget')
+
+    def __init__(self, requested, when, queue, over_budget = False):
+        self.requested = requested
+        self.when = when
+        self.queue = queue
+        self.over_budget = over_budget
+
+    @property
+    def delay(self):
+        return self.when - self.requested
+
+    def __repr__(self):
+        return '<Placement {0} -> {1} in {2}{3}>'.format(self.requested,
+            self.when, self.queue, ' (over budget)' if self.over_budget
+            else '')
+
+class Leveler(object):
+    """ Moves jobs so that no more than per_minute start in any minute of a
+        queue. per_minute is a number for every queue, or a dict of queue ->
+        number; queues not in it aren't leveled. Jobs are moved at most
+        tolerance later (a timedelta or seconds, by default
+        config.leveling_tolerance). """
+    def __init__(self, per_minute, tolerance = None):
+        budgets = per_minute.values() if isinstance(per_minute, dict) else \
+            [per_minute]
+        if any(budget < 1 for budget in budgets):
+            raise ValueError('per_minute must be at least 1')
+        self.per_minute = per_minute
+
+        if tolerance is None:
+            tolerance = config.leveling_tolerance
+        if not isinstance(tolerance, datetime.timedelta):
+            tolerance = datetime.timedelta(seconds = tolerance)
+        self.tolerance = tolerance
+
+        self.placements = list()
+        self._starts = dict() # queue -> {minute: jobs starting in it}
+        self._full = dict()   # queue -> {full minute: a later one to try}
+
+    def _queue_starts(self, queue, budget):
+        """ The starts per minute of queue, counting what's in it already the
+            first time it's asked for. """
+        starts = self._starts.get(queue)
+        if starts is None:
+            starts = self._starts[queue] = collections.defaultdict(int)
+            full = self._full[queue] = dict()
+            for job in atd.AtQueue(queue).jobs:
+                starts[_minute(job.when)] += 1
+            for minute, n in starts.items():
+                if n >= budget: full[minute] = minute + MINUTE
+        return starts
+
+    def _first_free(self, queue, minute):
+        """ The first minute at or after minute that isn't full. Full minutes
+            point past themselves, and the chains are shortened as they're
+            followed, so finding room takes about constant time. """
+        full = self._full[queue]
+        path = list()
+        while minute in full:
+            path.append(minute)
+            minute = full[minute]
+        for skipped in path:
+            full[skipped] = minute
+        return minute
+
+    def place(self, when, queue = 'a'):
+        """ Find the time a job due at the datetime when in queue should be
+            moved to, count it as starting then, and return its Placement. """
+        budget = self.per_minute.get(queue) if isinstance(self.per_minute,
+            dict) else self.per_minute
+        if budget is None:
+            placement = Placement(when, when, queue)
+            self.placements.append(placement)
+            return placement
+
+        starts = self._queue_starts(queue, budget)
+        minute = _minute(when)
+        latest = _minute(when + self.tolerance)
+
+        free = self._first_free(queue, minute)
+        over_budget = free > latest
+        if over_budget:
+            free = minute
+            candidate = minute
+            while candidate <= latest:
+                if starts[candidate] < starts[free]:
+                    free = candidate
+                candidate += MINUTE
+
+        starts[free] += 1
+        if starts[free] >= budget:
+            self._full[queue][free] = free + MINUTE
+
+        placement = Placement(when, when + (free - minute), queue, over_budget)
+        self.placements.append(placement)
+        return placement
+
+    def level(self, jobs):
+        """ Yield each of the (command, when, queue, tags) tuples jobs, as
+            atd.at_many() takes them, with when moved by place(). Jobs it
+            doesn't move keep the when they were given, so a timespec like
+            'now' isn't turned into a time that's already passed. Jobs that
+            are malformed, or have an invalid when or queue, are passed on as
+            they are, for at_many() to report. """
+        for job in jobs:
+            try:
+                command, requested, queue, tags = atd._job_tuple(job)
+                when, queue = atd._build_at_args(requested, queue)[1:]
+            except Exception:
+                yield job
+                continue
+            placement = self.place(when, queue)
+            yield (command, placement.when if placement.delay else requested,
+                queue, tags)
+
+    def report(self):
+        """ A dict summing up the placements: how many jobs there were, how
+            many were moved and how many went over budget, the most any was
+            moved by (max_delay) and the most jobs starting in any one minute
+            that a job was put in (max_starts). """
+        starts = [self._starts[p.queue][_minute(p.when)]
+            for p in self.placements if p.queue in self._starts]
+        return dict(jobs = len(self.placements),
+            moved = sum(1 for p in self.placements if p.delay),
+            over_budget = sum(1 for p in self.placements if p.over_budget),
+            max_delay = max([p.delay for p in self.placements] or
+                [datetime.timedelta(0)]),
+            max_starts = max(starts or [0]))
+
+def _minute(when):
+    return when.replace(second = 0, microsecond = 0)
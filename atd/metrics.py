@@ -0,0 +1,267 @@
+################################################################################
+# atd.py - The Unix at scheduler in Python ################ py2/3k version 0.2 #
+################################################################################
+# Instrumentation: see where python-atd spends its time.                       #
+################################################################################
+# Every  `at`,  `atq`  and  `at -r`  python-atd  runs, every parse  of  their  #
+# output,  every lazy-loaded AtJob attribute and every snapshot cache  lookup  #
+# is reported to the observers added with add_observer(),  as  a  dict  with  #
+# an  event key (see the constants below).  With no observers, reporting costs #
+# next to nothing, so it's always on.                                          #
+#                                                                              #
+# Collector is an observer that keeps counters and latency histograms in       #
+# memory, and exports them as a dict or in the Prometheus text format. Use     #
+# enable() to start collecting into the shared one:                            #
+#                                                                              #
+#     collector = atd.metrics.enable()                                         #
+#     print(collector.prometheus())                                            #
+################################################################################
+##  Written by Fredrick Brennan <copypaste@kittens.ph>. See LICENSE (Expat).  ##
+################################################################################
+
+from __future__ import absolute_import
+import bisect
+import os
+import threading
+import time
+
+# Events. Every event dict also has the keys listed with it.
+SUBPROCESS = 'subprocess' # kind, seconds, returncode, output_bytes, error
+PARSE = 'parse'           # kind, seconds, jobs
+LAZY_LOAD = 'lazy_load'   # attribute, source
+CACHE = 'cache'           # cache, hit
+
+clock = getattr(time, 'perf_counter', time.time)
+
+_observers = []
+_observers_lock = threading.Lock()
+
+def add_observer(observer):
+    """ Call observer with every event dict from now on. Observers are called
+        on whatever thread the event happened on, so they must be quick and
+        thread safe, and must not raise. """
+    global _observers
+    with _observers_lock:
+        _observers = _observers + [observer]
+
+def remove_observer(observer):
+    """ Stop calling observer. Raises ValueError if it isn't observing. """
+    global _observers
+    with _observers_lock:
+        observers = list(_observers)
+        observers.remove(observer)
+        _observers = observers
+
+def enabled():
+    """ True if anybody is observing. """
+    return bool(_observers)
+
+def emit(event, **fields):
+    """ Report event to every observer. """
+    observers = _observers
+    if not observers:
+        return
+    fields['event'] = event
+    for observer in observers:
+        observer(fields)
+
+def kind(args):
+    """ What sort of command args is, for grouping: 'at', 'atq', 'at -c',
+        'at -r' and so on. """
+    name = os.path.basename(args[0])
+    if len(args) > 1 and args[1] in ('-c', '-r', '-l', '-d'):
+        return '{0} {1}'.format(name, args[1])
+    return name
+
+class call(object):
+    """ Times a subprocess for a with block, reporting a SUBPROCESS event when
+        it ends. Set returncode and output_bytes on it inside the block;
+        CalledProcessError's returncode is picked up by itself. """
+    __slots__ = ('args', 'returncode', 'output_bytes', 'started')
+
+    def __init__(self, args):
+        self.args = args
+        self.returncode = None
+        self.output_bytes = 0
+
+    def __enter__(self):
+        self.started = clock()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if not _observers:
+            return False
+        if exc is not None and getattr(exc, 'returncode', None) is not None:
+            self.returncode = exc.returncode
+        emit(SUBPROCESS, kind = kind(self.args),
+            seconds = clock() - self.started, returncode = self.returncode,
+            output_bytes = self.output_bytes,
+            error = exc_type.__name__ if exc_type is not None and
+                issubclass(exc_type, Exception) else None)
+        return False
+
+# Seconds. Forking `at` takes around a millisecond; `atq` on a big queue, more.
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0)
+
+class _Histogram(object):
+    __slots__ = ('buckets', 'counts', 'count', 'sum')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        """ (upper bound, count of values <= it) pairs, ending with +Inf. """
+        total = 0
+        pairs = []
+        for bound, count in zip(list(self.buckets) + [float('inf')],
+                self.counts):
+            total += count
+            pairs.append((bound, total))
+        return pairs
+
+    def as_dict(self):
+        return dict(count = self.count, sum = self.sum,
+            buckets = [('+Inf' if bound == float('inf') else bound, count)
+                for bound, count in self.cumulative()])
+
+class Collector(object):
+    """ An observer that aggregates events in memory: latency histograms of
+        subprocesses and parses, and counters of failures, output bytes,
+        parsed jobs, lazy loads and cache lookups. """
+    def __init__(self, buckets = BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """ Forget everything collected so far. """
+        with self._lock:
+            self.subprocess_seconds = dict()  # kind -> _Histogram
+            self.subprocess_failures = dict() # kind -> count
+            self.output_bytes = dict()        # kind -> bytes
+            self.parse_seconds = dict()       # kind -> _Histogram
+            self.parsed_jobs = dict()         # kind -> count
+            self.lazy_loads = dict()          # (attribute, source) -> count
+            self.cache_lookups = dict()       # (cache, 'hit'/'miss') -> count
+
+    def __call__(self, event):
+        with self._lock:
+            name = event['event']
+            if name == SUBPROCESS:
+                kind = event['kind']
+                self._histogram(self.subprocess_seconds, kind).observe(
+                    event['seconds'])
+                self.output_bytes[kind] = self.output_bytes.get(kind, 0) + \
+                    event['output_bytes']
+                if event['returncode'] != 0 or event['error']:
+                    self.subprocess_failures[kind] = \
+                        self.subprocess_failures.get(kind, 0) + 1
+            elif name == PARSE:
+                kind = event['kind']
+                self._histogram(self.parse_seconds, kind).observe(
+                    event['seconds'])
+                self.parsed_jobs[kind] = self.parsed_jobs.get(kind, 0) + \
+                    event['jobs']
+            elif name == LAZY_LOAD:
+                key = (event['attribute'], event['source'])
+                self.lazy_loads[key] = self.lazy_loads.get(key, 0) + 1
+            elif name == CACHE:
+                key = (event['cache'], 'hit' if event['hit'] else 'miss')
+                self.cache_lookups[key] = self.cache_lookups.get(key, 0) + 1
+
+    def _histogram(self, histograms, kind):
+        histogram = histograms.get(kind)
+        if histogram is None:
+            histogram = histograms[kind] = _Histogram(self.buckets)
+        return histogram
+
+    def as_dict(self):
+        """ Everything collected, as plain dicts, lists and numbers. Counters
+            keyed by two labels are keyed by 'label1 label2' strings. """
+        def pairs(counters):
+            return dict((' '.join(key), count)
+                for key, count in counters.items())
+
+        with self._lock:
+            return dict(
+                subprocess_seconds = dict((kind, histogram.as_dict())
+                    for kind, histogram in self.subprocess_seconds.items()),
+                subprocess_failures = dict(self.subprocess_failures),
+                output_bytes = dict(self.output_bytes),
+                parse_seconds = dict((kind, histogram.as_dict())
+                    for kind, histogram in self.parse_seconds.items()),
+                parsed_jobs = dict(self.parsed_jobs),
+                lazy_loads = pairs(self.lazy_loads),
+                cache_lookups = pairs(self.cache_lookups))
+
+    def prometheus(self, prefix = 'atd'):
+        """ Everything collected, in the Prometheus text exposition format. """
+        lines = []
+
+        def header(name, kind, help):
+            lines.append('# HELP {0}_{1} {2}'.format(prefix, name, help))
+            lines.append('# TYPE {0}_{1} {2}'.format(prefix, name, kind))
+
+        def histogram(name, help, histograms):
+            header(name, 'histogram', help)
+            for kind, hist in sorted(histograms.items()):
+                for bound, count in hist.cumulative():
+                    lines.append('{0}_{1}_bucket{{kind="{2}",le="{3}"}} {4}'
+                        .format(prefix, name, _escape(kind), '+Inf' if
+                        bound == float('inf') else repr(bound), count))
+                lines.append('{0}_{1}_sum{{kind="{2}"}} {3!r}'.format(prefix,
+                    name, _escape(kind), hist.sum))
+                lines.append('{0}_{1}_count{{kind="{2}"}} {3}'.format(prefix,
+                    name, _escape(kind), hist.count))
+
+        def counter(name, help, counters, labels):
+            header(name, 'counter', help)
+            for key, count in sorted(counters.items()):
+                key = key if isinstance(key, tuple) else (key,)
+                lines.append('{0}_{1}{{{2}}} {3}'.format(prefix, name,
+                    ','.join('{0}="{1}"'.format(label, _escape(value))
+                    for label, value in zip(labels, key)), count))
+
+        with self._lock:
+            histogram('subprocess_seconds', 'Wall time of subprocesses.',
+                self.subprocess_seconds)
+            counter('subprocess_failures_total', 'Subprocesses that failed.',
+                self.subprocess_failures, ('kind',))
+            counter('subprocess_output_bytes_total', 'Bytes subprocesses '
+                'wrote to stdout and stderr.', self.output_bytes, ('kind',))
+            histogram('parse_seconds', 'Time spent parsing queue listings.',
+                self.parse_seconds)
+            counter('parsed_jobs_total', 'Jobs parsed from queue listings.',
+                self.parsed_jobs, ('kind',))
+            counter('lazy_loads_total', 'AtJob attributes loaded lazily.',
+                self.lazy_loads, ('attribute', 'source'))
+            counter('cache_lookups_total', 'Snapshot cache lookups.',
+                self.cache_lookups, ('cache', 'result'))
+
+        return '\n'.join(lines) + '\n'
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
+
+collector = Collector()
+
+def enable():
+    """ Start collecting into the shared collector, and return it. """
+    if collector not in _observers:
+        add_observer(collector)
+    return collector
+
+def disable():
+    """ Stop collecting into the shared collector. What it has is kept. """
+    if collector in _observers:
+        remove_observer(collector)
@@ -0,0 +1,208 @@
+################################################################################
+# atd.py - The Unix at scheduler in Python ################ py2/3k version 0.2 #
+################################################################################
+# Reconciliation: make the queue match the jobs you expect it to have.         #
+################################################################################
+# Programs that keep the jobs they've scheduled in their own database drift    #
+# from the queue: jobs get lost, canceled by hand or left behind. reconcile()  #
+# takes the jobs you expect, compares them with one AtQueue in a single pass,  #
+# and works out the least it has to do to fix things, as a Plan:               #
+#                                                                              #
+#   keep      jobs in the queue just as expected,                              #
+#   submit    expected jobs that aren't in the queue,                          #
+#   replace   jobs whose when or queue (or command) drifted; `at` can't change #
+#             a job, so a new one is submitted and then the old one canceled,  #
+#   cancel    jobs in the queue that nobody expects, and                       #
+#   expired   expected jobs that aren't in the queue, but were due already,    #
+#             so have probably run. They're left alone.                        #
+#                                                                              #
+# Only jobs in the queue reconcile() is given are canceled for not being       #
+# expected, since a host's other queues belong to other programs (and, for     #
+# root, to other users). Reconciling every queue only cancels them with        #
+# cancel_unexpected=True.                                                      #
+#                                                                              #
+# The plan is then run with atd.at_many() and chunked, concurrent `at -r`s,    #
+# or, with dry_run, returned with an estimate of what running it would cost.   #
+################################################################################
+##  Written by Fredrick Brennan <copypaste@kittens.ph>. See LICENSE (Expat).  ##
+################################################################################
+
+from __future__ import absolute_import
+import datetime
+
+# Submodules #
+from atd import atd
+from atd import atq
+from atd import config
+from atd import metrics
+from atd import timespec
+
+class Plan(object):
+    """ What reconcile() does, or would do. Expected jobs are dicts, as given
+        to it. keep and cancel are lists of job ids, submit and expired lists
+        of expected jobs, and replace a dict of the id of the job in the queue
+        -> the expected job that replaces it. unexpected is a list of the ids
+        of jobs nobody expects that are left alone, because they're outside
+        what reconcile() was asked to look after.
+
+        Once it's been run, submitted is a list of (expected job, the AtJob
+        made for it, or the exception submitting it raised) tuples, and
+        canceled a CancelReport. A replaced job is only canceled if its
+        replacement was submitted. """
+    def __init__(self):
+        self.keep = list()
+        self.submit = list()
+        self.replace = dict()
+        self.cancel = list()
+        self.expired = list()
+        self.unexpected = list()
+        self.submitted = None
+        self.canceled = None
+
+    def __bool__(self):
+        """ True if there's anything to do. """
+        return bool(self.submit or self.replace or self.cancel)
+    __nonzero__ = __bool__
+
+    def __repr__(self):
+        return ('<Plan keep {0}, submit {1}, replace {2}, cancel {3}, '
+            'expired {4}, unexpected {5}>').format(len(self.keep),
+            len(self.submit), len(self.replace), len(self.cancel),
+            len(self.expired), len(self.unexpected))
+
+    def cost(self, workers = 8):
+        """ Estimate what running this plan takes: a dict of how many jobs
+            are submitted and canceled, how many of each command are run
+            (processes, a dict of kind -> count, like atd.metrics groups them)
+            and about how many seconds that takes. seconds is worked out from
+            what the shared metrics collector has seen, so it's None until
+            it's seen each kind of command at least once. """
+        submits = len(self.submit) + len(self.replace)
+        ids = self.cancel + list(self.replace)
+
+        processes = dict()
+        if config.scheduler_backend != 'engine':
+            if config.at_backend != 'spool' and submits:
+                processes['at'] = submits
+            if ids:
+                processes['at -r'] = len(atd._chunk_ids([config.at_binary,
+                    '-r'], ids, -(-len(ids) // workers)))
+
+        seconds = 0.0
+        for kind, count in processes.items():
+            histogram = metrics.collector.subprocess_seconds.get(kind)
+            if histogram is None or not histogram.count:
+                seconds = None
+                break
+            seconds += histogram.sum / histogram.count * \
+                -(-count // workers)
+
+        return dict(submits = submits, cancels = len(ids),
+            processes = processes, seconds = seconds)
+
+def _minute(when):
+    return when.replace(second = 0, microsecond = 0)
+
+def _when(when, now):
+    """ when as a datetime. Strings are dates and times like export writes,
+        or else timespecs, resolved at now. """
+    if not isinstance(when, str):
+        return when
+    parsed = timespec.parse_datetime(when)
+    return timespec.resolve(when, now) if parsed is None else parsed
+
+def plan(expected, queue = False, compare_commands = False, now = None,
+        cancel_unexpected = None):
+    """ Work out the Plan that makes the queue match expected. See
+        reconcile(). """
+    if cancel_unexpected is None:
+        cancel_unexpected = bool(queue)
+    now = now or datetime.datetime.now()
+    current = atq.AtQueue(queue)
+    if compare_commands:
+        current.load_commands()
+    by_id = dict((int(job.id), job) for job in current.jobs)
+
+    result = Plan()
+    seen = set()
+    for job in expected:
+        job = dict(job)
+        job['queue'] = job.get('queue') or 'a'
+        if queue and job['queue'] != queue:
+            continue # Someone else's business.
+        job['when'] = _when(job['when'], now)
+
+        found = None
+        if job.get('id') is not None:
+            found = by_id.get(int(job['id']))
+
+        if found is None:
+            if job['when'] <= now:
+                result.expired.append(job)
+            else:
+                result.submit.append(job)
+            continue
+
+        id = int(found.id)
+        seen.add(id)
+        if found.queue == '=' or ((_minute(found.when), found.queue) ==
+                (_minute(job['when']), job['queue']) and
+                (not compare_commands or found.command == job['command'])):
+            result.keep.append(id)
+        else:
+            result.replace[id] = job
+
+    unexpected = [id for id, job in by_id.items()
+        if id not in seen and job.queue != '=']
+    if cancel_unexpected:
+        result.cancel = unexpected
+    else:
+        result.unexpected = unexpected
+    return result
+
+def execute(plan, workers = 8):
+    """ Run plan: submit what it says with atd.at_many(), then cancel what it
+        says, in chunks, with up to workers at a time. Returns plan, with
+        submitted and canceled set. """
+    jobs = plan.submit + list(plan.replace.values())
+    replaced = [None] * len(plan.submit) + list(plan.replace)
+    results = atd.at_many(((job['command'], job['when'], job['queue'],
+        job.get('tags')) for job in jobs), workers)
+
+    plan.submitted = list()
+    ids = list(plan.cancel)
+    for job, id, result in zip(jobs, replaced, results):
+        plan.submitted.append((job, result))
+        if id is not None and not isinstance(result, Exception):
+            ids.append(id)
+
+    plan.canceled = atd._atrm_ids(ids, workers)
+    return plan
+
+def reconcile(expected, queue = False, dry_run = False, workers = 8,
+        compare_commands = False, cancel_unexpected = None):
+    """ Make queue (or every queue) match expected, an iterable of dicts with
+        the keys command, when and, optionally, id, queue (by default, 'a')
+        and tags, like python -m atd export writes. when is a datetime, or a
+        string: a date and time like export writes, or a timespec. id is the
+        job's id, if it's been submitted before. Expected jobs in other queues
+        than queue are ignored.
+
+        Jobs in queue that aren't expected are canceled, except ones already
+        running. Without a queue, every queue on the host is looked at, and
+        jobs nobody expects are only canceled if cancel_unexpected is True;
+        otherwise they're listed in the Plan's unexpected. That includes
+        other programs' jobs, and, for root, other users'.
+
+        The queue is read once, and every expected job looked up in it by id,
+        so this takes time in proportion to the number of jobs. If
+        compare_commands, every job's command is loaded too (see
+        AtQueue.load_commands()), and jobs whose command differs are
+        replaced.
+
+        Returns the Plan, after running it with execute(), unless dry_run. """
+    result = plan(expected, queue, compare_commands,
+        cancel_unexpected = cancel_unexpected)
+    if dry_run:
+        return result
+    return execute(result, workers)
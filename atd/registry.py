@@ -0,0 +1,171 @@
+################################################################################
+# atd.py - The Unix at scheduler in Python ################ py2/3k version 0.2 #
+################################################################################
+# A local registry of the jobs this program created, kept in SQLite.           #
+################################################################################
+# `at`  only  tells  us  a  job's  id when we create it. Learning its command, #
+# owner  or due time again means running `atq` or `at -c`.  If you set        #
+# config.registry_path,  every  job  made with at() is recorded in  a  SQLite #
+# file  instead,  along with any tags you give it, and AtJob looks there first #
+# when  an  attribute is lazy-loaded.  Jobs made some other way, or before the #
+# registry was turned on, are looked up the usual way.                         #
+#                                                                              #
+# Jobs  run  and  ids  get  reused  without  us  knowing, so  every            #
+# config.registry_reconcile_interval  seconds  the  registry  is checked       #
+# against the live queue, and jobs that are gone are forgotten.                #
+################################################################################
+##  Written by Fredrick Brennan <copypaste@kittens.ph>. See LICENSE (Expat).  ##
+################################################################################
+
+from __future__ import absolute_import
+import datetime
+import json
+import os
+import pwd
+import sqlite3
+import threading
+import time
+
+# Submodules #
+from atd import atq
+from atd import config
+from atd import spool
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    queue TEXT NOT NULL,
+    due REAL,
+    who TEXT,
+    command TEXT NOT NULL,
+    tags TEXT NOT NULL,
+    created REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS job_tags (
+    tag TEXT NOT NULL,
+    id INTEGER NOT NULL REFERENCES jobs (id) ON DELETE CASCADE,
+    PRIMARY KEY (tag, id)
+);
+'''
+
+class Registry(object):
+    """ The jobs recorded in the SQLite file at path. Safe to share between
+        threads, and between processes using the same file. """
+    def __init__(self, path, reconcile_interval = None):
+        self.path = path
+        self.reconcile_interval = reconcile_interval
+        self._lock = threading.Lock()
+        self._reconciled = time.time()
+        self._db = sqlite3.connect(path, check_same_thread = False,
+            isolation_level = None)
+        self._db.execute('PRAGMA journal_mode = WAL')
+        self._db.execute('PRAGMA foreign_keys = ON')
+        self._db.executescript(SCHEMA)
+
+    def record(self, job, tags = None):
+        """ Record job, an AtJob just returned by at(). tags is an iterable of
+            strings to find it by later with tagged(). """
+        tags = sorted(set(tags or ()))
+        due = (spool._timestamp(job.when)
+            if isinstance(job.when, datetime.datetime) else None)
+
+        with self._lock:
+            with self._db:
+                self._db.execute('BEGIN')
+                self._db.execute('INSERT OR REPLACE INTO jobs VALUES '
+                    '(?, ?, ?, ?, ?, ?, ?)', (int(job.id), job.queue, due,
+                    pwd.getpwuid(os.getuid()).pw_name, job.command,
+                    json.dumps(tags), time.time()))
+                self._db.executemany('INSERT INTO job_tags VALUES (?, ?)',
+                    [(tag, int(job.id)) for tag in tags])
+
+    def get(self, id):
+        """ Return a dict with the keys id, queue, when, who, command, tags
+            and created for job id, or None if it isn't recorded. when is None
+            if the job was submitted with a timespec we couldn't resolve. """
+        self._reconcile_if_due()
+        with self._lock:
+            row = self._db.execute('SELECT id, queue, due, who, command, tags, '
+                'created FROM jobs WHERE id = ?', (int(id),)).fetchone()
+
+        if row is None:
+            return None
+        return dict(id = row[0], queue = row[1],
+            when = (datetime.datetime.fromtimestamp(row[2])
+                if row[2] is not None else None),
+            who = row[3], command = row[4], tags = json.loads(row[5]),
+            created = datetime.datetime.fromtimestamp(row[6]))
+
+    def tagged(self, tag):
+        """ Return a list of the ids of jobs recorded with tag. """
+        self._reconcile_if_due()
+        with self._lock:
+            return [row[0] for row in self._db.execute('SELECT id FROM '
+                'job_tags WHERE tag = ? ORDER BY id', (tag,))]
+
+    def forget(self, *ids):
+        """ Stop tracking the jobs with ids, e.g. because they were
+            canceled. """
+        with self._lock:
+            self._db.executemany('DELETE FROM jobs WHERE id = ?',
+                [(int(id),) for id in ids])
+
+    def reconcile(self, atqueue = None):
+        """ Forget every job that's no longer in atqueue (by default, a fresh
+            AtQueue of the whole queue), or whose id now belongs to a job due
+            at a different time. Jobs recorded after atqueue was read are left
+            alone. Returns a list of the forgotten ids. """
+        started = time.time()
+        if atqueue is None:
+            atqueue = atq.AtQueue()
+            started = time.time()
+        self._reconciled = started
+
+        with self._lock:
+            rows = self._db.execute('SELECT id, due, created FROM jobs '
+                'WHERE created < ?', (started,)).fetchall()
+
+        stale = list()
+        for id, due, created in rows:
+            try:
+                live = atqueue.find_job_by_id(id)
+            except ValueError:
+                stale.append(id)
+                continue
+
+            # atq only shows the minute, so that's all we can compare.
+            if due is not None and int(due) // 60 != \
+                    int(spool._timestamp(live.when)) // 60:
+                stale.append(id)
+
+        self.forget(*stale)
+        return stale
+
+    def _reconcile_if_due(self):
+        interval = (config.registry_reconcile_interval
+            if self.reconcile_interval is None else self.reconcile_interval)
+        if time.time() - self._reconciled >= interval:
+            self._reconciled = time.time()
+            self.reconcile()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+_registry = None
+_registry_lock = threading.Lock()
+
+def get_registry():
+    """ The Registry at config.registry_path, or None if it isn't set. """
+    global _registry
+    path = config.registry_path
+    if not path:
+        return None
+
+    path = os.path.expanduser(path)
+    with _registry_lock:
+        if _registry is None or _registry.path != path:
+            if _registry is not None:
+                _registry.close()
+            _registry = Registry(path)
+        return _registry
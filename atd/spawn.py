@@ -0,0 +1,275 @@
+################################################################################
+# atd.py - The Unix at scheduler in Python ################ py2/3k version 0.2 #
+################################################################################
+# How python-atd starts `at`, `atq` and `at -r`.                               #
+################################################################################
+# config.spawn_backend picks one of:                                           #
+#                                                                              #
+# popen        subprocess.Popen, as always.                                    #
+# posix_spawn  os.posix_spawn(), which never copies the parent's page tables,  #
+#              however big the parent is.                                      #
+# helper       A pool of small, long-lived helper processes (spawn_helper.py)  #
+#              which run each command for us, so we never fork at all after    #
+#              they've started. config.spawn_helpers is the most that run at   #
+#              once. They're started lazily, with the parent's environment     #
+#              and umask at that time; the working directory is sent along     #
+#              with every command.                                             #
+#                                                                              #
+# Either way, run() returns the same thing and reports to atd.metrics.         #
+################################################################################
+##  Written by Fredrick Brennan <copypaste@kittens.ph>. See LICENSE (Expat).  ##
+################################################################################
+
+from __future__ import absolute_import
+import errno
+import json
+import os
+import selectors
+import sys
+import threading
+from subprocess import Popen, PIPE, DEVNULL, CalledProcessError
+
+# Submodules #
+from atd import config
+from atd import metrics
+
+BACKENDS = ('popen', 'posix_spawn', 'helper')
+
+def run(args, input = None, env = None, backend = None):
+    """ Run args, feeding it input (bytes) on stdin. env is the environment to
+        run it in, or None for ours. Returns a tuple of (returncode, stdout,
+        stderr). Raises OSError if args can't be run at all.
+
+        backend is one of BACKENDS, by default config.spawn_backend. """
+    backend = backend or config.spawn_backend
+    if backend not in BACKENDS:
+        raise ValueError('Invalid spawn backend. Use one of {0}.'.format(
+            BACKENDS))
+
+    with metrics.call(args) as call:
+        if backend == 'popen':
+            returncode, stdout, stderr = _run_popen(args, input, env)
+        elif backend == 'posix_spawn':
+            returncode, stdout, stderr = _run_posix_spawn(args, input, env)
+        else:
+            returncode, stdout, stderr = get_pool().run(args, input, env)
+        call.returncode = returncode
+        call.output_bytes = len(stdout) + len(stderr)
+
+    return (returncode, stdout, stderr)
+
+def check_output(args, backend = None):
+    """ Like subprocess.check_output(), with the spawn backend. stderr is
+        captured, and attached to the CalledProcessError if args fails. """
+    returncode, stdout, stderr = run(args, backend = backend)
+    if returncode != 0:
+        raise CalledProcessError(returncode, args, stdout, stderr)
+    return stdout
+
+def _run_popen(args, input, env):
+    proc = Popen(args, stdin = DEVNULL if input is None else PIPE,
+        stdout = PIPE, stderr = PIPE, env = env)
+    stdout, stderr = proc.communicate(input)
+    return (proc.returncode, stdout, stderr)
+
+def _run_posix_spawn(args, input, env):
+    if not hasattr(os, 'posix_spawn'):
+        raise NotImplementedError('os.posix_spawn() needs Python 3.8 or '
+            'later on a POSIX system. Use the popen spawn backend.')
+
+    # Pipes are close-on-exec; only the child's dup2()ed copies survive.
+    if input is None:
+        stdin_r, stdin_w = os.open(os.devnull, os.O_RDONLY), None
+    else:
+        stdin_r, stdin_w = os.pipe()
+    stdout_r, stdout_w = os.pipe()
+    stderr_r, stderr_w = os.pipe()
+    spawn = os.posix_spawn if os.path.dirname(args[0]) else os.posix_spawnp
+
+    try:
+        pid = spawn(args[0], args, os.environ if env is None else env,
+            file_actions = [(os.POSIX_SPAWN_DUP2, stdin_r, 0),
+            (os.POSIX_SPAWN_DUP2, stdout_w, 1),
+            (os.POSIX_SPAWN_DUP2, stderr_w, 2)])
+    except BaseException:
+        for fd in (stdin_w, stdout_r, stderr_r):
+            if fd is not None: os.close(fd)
+        raise
+    finally:
+        for fd in (stdin_r, stdout_w, stderr_w):
+            os.close(fd)
+
+    try:
+        stdout, stderr = _communicate(stdin_w, input, stdout_r, stderr_r)
+    finally:
+        status = _waitpid(pid)
+    return (_exitcode(status), stdout, stderr)
+
+def _exitcode(status):
+    """ The returncode Popen would give for a waitpid() status: the exit
+        status, or minus the signal that killed the child. (Python 3.9's
+        os.waitstatus_to_exitcode(), for 3.8.) """
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+def _waitpid(pid):
+    while True:
+        try:
+            return os.waitpid(pid, 0)[1]
+        except OSError as e: # Python 2 doesn't retry EINTR for us.
+            if e.errno != errno.EINTR:
+                raise
+
+def _communicate(stdin, input, stdout, stderr):
+    """ Write input to the file descriptor stdin while reading stdout and
+        stderr until they're closed, without deadlocking on full pipes. Closes
+        all three. Returns (stdout, stderr) as bytes. """
+    output = {stdout: [], stderr: []}
+    selector = selectors.DefaultSelector()
+    try:
+        selector.register(stdout, selectors.EVENT_READ)
+        selector.register(stderr, selectors.EVENT_READ)
+        if stdin is not None:
+            if input:
+                os.set_blocking(stdin, False)
+                selector.register(stdin, selectors.EVENT_WRITE)
+            else:
+                os.close(stdin)
+                stdin = None
+
+        view = memoryview(input or b'')
+        while selector.get_map():
+            for key, events in selector.select():
+                fd = key.fd
+                if fd == stdin:
+                    try:
+                        view = view[os.write(fd, view[:65536]):]
+                    except BrokenPipeError:
+                        view = view[:0] # It doesn't want the rest.
+                    if not view:
+                        selector.unregister(fd)
+                        os.close(fd)
+                        stdin = None
+                    continue
+
+                data = os.read(fd, 65536)
+                if data:
+                    output[fd].append(data)
+                else:
+                    selector.unregister(fd)
+    finally:
+        selector.close()
+        for fd in (stdin, stdout, stderr):
+            if fd is not None: os.close(fd)
+
+    return (b''.join(output[stdout]), b''.join(output[stderr]))
+
+HELPER = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    'spawn_helper.py')
+
+class _Helper(object):
+    """ One running spawn_helper.py. """
+    def __init__(self):
+        # A new session, so ^C meant for our parent doesn't reach it. It exits
+        # by itself when its stdin is closed, i.e. when we do.
+        self.proc = Popen([sys.executable, '-S', HELPER], stdin = PIPE,
+            stdout = PIPE, start_new_session = True)
+
+    def run(self, args, input, env):
+        request = dict(args = list(args), env = env, cwd = os.getcwd(),
+            input = None if input is None else input.decode('latin-1'))
+        try:
+            self.proc.stdin.write(json.dumps(request).encode('utf-8') + b'\n')
+            self.proc.stdin.flush()
+            line = self.proc.stdout.readline()
+        except (IOError, OSError):
+            line = b''
+        if not line:
+            raise OSError(errno.EPIPE, 'The spawn helper process died.')
+
+        response = json.loads(line.decode('utf-8'))
+        if 'errno' in response:
+            raise OSError(response['errno'], response['strerror'],
+                response['filename'])
+        return (response['returncode'], response['stdout'].encode('latin-1'),
+            response['stderr'].encode('latin-1'))
+
+    def close(self):
+        self.proc.stdin.close()
+        self.proc.stdout.close()
+        self.proc.wait()
+
+class HelperPool(object):
+    """ Up to size helper processes (by default, config.spawn_helpers), used
+        like a connection pool: each run() borrows an idle helper, starting
+        one if there are fewer than size, or waits for one to be returned.
+        Safe to share between threads. A forked child starts its own. """
+    def __init__(self, size = None):
+        self.size = size or config.spawn_helpers
+        self._cond = threading.Condition()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._idle = []
+        self._started = 0
+
+    def _borrow(self):
+        with self._cond:
+            if self._pid != os.getpid():
+                self._reset() # Our parent's helpers aren't ours to use.
+            while not self._idle and self._started >= self.size:
+                self._cond.wait()
+            if self._idle:
+                return self._idle.pop()
+            self._started += 1
+
+        try:
+            return _Helper()
+        except BaseException:
+            self._return(None)
+            raise
+
+    def _return(self, helper):
+        with self._cond:
+            if helper is None:
+                self._started -= 1
+            else:
+                self._idle.append(helper)
+            self._cond.notify()
+
+    def run(self, args, input = None, env = None):
+        """ Run args with a helper. See atd.spawn.run(). """
+        helper = self._borrow()
+        try:
+            result = helper.run(args, input, env)
+        except OSError as e:
+            if e.errno == errno.EPIPE: # Don't hand out a dead helper again.
+                helper.proc.kill()
+                helper.close()
+                helper = None
+            raise
+        finally:
+            self._return(helper)
+        return result
+
+    def close(self):
+        """ Stop every idle helper. Helpers that are busy at the time go back
+            into the pool as usual. """
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._started -= len(idle)
+        for helper in idle:
+            helper.close()
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """ The HelperPool shared by everything using the helper backend. """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = HelperPool()
+        return _pool
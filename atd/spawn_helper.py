@@ -0,0 +1,47 @@
+################################################################################
+# atd.py - The Unix at scheduler in Python ################ py2/3k version 0.2 #
+################################################################################
+# The helper process behind config.spawn_backend = 'helper'.                   #
+################################################################################
+# It's started once, while it's small, and then runs `at`, `atq` and  `at -r`  #
+# for its parent, which no longer pays to fork itself every time. Requests and #
+# responses are JSON, one per line. Bytes are sent as Latin-1 strings, which   #
+# round-trip any byte exactly.                                                 #
+#                                                                              #
+# This file is run as a script, so it must not import anything from atd. See   #
+# atd.spawn for the other end of the pipe.                                     #
+################################################################################
+##  Written by Fredrick Brennan <copypaste@kittens.ph>. See LICENSE (Expat).  ##
+################################################################################
+
+from __future__ import absolute_import
+import json
+import sys
+from subprocess import Popen, PIPE, DEVNULL
+
+def handle(request):
+    """ Run one request, a dict with the keys args, input, env and cwd, and
+        return the response dict. """
+    input = request['input']
+    try:
+        proc = Popen(request['args'], stdin = DEVNULL if input is None else
+            PIPE, stdout = PIPE, stderr = PIPE, env = request['env'],
+            cwd = request['cwd'])
+        stdout, stderr = proc.communicate(None if input is None else
+            input.encode('latin-1'))
+    except OSError as e:
+        return dict(errno = e.errno, strerror = e.strerror,
+            filename = e.filename)
+
+    return dict(returncode = proc.returncode,
+        stdout = stdout.decode('latin-1'), stderr = stderr.decode('latin-1'))
+
+def main(requests, responses):
+    for line in iter(requests.readline, b''):
+        response = handle(json.loads(line.decode('utf-8')))
+        responses.write(json.dumps(response).encode('utf-8') + b'\n')
+        responses.flush()
+    return 0 # Our parent went away.
+
+if __name__ == '__main__':
+    sys.exit(main(sys.stdin.buffer, sys.stdout.buffer))
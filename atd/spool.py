@@ -0,0 +1,380 @@
+################################################################################
+# atd.py - The Unix at scheduler in Python ################ py2/3k version 0.2 #
+################################################################################
+# Read and write the `at` spool directory directly, without `atq` or `at`.     #
+################################################################################
+# Each job is a file in the spool, and its name already tells us most of what  #
+# `atq`  would:  the  queue letter, the job number as five hex digits and  the #
+# minute it's due (since the epoch) as eight hex digits, e.g.  a0000d01b9a1c4  #
+# is job 13 in queue a.  The file's owner is the job's owner.  Jobs  that  are #
+# not yet executable are still being written by `at`, and are skipped like     #
+# `atq` skips them.                                                            #
+#                                                                              #
+# write_jobs() creates jobs the way GNU at does: it takes job numbers from the #
+# .SEQ file under at's lock, writes each job script with the executable bit    #
+# clear and only sets it once the script is complete, and then wakes atd with  #
+# one SIGHUP for the whole batch. Only GNU at's spool format is supported.     #
+################################################################################
+##  Written by Fredrick Brennan <copypaste@kittens.ph>. See LICENSE (Expat).  ##
+################################################################################
+
+from __future__ import absolute_import
+import datetime
+import errno
+import fcntl
+import os
+import pwd
+import re
+import signal
+import stat
+import threading
+import time
+
+# Submodules #
+from atd import config
+
+SPOOL_NAME = re.compile(r'^([A-Za-z=])([0-9a-f]{5})([0-9a-f]{8})$')
+
+def parse_spool_name(name):
+    """ Parse the name of a file in the spool. Returns a tuple of (queue, id,
+        when), or None if name isn't the name of a job. """
+    match = SPOOL_NAME.match(name)
+    if not match:
+        return None
+
+    return (match.group(1), int(match.group(2), 16),
+        datetime.datetime.fromtimestamp(int(match.group(3), 16) * 60))
+
+def spool_name(queue, id, when):
+    """ The inverse of parse_spool_name(). when is a datetime in local time,
+        and is truncated to the minute. """
+    minutes = int(_timestamp(when)) // 60
+    return '{0}{1:05x}{2:08x}'.format(queue, id, minutes)
+
+def _timestamp(dt):
+    """ datetime.timestamp() for naive local datetimes, Python 2 included. """
+    return time.mktime(dt.timetuple()) + dt.microsecond / 1000000.0
+
+class _Owners(dict):
+    """ uid -> user name, looking up each uid in the password database only
+        once. Unknown uids are shown as a number, like `atq` shows them. """
+    def __missing__(self, uid):
+        try:
+            name = pwd.getpwuid(uid).pw_name
+        except KeyError:
+            name = str(uid)
+        self[uid] = name
+        return name
+
+def read_spool(directory = None, queue = False):
+    """ Return a list of dicts with the keys id, when, queue and who, one for
+        each job in the spool directory (config.atjobs_dir by default), in the
+        same form as AtQueue parses them from `atq`.
+
+        Like `atq`, only root sees everyone's jobs. Raises OSError if the spool
+        can't be read, which is the usual case for non-root users. """
+    return list(iter_spool(directory, queue))
+
+def iter_spool(directory = None, queue = False):
+    """ Like read_spool(), but returns an iterator that stats each file only
+        when it's reached, so the jobs are never all in memory at once. The
+        directory is listed right away, so OSError is raised here. Jobs that
+        are gone by the time they're reached are left out. """
+    return _iter_spool(_scandir(directory or config.atjobs_dir), queue)
+
+def _iter_spool(entries, queue):
+    owners = _Owners()
+    for entry in entries:
+        parsed = parse_spool_name(entry.name)
+        if not parsed: continue # .SEQ, lock files, etc.
+        if queue and parsed[0] != queue: continue
+
+        try:
+            st = entry.stat()
+        except OSError as e:
+            if e.errno == errno.ENOENT: continue # Run or removed since.
+            raise
+        job = _job_from_stat(parsed, st, owners)
+        if job: yield job
+
+def read_spool_entry(name, directory = None, owners = None):
+    """ Like read_spool(), for just the one file name in the spool. Returns
+        None if name isn't a job we can see, or hasn't been fully written yet.
+        Raises OSError if name doesn't exist (any more). """
+    directory = directory or config.atjobs_dir
+    parsed = parse_spool_name(name)
+    if not parsed:
+        return None
+
+    st = os.stat(os.path.join(directory, name))
+    return _job_from_stat(parsed, st, _Owners() if owners is None else owners)
+
+def _job_from_stat(parsed, st, owners):
+    """ Make a job dict from a parsed spool name and the stat of its file, or
+        return None if `atq` wouldn't show it. """
+    job_queue, job_id, when = parsed
+
+    if not stat.S_ISREG(st.st_mode): return None
+    if not st.st_mode & stat.S_IXUSR: return None # Still being written
+    uid = os.getuid()
+    if uid != 0 and st.st_uid != uid: return None
+
+    return dict(id = job_id, when = when, queue = job_queue,
+        who = owners[st.st_uid])
+
+def spool_names(directory = None, queue = False):
+    """ Return a dict of job id -> file name for every file in the spool
+        directory (config.atjobs_dir by default) that's named like a job. This
+        doesn't stat anything, so unlike read_spool() it includes jobs still
+        being written and other users' jobs. Raises OSError if the spool can't
+        be read. """
+    directory = directory or config.atjobs_dir
+    names = dict()
+
+    for name in os.listdir(directory):
+        parsed = parse_spool_name(name)
+        if parsed and not (queue and parsed[0] != queue):
+            names[parsed[1]] = name
+
+    return names
+
+def job_script_paths(directory = None):
+    """ Return a dict of job id -> path of its script, for every job in the
+        spool directory (config.atjobs_dir by default). Raises OSError if the
+        spool can't be read. """
+    directory = directory or config.atjobs_dir
+    return dict((id, os.path.join(directory, name))
+        for id, name in spool_names(directory).items())
+
+ENV_LINE = re.compile(r'^([A-Za-z_][A-Za-z0-9_]*)=(.*); export \1$', re.S)
+CD_LINE = re.compile(r'^cd (.*) \|\| \{$', re.S)
+HEREDOC_LINE = re.compile(r"^\$\{SHELL:-/bin/sh\} << '(.+)'$")
+SHELL_ESCAPE = re.compile(r'\\(.)', re.S)
+
+def parse_job_script(script):
+    """ Parse a job script, as printed by `at -c` or found in the spool, into
+        a dict with the keys command, environment, cwd and umask.
+
+        `at` saves the command inside a shell script that restores the
+        environment and working directory it was submitted from. GNU at wraps
+        the command in a here-document, which lets us get it back exactly; for
+        older versions, and BSD at, everything after the `cd` is the command.
+        environment is a dict, and cwd and umask are None if the script
+        doesn't set them. """
+    if isinstance(script, bytes):
+        script = script.decode("utf-8", "replace")
+
+    lines = script.split('\n')
+    environment = dict()
+    cwd = umask = None
+    command = None
+    i = 0
+
+    while i < len(lines):
+        line = lines[i]
+        i += 1
+
+        if line.startswith('#') or not line:
+            continue
+        elif line.startswith('umask '):
+            umask = int(line[6:], 8)
+            continue
+
+        # Values with newlines in them span more than one line. Older stand-ins
+        # escaped them with \, GNU at quotes them.
+        start = i - 1
+        logical = line
+        while i < len(lines) and (logical.endswith('\\') or
+                (logical.endswith('"') and lines[i].startswith('"'))):
+            logical += '\n' + lines[i]
+            i += 1
+
+        env = ENV_LINE.match(logical)
+        cd = CD_LINE.match(logical)
+        heredoc = HEREDOC_LINE.match(line)
+
+        if env:
+            environment[env.group(1)] = SHELL_ESCAPE.sub(r'\1',
+                env.group(2).replace('"\n"', '\n'))
+        elif cd:
+            cwd = SHELL_ESCAPE.sub(r'\1', cd.group(1))
+            while i < len(lines) and lines[i] != '}':
+                i += 1
+            i += 1
+        elif heredoc:
+            body = lines[i:]
+            end = body.index(heredoc.group(1)) if heredoc.group(1) in body \
+                else len(body)
+            command = '\n'.join(body[:end])
+            break
+        else:
+            command = '\n'.join(lines[start:]).rstrip('\n')
+            break
+
+    return dict(command = command, environment = environment, cwd = cwd,
+        umask = umask)
+
+# Variables GNU at doesn't put in job scripts.
+NO_EXPORT = frozenset(('TERM', 'DISPLAY', '_', 'SHELLOPTS', 'BASH_VERSINFO',
+    'EUID', 'GROUPS', 'PPID', 'UID'))
+ENV_NAME = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+ENV_UNSAFE = re.compile(r'([^A-Za-z0-9%/{[\]=\-_.:,@])')
+CWD_UNSAFE = re.compile(r'([^A-Za-z0-9/])')
+
+def render_job_script(command, environment, cwd, umask, delimiter,
+        send_mail = False):
+    """ The job script GNU at would write for command, run with environment
+        (a dict) and umask in the directory cwd. delimiter ends the
+        here-document holding the command, so it mustn't be a line of it. """
+    lines = ['#!/bin/sh',
+        '# atrun uid={0} gid={1}'.format(os.getuid(), os.getgid()),
+        '# mail {0:>8} {1}'.format(pwd.getpwuid(os.getuid()).pw_name,
+            1 if send_mail else 0),
+        'umask {0:o}'.format(umask)]
+
+    for k, v in sorted(environment.items()):
+        if k in NO_EXPORT or not ENV_NAME.match(k): continue
+        # Like GNU at, newlines are quoted, since \ would swallow them.
+        lines.append('{0}={1}; export {0}'.format(k, '"\n"'.join(
+            ENV_UNSAFE.sub(r'\\\1', part) for part in v.split('\n'))))
+
+    lines.extend(['cd {0} || {{'.format(CWD_UNSAFE.sub(r'\\\1', cwd)),
+        "\t echo 'Execution directory inaccessible' >&2",
+        '\t exit 1',
+        '}',
+        "${{SHELL:-/bin/sh}} << '{0}'".format(delimiter)])
+    if not command.endswith('\n'):
+        command += '\n'
+    return '\n'.join(lines) + '\n' + command + delimiter + '\n'
+
+_umask_lock = threading.Lock()
+
+def _umask():
+    """ Our umask. The only way to read it is to change it, so don't let two
+        threads do that at once. """
+    with _umask_lock:
+        umask = os.umask(0o077)
+        os.umask(umask)
+    return umask
+
+def write_jobs(jobs, directory = None, environment = None, cwd = None):
+    """ Create a job in the spool directory (config.atjobs_dir by default)
+        for each (command, when, queue) tuple in jobs, where when is a
+        datetime, and wake atd once. Returns a list of the new jobs' ids, in
+        the same order.
+
+        If writing a job fails, the exception is raised with the ids of the
+        jobs written before it, which stay in the spool, as its written
+        attribute. atd is woken for those all the same.
+
+        Jobs run in environment (by default config.atjob_environment, or our
+        environment if config.inherit_env) and in cwd (by default our working
+        directory), with our umask, like jobs submitted by `at` from here. """
+    directory = directory or config.atjobs_dir
+    if environment is None:
+        environment = os.environ if config.inherit_env else \
+            config.atjob_environment
+    cwd = cwd or os.getcwd()
+    umask = _umask()
+
+    jobs = list(jobs)
+    ids = _allocate_ids(directory, len(jobs))
+    spare = list()
+    written = 0
+
+    try:
+        for i, (command, when, queue) in enumerate(jobs):
+            delimiter = 'marcinDELIMITER{0}'.format(os.urandom(4).hex())
+            while delimiter in command.split('\n'):
+                delimiter = 'marcinDELIMITER{0}'.format(os.urandom(4).hex())
+            script = render_job_script(command, environment, cwd, umask,
+                delimiter, config.always_send_mail).encode('utf-8')
+
+            while True:
+                try:
+                    _write_job(os.path.join(directory, spool_name(queue,
+                        ids[i], when)), script)
+                    break
+                except OSError as e:
+                    # Job numbers wrap around, so this one may still be in
+                    # use.
+                    if e.errno != errno.EEXIST: raise
+                    if not spare:
+                        spare = _allocate_ids(directory, len(jobs) - i)
+                    ids[i] = spare.pop(0)
+            written += 1
+    except Exception as e:
+        e.written = ids[:written]
+        raise
+    finally:
+        if written:
+            wake_atd()
+    return ids
+
+def _write_job(path, script):
+    """ Write script to path, which mustn't exist, and only then make it
+        executable, so neither atd nor `atq` see it half-written. """
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o400)
+    try:
+        view = memoryview(script)
+        while view:
+            view = view[os.write(fd, view):]
+        os.fchmod(fd, 0o700)
+    except BaseException:
+        os.close(fd)
+        os.unlink(path)
+        raise
+    os.close(fd)
+
+def _allocate_ids(directory, n):
+    """ Take the next n job numbers from directory/.SEQ, holding the lock
+        GNU at holds on directory/.lockfile while it does the same. Numbers
+        wrap around after 0xfffff, and then those still in use are skipped. """
+    lock = os.open(os.path.join(directory, '.lockfile'),
+        os.O_WRONLY | os.O_CREAT, 0o600)
+    try:
+        fcntl.lockf(lock, fcntl.LOCK_EX)
+        with open(os.path.join(directory, '.SEQ'), 'a+') as seq:
+            seq.seek(0)
+            last = seq.read().strip()
+            last = int(last, 16) if last else 0
+            ids = list()
+            taken = ()
+            while len(ids) < n:
+                last = last % 0xfffff + 1
+                if last == 1:
+                    taken = spool_names(directory)
+                if last not in taken:
+                    ids.append(last)
+            seq.seek(0)
+            seq.truncate()
+            seq.write('{0:05x}\n'.format(last))
+        return ids
+    finally:
+        os.close(lock) # Releases the lock.
+
+def wake_atd(pid_file = None):
+    """ Tell atd to look at the spool again, like `at` does after adding a
+        job, by sending SIGHUP to the pid in pid_file (config.atd_pid_file by
+        default). Returns False if atd couldn't be woken, in which case it
+        notices the new jobs next time it wakes up by itself. """
+    try:
+        with open(pid_file or config.atd_pid_file) as f:
+            os.kill(int(f.read().strip()), signal.SIGHUP)
+    except (IOError, OSError, ValueError):
+        return False
+    return True
+
+def _scandir(directory):
+    """ os.scandir() where it exists, and a slower stand-in elsewhere. """
+    if hasattr(os, 'scandir'):
+        return list(os.scandir(directory))
+    return [_DirEntry(directory, name) for name in os.listdir(directory)]
+
+class _DirEntry(object):
+    def __init__(self, directory, name):
+        self.name = name
+        self.path = os.path.join(directory, name)
+
+    def stat(self):
+        return os.stat(self.path)
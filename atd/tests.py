@@ -12,9 +12,94 @@
 ################################################################################
 
 from __future__ import absolute_import
-from atd import atd, atq
+from atd import atd, atq, spool, aio, watch, benchmarks, registry, metrics
+from atd import admission
+from atd import coalesce, completion, engine, leveling, reconcile, spawn
+from atd import timespec
+from atd import __main__ as cli
+from atd.benchmarks import fake
+import asyncio
+import io
 import unittest
 import datetime
+import json
+import os
+import shutil
+import signal
+import subprocess
+import tempfile
+import time
+import pwd
+from subprocess import CalledProcessError
+from unittest import mock
+
+FIXTURE_SPOOL = os.path.join(os.path.dirname(__file__), 'testdata', 'atjobs')
+
+# A stand-in for `at` that never touches the real queue. It reports the last
+# word of the command it's given as the new job's id, and fails on "fail". Its
+# `at -c` prints a two line job that echoes the job's id.
+FAKE_AT = '''#!/bin/sh
+if [ "$1" = "-c" ]; then
+    echo run >> "$0.log"
+    cat <<EOF
+#!/bin/sh
+umask 22
+JOB=$2; export JOB
+cd /tmp || {
+	 echo 'Execution directory inaccessible' >&2
+	 exit 1
+}
+\\${SHELL:-/bin/sh} << 'marcinDELIMITER0'
+echo $2
+echo done
+marcinDELIMITER0
+EOF
+    exit 0
+fi
+read cmd
+case "$cmd" in
+    *fail*) echo "Garbled time" >&2; exit 1;;
+esac
+echo "warning: commands will be executed using /bin/sh" >&2
+echo "job ${cmd##* } at Thu Jan  1 00:00:00 2037" >&2
+'''
+
+# A stand-in for `atq` that lists a fixed queue, and logs each time it's run.
+FAKE_ATQ = '''#!/bin/sh
+echo run >> "$0.log"
+printf '1\tThu Jan  1 00:00:00 2037 a nobody\n'
+printf '2\tFri Jan  2 12:30:00 2037 Q nobody\n'
+'''
+
+class FakeAtTestCase(unittest.TestCase):
+    """ Points config.at_binary and config.atq_binary at FAKE_AT and FAKE_ATQ
+        for the duration of a test. """
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.real_binaries = (atd.config.at_binary, atd.config.atq_binary)
+        atd.config.at_binary = self._install('at', FAKE_AT)
+        atd.config.atq_binary = self._install('atq', FAKE_ATQ)
+        atq.snapshot_cache.invalidate()
+
+    def tearDown(self):
+        atd.config.at_binary, atd.config.atq_binary = self.real_binaries
+        atq.snapshot_cache.invalidate()
+        shutil.rmtree(self.tmpdir)
+
+    def _install(self, name, script):
+        fake = os.path.join(self.tmpdir, name)
+        with open(fake, 'w') as f:
+            f.write(script)
+        os.chmod(fake, 0o755)
+        return fake
+
+    def atq_runs(self, binary = None):
+        """ How many times FAKE_ATQ (or FAKE_AT's -c) has been run so far. """
+        try:
+            with open((binary or atd.config.atq_binary) + '.log') as f:
+                return len(f.readlines())
+        except IOError:
+            return 0
 
 class TimeConversionTests(unittest.TestCase):
     def test_datetime(self):
@@ -37,6 +122,57 @@ class TimeConversionTests(unittest.TestCase):
 
         print("Success: Timedelta conversion")
 
+class TimespecTests(FakeAtTestCase):
+    now = datetime.datetime(2037, 1, 31, 15, 30, 20)
+
+    def assertResolves(self, spec, *when):
+        self.assertEqual(timespec.resolve(spec, self.now),
+            datetime.datetime(*when))
+
+    def test_times(self):
+        self.assertResolves('now', 2037, 1, 31, 15, 30)
+        self.assertResolves('NOW + 5 Minutes', 2037, 1, 31, 15, 35)
+        self.assertResolves('teatime', 2037, 1, 31, 16, 0)
+        self.assertResolves('noon', 2037, 2, 1, 12, 0) # Passed, so tomorrow
+        self.assertResolves('midnight', 2037, 2, 1, 0, 0)
+        self.assertResolves('10:00 am', 2037, 2, 1, 10, 0)
+        self.assertResolves('12am', 2037, 2, 1, 0, 0)
+        self.assertResolves('4pm + 3 days', 2037, 2, 3, 16, 0)
+        self.assertResolves('1745', 2037, 1, 31, 17, 45)
+        self.assertResolves('9 am next day', 2037, 2, 2, 9, 0)
+
+    def test_dates(self):
+        self.assertResolves('teatime tomorrow', 2037, 2, 1, 16, 0)
+        self.assertResolves('10:00 today', 2037, 1, 31, 10, 0)
+        self.assertResolves('friday', 2037, 2, 6, 15, 30)
+        self.assertResolves('Jan 1', 2038, 1, 1, 15, 30) # Passed this year
+        self.assertResolves('noon dec 25, 2038', 2038, 12, 25, 12, 0)
+        self.assertResolves('25 December 2038', 2038, 12, 25, 15, 30)
+        self.assertResolves('12/25/38', 2038, 12, 25, 15, 30)
+        self.assertResolves('25.12.2038', 2038, 12, 25, 15, 30)
+        self.assertResolves('2038-12-25', 2038, 12, 25, 15, 30)
+        self.assertResolves('12252038', 2038, 12, 25, 15, 30)
+        self.assertResolves('now + 1 month', 2037, 3, 3, 15, 30) # Like mktime
+
+    def test_invalid(self):
+        for spec in ('', 'whenever', 'teatime teatime', '25:00', '13pm',
+                'Feb 30 2038', 'now + 2 fortnights', 'now +', '12/25',
+                'now; reboot'):
+            self.assertRaises(ValueError, timespec.resolve, spec, self.now)
+
+    def test_memo(self):
+        self.assertIs(timespec.parse('noon tomorrow'),
+            timespec.parse('noon tomorrow'))
+
+    def test_at_validates(self):
+        self.assertRaises(ValueError, atd.at, 'echo', 'noon yesterday')
+        self.assertRaises(ValueError, atd.at, 'echo', 'now - 1 hour')
+        self.assertEqual(self.atq_runs(atd.config.at_binary), 0)
+
+        job = atd.at('echo 3', 'now')
+        self.assertLessEqual(job.when, datetime.datetime.now())
+        self.assertEqual(job.when.second, 0)
+
 class QueueTests(unittest.TestCase):
     def test_at_queue_validity(self):
         valid = atq._validate_queue
@@ -67,7 +203,7 @@ class QueueTests(unittest.TestCase):
 
         self.assertEqual(len(atq.jobs), len(atq2.jobs))
         self.assertEqual(len(atq.jobs), 5)
-        self.assertEqual(atq2.jobs[0].command.decode("utf-8"), 'echo')
+        self.assertEqual(atq2.jobs[0].command, 'echo')
 
         atd.clear('Q')
         atd.clear('U')
@@ -112,6 +248,1320 @@ class ScheduleTests(unittest.TestCase):
 
         print("Success: Deleted our job")
 
+class AtManyTests(FakeAtTestCase):
+    def test_at_many_order(self):
+        jobs = [("echo {0}".format(i), "now + 24 hours", 'Q')
+            for i in range(1, 50)]
+
+        results = list(atd.at_many(jobs, workers = 4))
+
+        self.assertEqual([job.id for job in results], list(range(1, 50)))
+        self.assertEqual(results[0].command, "echo 1")
+        self.assertEqual(results[0].queue, 'Q')
+
+    def test_at_many_failures(self):
+        jobs = [("echo 1", "now + 24 hours"),
+                ("echo fail", "now + 24 hours"),
+                ("echo 3", "now + 24 hours", '!'),
+                ("echo 4", datetime.timedelta(days = -1)),
+                ("echo 5", "now + 24 hours")]
+
+        results = list(atd.at_many(jobs, workers = 2))
+
+        self.assertEqual(results[0].id, 1)
+        self.assertIsInstance(results[1], CalledProcessError)
+        self.assertEqual(results[1].stderr, b'Garbled time\n')
+        self.assertIsInstance(results[2], ValueError)
+        self.assertIsInstance(results[3], ValueError)
+        self.assertEqual(results[4].id, 5)
+
+# A stand-in for `at -r` that logs its arguments, and can't find job 2.
+FAKE_ATRM = '''#!/bin/sh
+shift
+echo "$@" >> "$0.log"
+status=0
+for id; do
+    if [ "$id" = 2 ]; then echo "Cannot find jobid 2" >&2; status=1; fi
+done
+exit $status
+'''
+
+class CancelTests(FakeAtTestCase):
+    def setUp(self):
+        super(CancelTests, self).setUp()
+        atd.config.at_binary = self._install('atrm', FAKE_ATRM)
+
+    def atrm_calls(self):
+        with open(atd.config.at_binary + '.log') as f:
+            return [line.split() for line in f]
+
+    def test_chunks(self):
+        ids = list(range(1, 1001))
+        chunks = atd._chunk_ids(['at', '-r'], ids, limit = 2000)
+
+        self.assertEqual(sum(chunks, []), ids)
+        self.assertGreater(len(chunks), 1)
+        for chunk in chunks:
+            self.assertLessEqual(sum(len(str(id)) + 9 for id in chunk), 2000)
+        self.assertEqual(atd._chunk_ids(['at', '-r'], ids, 300),
+            [ids[0:300], ids[300:600], ids[600:900], ids[900:]])
+
+    def test_atrm_where(self):
+        report = atd.atrm_where(lambda job: job.queue == 'Q')
+
+        self.assertEqual(self.atrm_calls(), [['2']])
+        self.assertFalse(report)
+        self.assertEqual(report.canceled, [])
+        self.assertEqual(report.failed, {2: 'Cannot find jobid 2'})
+
+        report = atd.atrm_where(before = datetime.datetime(2037, 1, 2))
+        self.assertTrue(report)
+        self.assertEqual(report, {1: None})
+
+        self.assertEqual(atd.atrm_where(after = datetime.datetime(2038, 1, 1)),
+            {})
+        self.assertEqual(atd.atrm_where(lambda job: job.queue == 'a').canceled,
+            [1])
+
+    def test_clear(self):
+        report = atd.clear(workers = 2)
+
+        self.assertEqual(sorted(self.atrm_calls()), [['1'], ['2']])
+        self.assertEqual(report, {1: None, 2: 'Cannot find jobid 2'})
+
+    def test_async_clear(self):
+        report = asyncio.run(aio.clear(workers = 2))
+
+        self.assertIsInstance(report, atd.CancelReport)
+        self.assertEqual(sorted(self.atrm_calls()), [['1'], ['2']])
+        self.assertEqual(report, {1: None, 2: 'Cannot find jobid 2'})
+
+    def test_async_atrm_chunks(self):
+        jobs = [atd.AtJob(id) for id in range(3, 1003)]
+        with mock.patch.object(atd, '_arg_max', return_value = 2000):
+            self.assertTrue(asyncio.run(aio.atrm(*jobs)))
+
+            calls = self.atrm_calls()
+            self.assertGreater(len(calls), 1)
+            self.assertEqual(sorted(int(id) for call in calls for id in call),
+                list(range(3, 1003)))
+
+            with self.assertRaises(CalledProcessError) as raised:
+                asyncio.run(aio.atrm(*[atd.AtJob(id) for id in (1, 2)]))
+            self.assertEqual(raised.exception.cmd[2:], ['2'])
+
+class SnapshotCacheTests(FakeAtTestCase):
+    def test_lazy_lookups_share_snapshot(self):
+        hits, misses = atq.snapshot_cache.hits, atq.snapshot_cache.misses
+
+        for i in range(100):
+            job = atd.AtJob(2)
+            self.assertEqual(job.when, datetime.datetime(2037, 1, 2, 12, 30))
+            self.assertEqual(job.queue, 'Q')
+            self.assertEqual(job.who, 'nobody')
+
+        self.assertEqual(self.atq_runs(), 1)
+        self.assertEqual(atq.snapshot_cache.misses - misses, 1)
+        self.assertEqual(atq.snapshot_cache.hits - hits, 99)
+
+    def test_mutation_invalidates(self):
+        atd.AtJob(1).when
+        atd.at("echo 3", "now + 24 hours")
+        atd.AtJob(1).when
+
+        self.assertEqual(self.atq_runs(), 2)
+
+    def test_ttl(self):
+        cache = atq.SnapshotCache(ttl = 0)
+        cache.find_job_by_id(1)
+        cache.find_job_by_id(1)
+
+        self.assertEqual(cache.misses, 2)
+        self.assertRaises(ValueError, cache.find_job_by_id, 3)
+
+class FixtureSpoolTestCase(FakeAtTestCase):
+    """ Also points config.atjobs_dir at FIXTURE_SPOOL. """
+    def setUp(self):
+        super(FixtureSpoolTestCase, self).setUp()
+        self.real_atjobs_dir = atd.config.atjobs_dir
+        atd.config.atjobs_dir = FIXTURE_SPOOL
+
+    def tearDown(self):
+        atd.config.atjobs_dir = self.real_atjobs_dir
+        super(FixtureSpoolTestCase, self).tearDown()
+
+class StandInTestCase(unittest.TestCase):
+    """ Points atd.config at the benchmarks' stand-ins for `at` and `atq`
+        (see benchmarks.stand_ins()), with jobs jobs already in their spool,
+        for the duration of a test. self.paths is what stand_ins() gives, and
+        self.spool the spool directory. The config settings named in restore
+        are put back afterwards. It's all undone with addCleanup(), so even
+        when a subclass's setUp() fails part way through. """
+    jobs = 0
+    restore = ()
+
+    def setUp(self):
+        for k in self.restore:
+            self.addCleanup(setattr, atd.config, k, getattr(atd.config, k))
+        stand_ins = benchmarks.stand_ins('gnu', self.jobs)
+        self.paths = stand_ins.__enter__()
+        self.addCleanup(stand_ins.__exit__, None, None, None)
+        self.spool = self.paths['atjobs_dir']
+
+class SpoolTests(FixtureSpoolTestCase):
+    def test_spool_names(self):
+        self.assertIsNone(spool.parse_spool_name('.SEQ'))
+        queue, id, when = spool.parse_spool_name('a000010219b700')
+
+        self.assertEqual((queue, id), ('a', 1))
+        self.assertEqual(when, datetime.datetime.fromtimestamp(2114380800))
+        self.assertEqual(spool.spool_name(queue, id, when), 'a000010219b700')
+
+    def test_spool_backend(self):
+        q = atd.AtQueue(backend = 'spool')
+        jobs = sorted(q.jobs, key = lambda job: job.id)
+
+        self.assertEqual(q.source, 'spool')
+        self.assertEqual(self.atq_runs(), 0)
+        # Job 4 isn't executable yet, so `at` is still writing it.
+        self.assertEqual([job.id for job in jobs], [1, 2, 3])
+        self.assertEqual([job.queue for job in jobs], ['a', 'Q', '='])
+        self.assertEqual(jobs[1].when,
+            datetime.datetime.fromtimestamp(2114380800 + 86400 + 45000))
+        owner = os.stat(os.path.join(FIXTURE_SPOOL, 'a000010219b700')).st_uid
+        self.assertEqual(jobs[0].who, pwd.getpwuid(owner).pw_name)
+
+        self.assertEqual([job.id for job in atd.AtQueue('Q', 'spool').jobs],
+            [2])
+
+    def test_vanished_job(self):
+        # atd ran (and removed) job 5 between listing the spool and its stat.
+        entries = spool._scandir(FIXTURE_SPOOL) + [spool._DirEntry(
+            self.tmpdir, 'a000050219b700')]
+        with mock.patch.object(spool, '_scandir', return_value = entries):
+            self.assertEqual(sorted(job['id'] for job in spool.read_spool()),
+                [1, 2, 3])
+
+    def test_spool_fallback(self):
+        atd.config.atjobs_dir = os.path.join(self.tmpdir, 'nonexistent')
+        q = atd.AtQueue(backend = 'spool')
+
+        self.assertEqual(q.source, 'atq')
+        self.assertEqual(self.atq_runs(), 1)
+        self.assertEqual(len(q.jobs), 2)
+
+class IndexTests(FixtureSpoolTestCase):
+    def test_queries(self):
+        q = atd.AtQueue(backend = 'spool')
+        epoch = datetime.datetime.fromtimestamp
+
+        self.assertEqual(q.find_job_by_id(2).queue, 'Q')
+        self.assertEqual(q.find_job_by_id('2').queue, 'Q')
+        self.assertRaises(ValueError, q.find_job_by_id, 4)
+
+        self.assertEqual([job.id for job in q.in_queue('Q')], [2])
+        self.assertEqual(q.in_queue('z'), [])
+        self.assertEqual(len(q.owned_by(q.jobs[0].who)), 3)
+        self.assertEqual(q.owned_by('no such user'), [])
+
+        self.assertEqual([job.id for job in q.due_between(epoch(0),
+            epoch(2114380800))], [3])
+        self.assertEqual([job.id for job in q.due_between(epoch(2114380800),
+            epoch(2114380800 * 2))], [1, 2])
+        self.assertEqual([job.id for job in q.next_due(5,
+            epoch(2114380800 - 60))], [1, 2])
+        self.assertEqual([job.id for job in q.next_due(now = epoch(0))], [3])
+
+class AtqParserTests(FakeAtTestCase):
+    def test_fast_dates(self):
+        q = atd.AtQueue()
+        line = '7\tSat Feb  7 09:05:03 2037 b nobody'
+        bsd_line = 'Sat Feb 7 09:05:03 UTC 2037\tnobody\t\tb\t7'
+        expected = dict(id = 7, queue = 'b', who = 'nobody',
+            when = datetime.datetime.strptime(' '.join(line.split()[1:6]),
+            atq.AT_OUTPUT_DATETIME_FORMAT))
+
+        self.assertEqual(q._atq_line(line), expected)
+        self.assertEqual(q._atq_line(line), expected) # Memoized
+        self.assertEqual(q._atq_bsd_line(bsd_line), expected)
+
+    def test_iter_jobs(self):
+        q = atd.AtQueue()
+        jobs = list(q.iter_jobs())
+
+        self.assertEqual([job['id'] for job in jobs], [1, 2])
+        self.assertEqual(jobs[1]['when'],
+            datetime.datetime(2037, 1, 2, 12, 30))
+        self.assertEqual(q._parse_atq(q.raw), jobs)
+        self.assertFalse(q.bsd)
+
+        atd.config.atq_binary = self._install('bsd_atq', '#!/bin/sh\n'
+            'printf "Date\\t\\t\\t\\tOwner\\t\\tQueue\\tJob#\\n"\n'
+            'printf "Fri Jan 2 12:30:00 UTC 2037\\tnobody\\t\\tQ\\t2\\n"\n')
+        q = atd.AtQueue()
+
+        self.assertTrue(q.bsd)
+        self.assertEqual(q.jobs, [atd.AtJob(2)])
+        self.assertEqual(q.jobs[0].when, jobs[1]['when'])
+
+    def test_iter_jobs_failure(self):
+        atd.config.atq_binary = self._install('bad_atq', '#!/bin/sh\nexit 1\n')
+
+        self.assertRaises(CalledProcessError, atd.AtQueue)
+
+class RegistryTests(FakeAtTestCase):
+    def setUp(self):
+        super(RegistryTests, self).setUp()
+        atd.config.registry_path = os.path.join(self.tmpdir, 'registry.db')
+
+    def tearDown(self):
+        registry.get_registry().close()
+        atd.config.registry_path = None
+        super(RegistryTests, self).tearDown()
+
+    def test_lookups(self):
+        when = datetime.datetime(2037, 1, 1)
+        atd.at("echo 1", when, 'a', tags = ['nightly', 'billing'])
+        atd.at("echo 7", "noon tomorrow", 'b', tags = ['nightly'])
+
+        self.assertEqual(atd.AtJob(1).command, "echo 1")
+        self.assertEqual(atd.AtJob(1).when, when)
+        self.assertEqual(atd.AtJob(7).queue, 'b')
+        self.assertEqual(self.atq_runs(atd.config.at_binary), 0)
+        self.assertEqual(self.atq_runs(), 0)
+
+        recorded = registry.get_registry().get(1)
+        self.assertEqual(recorded['tags'], ['billing', 'nightly'])
+        self.assertEqual(registry.get_registry().tagged('nightly'), [1, 7])
+
+        # Job 7's timespec was resolved, so its when is recorded too.
+        self.assertEqual(atd.AtJob(7).when, timespec.resolve('noon tomorrow'))
+        self.assertEqual(self.atq_runs(), 0)
+
+        # Only job 1 is in the queue `atq` lists.
+        self.assertEqual(atd.AtQueue().tagged('nightly'), [atd.AtJob(1)])
+        self.assertEqual(atd.AtQueue().tagged('nothing'), [])
+
+    def test_reconcile(self):
+        atd.at("echo 1", datetime.datetime(2037, 1, 1))
+        atd.at("echo 2", datetime.datetime(2037, 1, 2))
+        atd.at("echo 7", datetime.datetime(2037, 1, 7))
+
+        # Job 2 is due at a different time in `atq`, so its id was reused.
+        self.assertEqual(sorted(registry.get_registry().reconcile()), [2, 7])
+        self.assertIsNotNone(registry.get_registry().get(1))
+        self.assertIsNone(registry.get_registry().get(2))
+
+    def test_atrm_forgets(self):
+        atd.at("echo 1", datetime.datetime(2037, 1, 1))
+        atd.config.at_binary = self._install('atrm', '#!/bin/sh\nexit 0\n')
+
+        self.assertTrue(atd.atrm(atd.AtJob(1)))
+        self.assertIsNone(registry.get_registry().get(1))
+
+class MetricsTests(FakeAtTestCase):
+    def setUp(self):
+        super(MetricsTests, self).setUp()
+        self.events = []
+        self.collector = metrics.Collector()
+        metrics.add_observer(self.events.append)
+        metrics.add_observer(self.collector)
+
+    def tearDown(self):
+        metrics.remove_observer(self.events.append)
+        metrics.remove_observer(self.collector)
+        super(MetricsTests, self).tearDown()
+
+    def test_events(self):
+        atd.at("echo 5", "now + 24 hours")
+        atd.AtJob(1).when
+        atd.AtJob(2).queue
+        atd.AtJob(1).command
+
+        self.assertEqual([(event['event'], event.get('kind')) for event in
+            self.events if event['event'] in (metrics.SUBPROCESS,
+            metrics.PARSE)], [(metrics.SUBPROCESS, 'at'),
+            (metrics.PARSE, 'atq'), (metrics.SUBPROCESS, 'atq'),
+            (metrics.SUBPROCESS, 'at -c')])
+        self.assertEqual(self.events[0]['returncode'], 0)
+        self.assertGreater(self.events[0]['output_bytes'], 0)
+
+        stats = self.collector.as_dict()
+        self.assertEqual(stats['subprocess_seconds']['atq']['count'], 1)
+        self.assertEqual(stats['parsed_jobs'], {'atq': 2})
+        self.assertEqual(stats['cache_lookups'],
+            {'snapshot miss': 1, 'snapshot hit': 1})
+        self.assertEqual(stats['lazy_loads'], {'when atq': 1, 'queue atq': 1,
+            'command at -c': 1})
+        self.assertEqual(stats['subprocess_failures'], {})
+
+    def test_failures(self):
+        atd.config.atq_binary = self._install('bad_atq', '#!/bin/sh\nexit 3\n')
+        self.assertRaises(CalledProcessError, atd.AtQueue)
+
+        self.assertEqual(self.events[-1]['returncode'], 3)
+        self.assertEqual(self.events[-1]['error'], 'CalledProcessError')
+        self.assertEqual(self.collector.as_dict()['subprocess_failures'],
+            {'bad_atq': 1})
+
+    def test_prometheus(self):
+        atd.AtQueue()
+        text = self.collector.prometheus()
+
+        self.assertIn('# TYPE atd_subprocess_seconds histogram\n', text)
+        self.assertIn('atd_subprocess_seconds_count{kind="atq"} 1\n', text)
+        self.assertIn('atd_subprocess_seconds_bucket{kind="atq",le="+Inf"} 1'
+            '\n', text)
+        self.assertIn('atd_parsed_jobs_total{kind="atq"} 2\n', text)
+
+        self.collector.reset()
+        self.assertNotIn('kind="atq"', self.collector.prometheus())
+
+class SpawnTests(FakeAtTestCase):
+    def tearDown(self):
+        atd.config.spawn_backend = 'popen'
+        spawn.get_pool().close()
+        super(SpawnTests, self).tearDown()
+
+    def test_backends(self):
+        big = b'x' * 300000 # More than fits in a pipe.
+        for backend in spawn.BACKENDS:
+            self.assertEqual(spawn.run(['cat'], big, backend = backend),
+                (0, big, b''))
+            self.assertEqual(spawn.run(['sh', '-c', 'echo $FOO >&2; exit 3'],
+                env = dict(FOO = 'bar'), backend = backend), (3, b'', b'bar\n'))
+            self.assertEqual(spawn.check_output(['pwd'], backend = backend),
+                (os.getcwd() + '\n').encode())
+            self.assertRaises(OSError, spawn.run,
+                [os.path.join(self.tmpdir, 'nonexistent')], backend = backend)
+            self.assertRaises(CalledProcessError, spawn.check_output,
+                ['false'], backend = backend)
+
+    def test_signaled(self):
+        for backend in ('popen', 'posix_spawn'):
+            self.assertEqual(spawn.run(['sh', '-c', 'kill -9 $$'],
+                backend = backend)[0], -9)
+        self.assertEqual(spawn._exitcode(3 << 8), 3)
+
+    def test_api(self):
+        atd.config.spawn_backend = 'helper'
+        job = atd.at("echo 5", "now + 24 hours")
+        q = atd.AtQueue()
+
+        self.assertEqual(job.id, 5)
+        self.assertEqual([job.id for job in q.jobs], [1, 2])
+        self.assertEqual(atd.AtJob(2).command, "echo 2\necho done")
+        self.assertRaises(ValueError, spawn.run, ['true'], backend = 'fork')
+
+    def test_pool(self):
+        pool = spawn.HelperPool(2)
+        try:
+            results = list(atd.ThreadPoolExecutor(4).map(lambda i:
+                pool.run(['echo', str(i)]), range(20)))
+            self.assertEqual(results, [(0, '{0}\n'.format(i).encode(), b'')
+                for i in range(20)])
+            self.assertLessEqual(pool._started, 2)
+        finally:
+            pool.close()
+
+class CompactTests(FixtureSpoolTestCase):
+    def test_compact_jobs(self):
+        q = atd.AtQueue(backend = 'spool')
+        compact = atd.AtQueue(backend = 'spool', compact = True)
+
+        self.assertIsInstance(compact.jobs, atq.JobColumns)
+        self.assertEqual(len(compact.jobs), 3)
+        self.assertEqual(compact.jobs, q.jobs)
+        for job, view in zip(q.jobs, compact.jobs):
+            self.assertEqual((view.id, view.when, view.queue, view.who),
+                (job.id, job.when, job.queue, job.who))
+        self.assertEqual(compact.jobs[-1].id, q.jobs[-1].id)
+        self.assertEqual([job.id for job in compact.jobs[1:]],
+            [job.id for job in q.jobs[1:]])
+        self.assertEqual(atd.AtQueue('z', 'spool', compact = True).jobs, [])
+
+    def test_compact_jobs_read_only(self):
+        compact = atd.AtQueue(backend = 'spool', compact = True)
+        job = compact.jobs[0]
+
+        self.assertRaises(TypeError, compact.jobs.append, job)
+        self.assertRaises(TypeError, compact.jobs.remove, job)
+        self.assertRaises(TypeError, compact.jobs.sort)
+        with self.assertRaises(TypeError):
+            compact.jobs[0:1] = []
+        with self.assertRaises(TypeError):
+            del compact.jobs[0]
+        self.assertEqual(len(compact.jobs), 3)
+
+        jobs = list(compact.jobs)
+        jobs.remove(job)
+        self.assertEqual(len(jobs), 2)
+
+    def test_compact_queries(self):
+        q = atd.AtQueue(backend = 'spool')
+        compact = atd.AtQueue(backend = 'spool', compact = True)
+        epoch = datetime.datetime.fromtimestamp
+
+        self.assertEqual(compact.find_job_by_id('2').queue, 'Q')
+        self.assertRaises(ValueError, compact.find_job_by_id, 4)
+        self.assertEqual(compact.in_queue('Q'), q.in_queue('Q'))
+        self.assertEqual(compact.owned_by(q.jobs[0].who),
+            q.owned_by(q.jobs[0].who))
+        self.assertEqual(compact.owned_by('no such user'), [])
+        self.assertEqual(compact.due_between(epoch(0), epoch(2114380800 * 2)),
+            q.due_between(epoch(0), epoch(2114380800 * 2)))
+        self.assertEqual(compact.next_due(5, epoch(2114380800 - 60)),
+            q.next_due(5, epoch(2114380800 - 60)))
+
+    def test_compact_commands(self):
+        compact = atd.AtQueue(backend = 'spool', compact = True)
+
+        self.assertEqual(compact.load_commands(), [])
+        self.assertEqual(len(compact.jobs.scripts), 3)
+        self.assertEqual(compact.find_job_by_id(1).command,
+            'echo hello')
+        self.assertEqual(self.atq_runs(), 0)
+        job = json.loads(repr(compact.find_job_by_id(1)))
+        self.assertEqual((job['id'], job['command']), (1, 'echo hello'))
+
+    def test_compact_update(self):
+        spooldir = os.path.join(self.tmpdir, 'atjobs')
+        shutil.copytree(FIXTURE_SPOOL, spooldir)
+        atd.config.atjobs_dir = spooldir
+        q = atd.AtQueue(backend = 'spool', compact = True)
+
+        os.remove(os.path.join(spooldir, 'a000010219b700'))
+        os.chmod(os.path.join(spooldir, 'b000040219b70a'), 0o700)
+        events = q.update()
+
+        self.assertEqual(sorted((event, job.id) for event, job in events),
+            [(atq.JOB_ADDED, 4), (atq.JOB_REMOVED, 1)])
+        self.assertEqual(sorted(job.id for job in q.jobs), [2, 3, 4])
+
+class WatchTests(FakeAtTestCase):
+    def setUp(self):
+        super(WatchTests, self).setUp()
+        self.spool = os.path.join(self.tmpdir, 'atjobs')
+        shutil.copytree(FIXTURE_SPOOL, self.spool)
+        self.real_atjobs_dir = atd.config.atjobs_dir
+        atd.config.atjobs_dir = self.spool
+
+    def tearDown(self):
+        atd.config.atjobs_dir = self.real_atjobs_dir
+        super(WatchTests, self).tearDown()
+
+    def add_job(self, queue, id, when, mode = 0o700):
+        name = os.path.join(self.spool, spool.spool_name(queue, id, when))
+        open(name, 'w').close()
+        os.chmod(name, mode)
+        return name
+
+    def test_update(self):
+        q = atd.AtQueue(backend = 'spool')
+        self.assertEqual(q.update(), [])
+
+        future = datetime.datetime(2037, 6, 1, 12, 0)
+        self.add_job('c', 10, future)
+        pending = self.add_job('c', 11, future, 0o600)
+        os.remove(os.path.join(self.spool, 'a000010219b700'))
+        os.rename(os.path.join(self.spool, 'Q000020219bf8e'),
+            os.path.join(self.spool, '=000020219bf8e'))
+
+        events = sorted((event, job.id) for event, job in q.update())
+        self.assertEqual(events, [(atq.JOB_ADDED, 10),
+            (atq.JOB_EXECUTED, 2), (atq.JOB_REMOVED, 1)])
+        self.assertEqual(q.find_job_by_id(2).queue, '=')
+        self.assertEqual([job.id for job in q.in_queue('=')], [3, 2])
+        self.assertEqual([job.id for job in q.due_between(future,
+            future + datetime.timedelta(minutes = 1))], [10])
+        self.assertEqual(self.atq_runs(), 0)
+
+        # `at` finishes writing job 11.
+        os.chmod(pending, 0o700)
+        self.assertEqual([(event, job.id) for event, job in q.update()],
+            [(atq.JOB_ADDED, 11)])
+        self.assertEqual(sorted(job.id for job in q.jobs),
+            sorted(job.id for job in atd.AtQueue(backend = 'spool').jobs))
+
+    def test_watch(self):
+        events = watch.watch(atd.AtQueue(backend = 'spool'))
+        self.add_job('c', 10, datetime.datetime(2037, 6, 1, 12, 0))
+
+        event, job = next(events)
+        self.assertEqual((event, job.id), (atq.JOB_ADDED, 10))
+
+        os.remove(os.path.join(self.spool, 'a000010219b700'))
+        event, job = next(events)
+        self.assertEqual((event, job.id), (atq.JOB_REMOVED, 1))
+        events.close()
+
+    def test_awatch_slow_consumer(self):
+        if not watch.SpoolWatcher().inotify:
+            self.skipTest('inotify isn\'t available')
+        real_set = asyncio.Event.set
+        sets = []
+        def counting_set(event):
+            sets.append(1)
+            real_set(event)
+
+        async def consume():
+            events = aio.awatch(atd.AtQueue(backend = 'spool'))
+            future = datetime.datetime(2037, 6, 1, 12, 0)
+            first = asyncio.ensure_future(events.__anext__())
+            await asyncio.sleep(0.1)
+            self.add_job('c', 10, future)
+            event, job = await asyncio.wait_for(first, 5)
+
+            # Hold on to the event while the spool changes again.
+            self.add_job('c', 11, future)
+            await asyncio.sleep(0.3)
+            held = len(sets)
+            event, job = await asyncio.wait_for(events.__anext__(), 5)
+            await events.aclose()
+            return held, job.id
+
+        with mock.patch.object(asyncio.Event, 'set', counting_set):
+            held, id = asyncio.run(consume())
+        self.assertEqual(id, 11)
+        self.assertLess(held, 10)
+
+    def test_polling_watcher(self):
+        watcher = watch.SpoolWatcher(poll_interval = 0.01,
+            use_inotify = False)
+
+        self.assertFalse(watcher.inotify)
+        self.assertFalse(watcher.wait(0.05))
+        self.add_job('c', 10, datetime.datetime(2037, 6, 1, 12, 0))
+        os.utime(self.spool, (0, 0))
+        self.assertTrue(watcher.wait(1))
+        self.assertFalse(watcher.changed())
+
+class SpoolWriterTests(StandInTestCase):
+    jobs = 3
+    restore = ('at_backend', 'atd_pid_file')
+
+    def setUp(self):
+        super(SpoolWriterTests, self).setUp()
+        atd.config.atd_pid_file = os.path.join(self.spool, 'atd.pid')
+        with open(atd.config.atd_pid_file, 'w') as f:
+            f.write('{0}\n'.format(os.getpid()))
+
+        self.wakes = 0
+        def woken(signum, frame):
+            self.wakes += 1
+        self.addCleanup(signal.signal, signal.SIGHUP,
+            signal.signal(signal.SIGHUP, woken))
+
+    def test_same_as_at(self):
+        command = "echo 'hi there'\necho $HOME\n"
+        when = datetime.datetime(2037, 3, 1, 12, 0)
+        by_at = atd.at(command, when, 'Q')
+        atd.config.at_backend = 'spool'
+        by_writer = atd.at(command, when, 'Q')
+
+        self.assertEqual(by_writer.id, by_at.id + 1)
+        self.assertEqual(self.wakes, 1)
+        scripts = [spool.parse_job_script(spawn.check_output(
+            [atd.config.at_binary, '-c', str(id)]))
+            for id in (by_at.id, by_writer.id)]
+        self.assertEqual(scripts[1]['command'], command.rstrip('\n'))
+        # Python's locale coercion adds this to the stand-in's environment.
+        scripts[0]['environment'].pop('LC_CTYPE', None)
+        self.assertEqual(scripts[0], scripts[1])
+
+        q = atd.AtQueue('Q')
+        self.assertEqual([(job.id, job.when) for job in q.jobs],
+            [(by_at.id, when), (by_writer.id, when)])
+
+    def test_script_runs(self):
+        out = os.path.join(self.spool, 'out')
+        environment = dict(PATH = '/bin:/usr/bin', ODD = 'a b\n"c"\\$d')
+        id, = spool.write_jobs([('printf %s "$ODD" > {0}\npwd >> {0}'.format(
+            out), datetime.datetime(2037, 3, 1), 'a')],
+            environment = environment, cwd = self.spool)
+
+        path = spool.job_script_paths()[id]
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o700)
+        subprocess.check_call(['/bin/sh', path])
+        with open(out) as f:
+            self.assertEqual(f.read(), environment['ODD'] + self.spool + '\n')
+        self.assertEqual(spool.parse_job_script(open(path).read())
+            ['environment'], environment)
+
+    def test_at_many_batches(self):
+        real_batch = atd.SPOOL_BATCH
+        atd.SPOOL_BATCH = 4
+        atd.config.at_backend = 'spool'
+        try:
+            jobs = list(atd.at_many([('echo {0}'.format(i), 'now + 1 hour',
+                'Q') for i in range(9)] + [('echo', 'whenever', 'Q')]))
+        finally:
+            atd.SPOOL_BATCH = real_batch
+
+        self.assertEqual([job.id for job in jobs[:-1]], list(range(4, 13)))
+        self.assertIsInstance(jobs[-1], ValueError)
+        self.assertEqual(self.wakes, 3)
+        self.assertEqual(len(atd.AtQueue('Q').jobs), 9)
+        self.assertEqual(atd.AtJob(12).command, 'echo 8')
+
+    def test_malformed_job(self):
+        atd.config.at_backend = 'spool'
+        jobs = list(atd.at_many([('true', 'now + 1 hour'), ('bad',),
+            ('true', 'now + 1 hour')]))
+
+        self.assertEqual([type(job) for job in jobs], [atd.AtJob, ValueError,
+            atd.AtJob])
+        self.assertEqual(len(atd.AtQueue('a').jobs), 5)
+
+    def test_write_fails_part_way(self):
+        atd.config.at_backend = 'spool'
+        real_write_job = spool._write_job
+        def write_job(path, script):
+            if b'echo 2' in script:
+                raise OSError(28, 'No space left on device')
+            real_write_job(path, script)
+
+        with mock.patch.object(spool, '_write_job', write_job):
+            jobs = list(atd.at_many(('echo {0}'.format(i), 'now + 1 hour',
+                'Q') for i in range(4)))
+
+        self.assertEqual([job.id for job in jobs[:2]], [4, 5])
+        self.assertEqual([type(job) for job in jobs[2:]], [OSError, OSError])
+        self.assertEqual(jobs[2].written, [4, 5])
+        self.assertEqual(self.wakes, 1)
+        self.assertEqual(sorted(job.id for job in atd.AtQueue('Q').jobs),
+            [4, 5])
+
+    def test_job_numbers_wrap(self):
+        with open(os.path.join(self.spool, '.SEQ'), 'w') as f:
+            f.write('ffffe\n')
+        ids = spool.write_jobs([('true', datetime.datetime(2037, 3, 1), 'a')]
+            * 3)
+
+        # Jobs 1 to 3 are taken, so after 0xfffff comes 4.
+        self.assertEqual(ids, [0xfffff, 4, 5])
+
+class CoalesceTests(StandInTestCase):
+    def setUp(self):
+        super(CoalesceTests, self).setUp()
+        self.coalescer = coalesce.Coalescer(window = 60,
+            directory = os.path.join(self.spool, 'coalesce'))
+        self.when = datetime.datetime.now().replace(second = 0,
+            microsecond = 0) + datetime.timedelta(days = 1)
+
+    def run_job(self, atjob):
+        """ Run atjob's script now, like atd would. """
+        subprocess.check_call(['/bin/sh',
+            spool.job_script_paths(self.spool)[atjob.id]],
+            stdout = subprocess.DEVNULL)
+
+    def test_grouping(self):
+        later = self.when + datetime.timedelta(minutes = 1)
+        jobs = [self.coalescer.at('echo {0}'.format(i),
+            self.when + datetime.timedelta(seconds = i), 'Q') for i in range(5)]
+        jobs.append(self.coalescer.at('echo later', later, 'Q'))
+        jobs.append(self.coalescer.at('echo R', self.when, 'R'))
+        self.assertIsNone(jobs[0].id)
+        self.assertEqual(len(self.coalescer.flush()), 3)
+
+        q = atd.AtQueue()
+        self.assertEqual(len(q.jobs), 3)
+        self.assertEqual(len(set(job.atjob.id for job in jobs[:5])), 1)
+        self.assertEqual(jobs[3].id, '{0}.3'.format(jobs[0].atjob.id))
+        self.assertEqual(q.find_job_by_id(jobs[5].result().id).when, later)
+        self.assertEqual(q.find_job_by_id(jobs[6].result().id).queue, 'R')
+
+    def test_isolation_and_status(self):
+        jobs = [self.coalescer.at(command, self.when, 'Q') for command in
+            ('exit 3', 'read line; exit $?', 'if then', 'true')]
+        self.coalescer.flush()
+        self.assertEqual([job.status() for job in jobs], [None] * 4)
+
+        self.run_job(jobs[0].atjob)
+        self.assertEqual([job.status() for job in jobs], [3, 1, 2, 0])
+
+    def test_cancel(self):
+        jobs = [self.coalescer.at('exit {0}'.format(i), self.when, 'Q')
+            for i in range(3)]
+        self.assertTrue(atd.atrm(jobs[0])) # Before it's submitted
+        self.coalescer.flush()
+        self.assertRaises(ValueError, jobs[0].result)
+
+        self.assertTrue(atd.atrm(jobs[1]))
+        self.run_job(jobs[2].atjob)
+        self.assertEqual([job.status() for job in jobs], [None, None, 2])
+        self.assertEqual(len(atd.AtQueue().jobs), 1)
+
+        atd.atrm(jobs[2])
+        self.assertEqual(atd.AtQueue().jobs, [])
+
+    def test_async_cancel(self):
+        jobs = [self.coalescer.at('exit {0}'.format(i), self.when, 'Q')
+            for i in range(2)]
+        self.coalescer.flush()
+
+        self.assertTrue(asyncio.run(aio.atrm(jobs[0])))
+        self.assertTrue(jobs[0].canceled)
+        self.assertFalse(jobs[1].canceled)
+        self.assertEqual(len(atd.AtQueue().jobs), 1)
+        self.run_job(jobs[1].atjob)
+        self.assertEqual([job.status() for job in jobs], [None, 1])
+
+        self.assertTrue(asyncio.run(aio.atrm(jobs[1])))
+        self.assertEqual(atd.AtQueue().jobs, [])
+
+    def test_remove_files(self):
+        jobs = [self.coalescer.at('exit {0}'.format(i), self.when, 'Q')
+            for i in range(3)]
+        self.coalescer.flush()
+        atd.atrm(jobs[1])
+        self.run_job(jobs[0].atjob)
+        directory = self.coalescer.directory
+        self.assertEqual(len(os.listdir(directory)), 3)
+
+        self.assertEqual(jobs[0].status(), 0)
+        self.assertEqual(len(os.listdir(directory)), 3)
+        self.assertEqual(jobs[2].status(), 2)
+        self.assertEqual(os.listdir(directory), [])
+        self.assertEqual([job.status() for job in jobs], [0, None, 2])
+
+        canceled = self.coalescer.at('true', self.when, 'Q')
+        self.coalescer.flush()
+        atd.atrm(canceled)
+        self.assertEqual(os.listdir(directory), [])
+
+    def test_prune(self):
+        job = self.coalescer.at('true', self.when, 'Q')
+        self.coalescer.flush()
+        self.run_job(job.atjob)
+        path = job.group.path(job.index, 'status')
+
+        directory = self.coalescer.directory
+        self.assertEqual(coalesce.prune(60, directory), 0)
+        os.utime(path, (0, 0))
+        self.assertEqual(coalesce.prune(60, directory), 1)
+        self.assertFalse(os.path.exists(path))
+
+    def test_now(self):
+        jobs = [self.coalescer.at('true', 'now', 'Q'),
+            self.coalescer.at('true', datetime.timedelta(0), 'Q')]
+        results = self.coalescer.flush()
+
+        self.assertEqual([type(result) for result in results], [atd.AtJob])
+        self.assertEqual(jobs[1].result().id, results[0].id)
+        self.assertEqual(len(atd.AtQueue('Q').jobs), 1)
+
+    def test_window(self):
+        coalescer = coalesce.Coalescer(window = 0.05,
+            directory = self.coalescer.directory)
+        job = coalescer.at('true', self.when, 'Q')
+        self.assertEqual(job.result(timeout = 5).id, 1)
+        self.assertRaises(ValueError, coalescer.at, 'true', 'whenever')
+
+class JobScriptTests(FakeAtTestCase):
+    def test_parse_job_script(self):
+        with open(os.path.join(FIXTURE_SPOOL, 'Q000020219bf8e')) as f:
+            parsed = spool.parse_job_script(f.read())
+
+        self.assertEqual(parsed['command'],
+            'cd /tmp && tar czf backup.tgz data\nrm -rf data')
+        self.assertEqual(parsed['cwd'], '/home/nobody')
+        self.assertEqual(parsed['umask'], 0o22)
+        self.assertEqual(parsed['environment'], dict(PATH = '/bin:/usr/bin',
+            HOME = '/home/nobody'))
+
+    def test_parse_old_job_script(self):
+        parsed = spool.parse_job_script(
+            '#!/bin/sh\n# atrun uid=0 gid=0\nFOO=a\\ b; export FOO\n'
+            'cd /a\\ dir || {\n\t exit 1\n}\necho one\necho two\n')
+
+        self.assertEqual(parsed['command'], 'echo one\necho two')
+        self.assertEqual(parsed['cwd'], '/a dir')
+        self.assertEqual(parsed['environment'], dict(FOO = 'a b'))
+
+    def test_lazy_command(self):
+        job = atd.AtJob(7)
+
+        self.assertEqual(job.command, 'echo 7\necho done')
+        self.assertEqual(job.environment, dict(JOB = '7'))
+        self.assertEqual(job.cwd, '/tmp')
+
+    def test_load_commands(self):
+        q = atd.AtQueue()
+        self.assertEqual(q.load_commands(), [])
+        self.assertEqual(self.atq_runs(atd.config.at_binary), 2)
+
+        self.assertEqual([job.command for job in q.jobs],
+            ['echo 1\necho done', 'echo 2\necho done'])
+        self.assertEqual(self.atq_runs(atd.config.at_binary), 2)
+
+    def test_load_commands_from_spool(self):
+        real_atjobs_dir = atd.config.atjobs_dir
+        atd.config.atjobs_dir = FIXTURE_SPOOL
+        try:
+            q = atd.AtQueue(backend = 'spool')
+            q.load_commands()
+        finally:
+            atd.config.atjobs_dir = real_atjobs_dir
+
+        self.assertEqual(self.atq_runs(atd.config.at_binary), 0)
+        self.assertEqual(q.find_job_by_id(1).command, 'echo hello')
+
+class AsyncTests(FakeAtTestCase):
+    def test_async_at(self):
+        async def submit():
+            return await asyncio.gather(*[aio.at("echo {0}".format(i),
+                "now + 24 hours", 'Q') for i in range(1, 20)])
+
+        jobs = asyncio.run(submit())
+
+        self.assertEqual([job.id for job in jobs], list(range(1, 20)))
+        self.assertEqual(jobs[0].command, "echo 1")
+        self.assertTrue(asyncio.run(aio.atrm(*jobs)))
+
+    def test_async_queue(self):
+        q = asyncio.run(aio.AsyncAtQueue.create())
+
+        self.assertEqual(q.source, 'atq')
+        self.assertEqual([job.id for job in q.jobs],
+            [job.id for job in atd.AtQueue().jobs])
+        self.assertEqual([job.when for job in q.jobs],
+            [job.when for job in atd.AtQueue().jobs])
+
+    def test_async_failure(self):
+        with self.assertRaises(CalledProcessError):
+            asyncio.run(aio.at("echo fail", "now + 24 hours"))
+
+    def test_async_timeout(self):
+        atd.config.at_binary = self._install('slow_at',
+            '#!/bin/sh\nexec sleep 10\n')
+
+        with self.assertRaises(asyncio.TimeoutError):
+            asyncio.run(aio.at("echo 1", "now + 24 hours", timeout = 0.1))
+
+class EngineTestCase(unittest.TestCase):
+    """ Switches config.scheduler_backend to the engine, in a temporary
+        directory, for the duration of a test. """
+    def setUp(self):
+        self.engine_dir = tempfile.mkdtemp()
+        self.real_engine = (atd.config.scheduler_backend,
+            atd.config.engine_dir)
+        atd.config.scheduler_backend = 'engine'
+        atd.config.engine_dir = self.engine_dir
+        atq.snapshot_cache.invalidate()
+
+    def tearDown(self):
+        engine.get_engine().close()
+        atd.config.scheduler_backend, atd.config.engine_dir = self.real_engine
+        atq.snapshot_cache.invalidate()
+        shutil.rmtree(self.engine_dir)
+
+    def wait_for(self, condition, timeout = 5):
+        deadline = time.time() + timeout
+        while not condition() and time.time() < deadline:
+            time.sleep(0.05)
+        return condition()
+
+# The same tests as for the system's `at`, with the engine instead.
+class EngineQueueTests(EngineTestCase, QueueTests):
+    pass
+
+class EngineScheduleTests(EngineTestCase, ScheduleTests):
+    pass
+
+class EngineTests(EngineTestCase):
+    def test_engine_runs_jobs(self):
+        out = os.path.join(self.engine_dir, 'out')
+        submitted = time.time()
+        atd.at('echo $PATH > {0}'.format(out), datetime.timedelta(seconds = 1))
+        q = atd.AtQueue()
+
+        self.assertEqual(q.source, 'engine')
+        self.assertEqual(len(q.jobs), 1)
+        self.assertTrue(self.wait_for(lambda: os.path.exists(out) and
+            os.path.getsize(out)))
+        self.assertLess(time.time() - submitted, 3) # Not a minute later.
+        self.assertTrue(self.wait_for(lambda: not atd.AtQueue().jobs))
+
+    def test_engine_environment(self):
+        job = atd.at('echo $PATH', 'now + 1 hour')
+
+        self.assertEqual(atd.AtJob(job.id).environment,
+            atd.config.atjob_environment)
+        self.assertEqual(atd.AtJob(job.id).cwd, os.getcwd())
+        self.assertEqual(atd.AtJob(job.id).command, 'echo $PATH')
+
+    def test_engine_recovery(self):
+        jobs = [atd.at('echo {0}'.format(i), 'now + 1 hour', 'Q')
+            for i in range(1, 6)]
+        self.assertTrue(atd.atrm(jobs[0]))
+        engine.get_engine().close()
+
+        # A record torn by a crash is dropped.
+        with open(os.path.join(self.engine_dir, engine.JOURNAL), 'ab') as f:
+            f.write(b'{"op": "remove", "id"')
+
+        q = atd.AtQueue('Q')
+        self.assertEqual([job.id for job in q.jobs], [2, 3, 4, 5])
+        self.assertEqual(q.jobs[0].command, 'echo 2')
+        self.assertEqual(atd.at('echo 6', 'now + 1 hour').id, 6)
+
+    def test_engine_cancel_errors(self):
+        job = atd.at('echo', 'now + 1 hour')
+
+        with self.assertRaises(CalledProcessError) as raised:
+            atd.atrm(job, atd.AtJob(99))
+        self.assertIn(b'Cannot find jobid 99', raised.exception.stderr)
+        self.assertEqual(atd.AtQueue().jobs, [])
+
+        report = atd.atrm_where(predicate = lambda job: True)
+        self.assertTrue(report)
+        self.assertEqual(report.canceled, [])
+
+    def test_engine_compaction(self):
+        real_compact_after = engine.COMPACT_AFTER
+        engine.COMPACT_AFTER = 10
+        try:
+            for i in range(20):
+                atd.atrm(atd.at('echo', 'now + 1 hour'))
+            kept = atd.at('echo kept', 'now + 1 hour')
+        finally:
+            engine.COMPACT_AFTER = real_compact_after
+        engine.get_engine().close()
+
+        with open(os.path.join(self.engine_dir, engine.JOURNAL), 'rb') as f:
+            self.assertLess(len(f.readlines()), 10)
+        self.assertEqual([job.id for job in atd.AtQueue().jobs], [kept.id])
+
+    def test_engine_exclusive(self):
+        engine.get_engine()
+        self.assertRaises(OSError, engine.Engine, self.engine_dir)
+
+    def test_engine_timespecs(self):
+        self.assertRaises(ValueError, atd.at, 'echo', 'whenever')
+        job = atd.at('echo', 'now + 2 days')
+        self.assertAlmostEqual(job.when.timestamp(), time.time() + 2 * 86400,
+            delta = 60)
+        self.assertEqual(atd.at('echo', 'teatime').when.hour, 16)
+
+class CommandLineTests(StandInTestCase):
+    jobs = 3
+
+    def run_cli(self, *argv, **kwargs):
+        """ Run `python -m atd argv`, returning (exit status, stdout). """
+        out = io.StringIO()
+        with mock.patch('sys.stdin', io.StringIO(kwargs.get('stdin', ''))):
+            with mock.patch('sys.stderr', io.StringIO()):
+                status = cli.main(list(argv), out)
+        return status, out.getvalue()
+
+    def test_export_import(self):
+        status, exported = self.run_cli('export', '--commands')
+        jobs = [json.loads(line) for line in exported.splitlines()]
+        self.assertEqual(status, 0)
+        self.assertEqual([job['id'] for job in jobs], [1, 2, 3])
+        self.assertEqual(jobs[0]['command'], 'true')
+        self.assertEqual(jobs[0]['cwd'], '/')
+
+        self.assertEqual(self.run_cli('cancel', '-', stdin = exported)[0], 0)
+        self.assertEqual(atd.AtQueue().jobs, [])
+
+        status, imported = self.run_cli('import', stdin = exported)
+        self.assertEqual(status, 0)
+        self.assertEqual(sorted(json.loads(line)['id'] for line in
+            imported.splitlines()), [4, 5, 6])
+        q = atd.AtQueue()
+        self.assertEqual(sorted(job.when for job in q.jobs),
+            sorted(datetime.datetime.strptime(job['when'], '%Y-%m-%dT%H:%M:%S')
+            for job in jobs))
+        self.assertEqual(atd.AtJob(5).command, 'true')
+
+    def test_export_reconcile(self):
+        exported = self.run_cli('export', '--commands')[1]
+        expected = [json.loads(line) for line in exported.splitlines()]
+        self.assertIsInstance(expected[0]['when'], str)
+
+        self.assertFalse(reconcile.reconcile(expected, queue = 'a'))
+        planned = reconcile.plan([dict(expected[0], id = None)] +
+            expected[1:], queue = 'a')
+        self.assertEqual(len(planned.submit), 1)
+        self.assertIsInstance(planned.submit[0]['when'], datetime.datetime)
+        self.assertEqual(planned.cancel, [1])
+
+    def test_import_csv(self):
+        status, imported = self.run_cli('import', '--format', 'csv',
+            stdin = 'command,when,queue\necho a,now + 1 day,Q\n'
+            'echo b,whenever,Q\necho c,now + 2 days,Q\n')
+        self.assertEqual(status, 1)
+        self.assertEqual([json.loads(line)['line'] for line in
+            imported.splitlines()], [2, 4])
+        self.assertEqual(len(atd.AtQueue('Q').jobs), 2)
+
+    def test_submit_and_list(self):
+        status, out = self.run_cli('submit', '-q', 'Q', '-c', 'echo hi',
+            'now', '+', '1', 'day')
+        self.assertEqual(json.loads(out)['id'], 4)
+        self.assertEqual(atd.AtJob(4).command, 'echo hi')
+
+        listed = self.run_cli('list')[1]
+        self.assertEqual([line.split('\t')[0] for line in
+            listed.splitlines()], ['1', '2', '3', '4'])
+        self.assertEqual(self.run_cli('list', '--backend', 'spool')[1].count(
+            '\n'), 4)
+        self.assertEqual(self.run_cli('list', '-q', 'Q')[1].split('\t')[:3],
+            ['4', str(atd.AtJob(4).when), 'Q'])
+        self.assertEqual(self.run_cli('list', '-q', '??')[0], 1)
+
+class LevelingTests(StandInTestCase):
+    def setUp(self):
+        super(LevelingTests, self).setUp()
+        self.when = datetime.datetime.now().replace(second = 0,
+            microsecond = 0) + datetime.timedelta(days = 1)
+
+    def minutes(self, placements):
+        return [(p.when - self.when).seconds // 60 for p in placements]
+
+    def test_place(self):
+        atd.at('true', self.when, 'Q')
+        leveler = leveling.Leveler(2, tolerance = 600)
+        placed = [leveler.place(self.when + datetime.timedelta(seconds = 5),
+            'Q') for i in range(5)]
+
+        self.assertEqual(self.minutes(placed), [0, 1, 1, 2, 2])
+        self.assertEqual(placed[1].delay, datetime.timedelta(minutes = 1))
+        self.assertEqual(placed[0].when.second, 5)
+        self.assertEqual(leveler.report(), dict(jobs = 5, moved = 4,
+            over_budget = 0, max_delay = datetime.timedelta(minutes = 2),
+            max_starts = 2))
+        self.assertRaises(ValueError, leveling.Leveler, 0)
+
+    def test_tolerance(self):
+        leveler = leveling.Leveler(1, tolerance = 120)
+        placed = [leveler.place(self.when, 'Q') for i in range(5)]
+
+        self.assertEqual(self.minutes(placed), [0, 1, 2, 0, 1])
+        self.assertEqual([p.over_budget for p in placed],
+            [False, False, False, True, True])
+        self.assertEqual(leveler.report()['max_starts'], 2)
+
+    def test_at_many(self):
+        leveler = leveling.Leveler(dict(Q = 2))
+        jobs = [('true', self.when, 'Q')] * 5 + [('true', self.when, 'R'),
+            ('true', 'whenever', 'Q')]
+        results = list(atd.at_many(jobs, level = leveler))
+
+        self.assertIsInstance(results[-1], ValueError)
+        self.assertEqual(self.minutes(leveler.placements), [0, 0, 1, 1, 2, 0])
+        self.assertEqual(sorted(job.when for job in atd.AtQueue('Q').jobs),
+            [job.when for job in results[:5]])
+        self.assertEqual(atd.AtQueue('R').jobs[0].when, self.when)
+
+    def test_now(self):
+        results = list(atd.at_many([('true', 'now', 'Q'), ('bad',),
+            ('true', 'now', 'Q')], level = leveling.Leveler(1)))
+
+        self.assertIsInstance(results[0], atd.AtJob)
+        self.assertIsInstance(results[1], TypeError)
+        self.assertEqual(results[2].when - results[0].when.replace(
+            second = 0, microsecond = 0), datetime.timedelta(minutes = 1))
+
+class ReconcileTests(StandInTestCase):
+    jobs = 4
+
+    def setUp(self):
+        super(ReconcileTests, self).setUp()
+        self.queued = dict((job.id, job) for job in atd.AtQueue().jobs)
+        self.later = datetime.datetime.now() + datetime.timedelta(days = 2)
+
+    def test_diff(self):
+        for compact in (False, True):
+            before = atd.AtQueue(compact = compact)
+            removed = 2 if compact else 1
+            atd.atrm(atd.AtJob(removed))
+            added = atd.at('true', self.later, 'a')
+            after = atd.AtQueue(compact = compact)
+            self.assertFalse(after.diff(after))
+
+            diff = after.diff(before)
+            self.assertEqual((diff.added, diff.removed, diff.changed),
+                (set([added.id]), set([removed]), set()))
+            if not compact:
+                after.find_job_by_id(3).queue = 'b'
+                self.assertEqual(after.diff(before).changed, set([3]))
+
+    def test_reconcile(self):
+        expected = [dict(id = 1, command = 'true', when = self.queued[1].when),
+            dict(id = 2, command = 'true', when = self.later),
+            dict(id = None, command = 'echo new', when = self.later),
+            dict(id = 3, command = 'true', when = self.queued[3].when,
+                queue = 'b'),
+            dict(id = 77, command = 'true', when = datetime.datetime(2000, 1,
+                1))]
+
+        planned = reconcile.reconcile(expected, dry_run = True,
+            cancel_unexpected = True)
+        self.assertEqual(planned.keep, [1])
+        self.assertEqual(sorted(planned.replace), [2, 3])
+        self.assertEqual([job['command'] for job in planned.submit],
+            ['echo new'])
+        self.assertEqual(planned.cancel, [4])
+        self.assertEqual(planned.expired[0]['id'], 77)
+        cost = planned.cost(workers = 2)
+        self.assertEqual((cost['submits'], cost['cancels'],
+            cost['processes']), (3, 3, {'at': 3, 'at -r': 2}))
+        self.assertEqual(len(atd.AtQueue().jobs), 4) # Nothing done yet
+
+        done = reconcile.reconcile(expected, cancel_unexpected = True)
+        self.assertTrue(done.canceled)
+        self.assertEqual(sorted(done.canceled), [2, 3, 4])
+        q = atd.AtQueue()
+        self.assertEqual(len(q.jobs), 4)
+        self.assertEqual(q.find_job_by_id(done.submitted[2][1].id).queue, 'b')
+        self.assertFalse(reconcile.plan([dict(job, id = atjob.id)
+            for job, atjob in done.submitted] + expected[:1]))
+
+    def test_queue_and_commands(self):
+        expected = [dict(id = 1, command = 'false', when = self.queued[1].when)]
+        planned = reconcile.plan(expected, queue = 'a',
+            compare_commands = True)
+        self.assertEqual(list(planned.replace), [1])
+        self.assertEqual(planned.cancel, [2, 3, 4])
+        self.assertFalse(reconcile.plan(expected, queue = 'b'))
+
+    def test_unexpected_left_alone(self):
+        foreign = atd.at('true', self.later, 'z')
+        expected = [dict(id = id, command = 'true', when = job.when)
+            for id, job in self.queued.items() if id != 4]
+
+        planned = reconcile.plan(expected)
+        self.assertFalse(planned)
+        self.assertEqual(sorted(planned.unexpected), [4, foreign.id])
+        done = reconcile.reconcile(expected)
+        self.assertEqual(done.canceled, {})
+        self.assertEqual(len(atd.AtQueue().jobs), 5)
+
+        self.assertEqual(reconcile.plan(expected, queue = 'a').cancel, [4])
+
+class CompletionTests(StandInTestCase):
+    restore = ('completion_log',)
+
+    def setUp(self):
+        super(CompletionTests, self).setUp()
+        self.log = os.path.join(self.spool, 'completions')
+        atd.config.completion_log = self.log
+        self.when = datetime.datetime.now() + datetime.timedelta(days = 1)
+
+    def run_job(self, atjob):
+        """ Run atjob's script now, like atd would, returning its output. """
+        return subprocess.run(['/bin/sh', spool.job_script_paths(
+            self.spool)[atjob.id]], stdout = subprocess.PIPE,
+            check = False).stdout
+
+    def test_wait(self):
+        job = atd.at('echo hi; exit 3', self.when)
+        self.assertEqual(job.command, 'echo hi; exit 3')
+        tracker = completion.Tracker()
+        self.assertEqual(tracker.wait([job], timeout = 0), ([], [job]))
+        self.assertEqual(asyncio.run(aio.wait([job], timeout = 0.1)),
+            ([], [job]))
+
+        self.assertEqual(self.run_job(job), b'hi\n')
+        done, pending = tracker.wait([job], timeout = 5)
+        self.assertEqual(pending, [])
+        self.assertEqual((done[0].id, done[0].status, done[0].output_bytes,
+            done[0].succeeded), (job.id, 3, 3, False))
+        self.assertTrue(done[0].started <= done[0].ended)
+        self.assertIs(tracker.get(atd.AtJob(job.id)), done[0])
+
+    def test_completed_since(self):
+        jobs = list(atd.at_many(('exit {0}'.format(i), self.when)
+            for i in range(3)))
+        for job in jobs[1:]:
+            self.run_job(job)
+
+        completions, cursor = completion.completed_since()
+        self.assertEqual([(c.id, c.status) for c in completions],
+            [(jobs[1].id, 1), (jobs[2].id, 2)])
+        self.assertEqual(completion.completed_since(cursor), ([], 2))
+
+        self.run_job(jobs[0])
+        completions, cursor = completion.completed_since(cursor)
+        self.assertEqual([c.status for c in completions], [0])
+        self.assertEqual(completion.wait(jobs)[0][0].status, 0)
+
+    def test_out_of_order(self):
+        with open(self.log, 'w') as f:
+            f.write('{"token": "t", "started": 0, "ended": 1, "status": 0, '
+                '"output_bytes": 0}\n{"token": "t", "id": 9}\n{"tok')
+        tracker = completion.Tracker()
+        self.assertEqual(tracker.poll(), 1)
+        self.assertEqual(tracker.completions[0].id, 9)
+        self.assertEqual(tracker.get(atd.AtJob(9)).ended,
+            datetime.datetime.fromtimestamp(1))
+
+class BatchTests(StandInTestCase):
+    jobs = 2
+
+    def controller(self, loads, **kwargs):
+        """ An AdmissionController reading loads in turn, then the last. """
+        loads = list(loads)
+        return admission.AdmissionController(max_load = 1.0, interval = 0.01,
+            load = lambda: loads.pop(0) if len(loads) > 1 else loads[0],
+            **kwargs)
+
+    def test_batch(self):
+        self.assertEqual(atd._build_at_args(None, 'b')[0][1:], ['-b', '-q',
+            'b'])
+        job = atd.batch('echo hi', tags = ['x'])
+        self.assertEqual(job.queue, atd.config.batch_default_queue)
+        self.assertEqual([j.id for j in atd.AtQueue('b').jobs], [job.id])
+        self.assertEqual(atd.batch('true', 'c').queue, 'c')
+
+    def test_admit(self):
+        controller = self.controller([1.5, 2.0, 0.5])
+        self.assertTrue(controller.admit(timeout = 5))
+        self.assertFalse(self.controller([1.0]).admit(timeout = 0.05))
+        self.assertEqual(controller.report()['throttled'], 1)
+        self.assertEqual(controller.report()['admitted'], 1)
+
+    def test_batch_many_depth(self):
+        atd.batch('true')
+        controller = self.controller([0.1], max_depth = 3)
+        results = list(atd.batch_many(['true', ('true', 'b'),
+            ('true', 'b', ['x']), 'true'], controller, timeout = 0.05))
+        self.assertEqual([type(r) for r in results], [atd.AtJob, atd.AtJob,
+            admission.Deferred, admission.Deferred])
+        self.assertEqual(results[2].job, ('true', 'b', ['x']))
+        self.assertEqual(len(atd.AtQueue('b').jobs), 3)
+        self.assertEqual((controller.admitted, controller.deferred), (2, 2))
+
+    def test_read_loadavg(self):
+        with tempfile.NamedTemporaryFile('w') as f:
+            f.write('0.42 0.30 0.20 1/123 4567\n')
+            f.flush()
+            self.assertEqual(admission.read_loadavg(f.name), 0.42)
+        self.assertIsInstance(admission.read_loadavg('/nonexistent'), float)
+
+class StandInTests(unittest.TestCase):
+    def test_stand_ins(self):
+        for flavor in fake.FLAVORS:
+            with benchmarks.stand_ins(flavor, 3):
+                job = atd.at("echo 'hi there'\necho $HOME", "now + 24 hours",
+                    'Q')
+                q = atd.AtQueue()
+
+                self.assertEqual(job.id, 4)
+                self.assertEqual(sorted(j.id for j in q.jobs), [1, 2, 3, 4])
+                self.assertEqual(q.find_job_by_id(4).queue, 'Q')
+                self.assertEqual(atd.AtJob(4).command,
+                    "echo 'hi there'\necho $HOME")
+                self.assertEqual(atd.AtJob(4).environment['PATH'],
+                    atd.config.atjob_environment['PATH'])
+                self.assertEqual(atd.AtJob(1).command, 'true')
+
+                self.assertTrue(atd.atrm(job))
+                self.assertEqual(atd.AtQueue('Q').jobs, [])
+
 class NoNullAtJobComparisonTest(unittest.TestCase):
     def test_null_atjob_comparison(self):
         atj1 = atd.AtJob(0)
@@ -0,0 +1,326 @@
+################################################################################
+# atd.py - The Unix at scheduler in Python ################ py2/3k version 0.2 #
+################################################################################
+# Parses `at` timespecs, so we know when a job is due without asking `atq`.    #
+################################################################################
+# The grammar is GNU at's (see its timespec file), as far as it's useful:      #
+#                                                                              #
+#   timespec  ::= "now" [increment] | time [date] [increment]                  #
+#               | date [increment]                                             #
+#   time      ::= ("noon" | "midnight" | "teatime" | HH[:MM] ["am" | "pm"]     #
+#               | HHMM) ["utc"]                                                #
+#   date      ::= "today" | "tomorrow" | weekday | month DD [[","] YYYY]       #
+#               | DD month [YYYY] | MM/DD/[CC]YY | DD.MM.[CC]YY                #
+#               | CCYY-MM-DD | MMDD[CC]YY                                      #
+#   increment ::= ("+" | "-") N unit | "next" unit                             #
+#   unit      ::= minute | hour | day | week | month | year, or their plurals  #
+#                                                                              #
+# Words are case-insensitive, and month and weekday names may be abbreviated   #
+# to three letters. A time that's already passed today, without a date, means  #
+# tomorrow; a month and day without a year that's passed means next year.      #
+# Like `at`, we ignore seconds: every timespec is due at the start of a        #
+# minute. Parses are memoized, since programs tend to use the same few specs.  #
+#                                                                              #
+# parse_datetime() reads the dates and times python -m atd export writes,      #
+# for import and reconcile() to tell them from timespecs.                      #
+################################################################################
+##  Written by Fredrick Brennan <copypaste@kittens.ph>. See LICENSE (Expat).  ##
+################################################################################
+
+from __future__ import absolute_import
+import calendar
+import datetime
+import re
+import time
+
+_TOKEN = re.compile(r'\s*(?:(\d+)|([a-z]+)|([-+:,/.])|(\S))')
+
+TIMES = dict(noon = (12, 0), midnight = (0, 0), teatime = (16, 0))
+
+MONTHS = dict()
+for i, month in enumerate(['january', 'february', 'march', 'april', 'may',
+        'june', 'july', 'august', 'september', 'october', 'november',
+        'december'], 1):
+    MONTHS[month] = MONTHS[month[:3]] = i
+MONTHS['sept'] = 9
+
+WEEKDAYS = dict()
+for i, weekday in enumerate(['monday', 'tuesday', 'wednesday', 'thursday',
+        'friday', 'saturday', 'sunday']):
+    WEEKDAYS[weekday] = WEEKDAYS[weekday[:3]] = i
+
+UNITS = dict()
+for unit in ('minute', 'hour', 'day', 'week', 'month', 'year'):
+    UNITS[unit] = UNITS[unit + 's'] = unit
+UNITS['min'] = UNITS['mins'] = 'minute'
+
+# Parsed timespecs are remembered, up to this many.
+TIMESPEC_MEMO_SIZE = 1024
+
+# Formats parse_datetime() takes as a date and time, not a timespec.
+WHEN_FORMATS = ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M',
+    '%Y-%m-%d %H:%M')
+_memo = dict()
+
+class Timespec(object):
+    """ A parsed timespec. time is an (hour, minute) tuple, or None for the
+        current time. date is None, 'today', 'tomorrow', ('weekday', 0-6) or
+        ('date', year or None, month, day). increment is a (count, unit)
+        tuple or None. If utc, time and date are in UTC. """
+    __slots__ = ('spec', 'time', 'date', 'increment', 'utc')
+
+    def __init__(self, spec, time = None, date = None, increment = None,
+            utc = False):
+        self.spec = spec
+        self.time = time
+        self.date = date
+        self.increment = increment
+        self.utc = utc
+
+    def __repr__(self):
+        return 'Timespec({0!r})'.format(self.spec)
+
+    def resolve(self, now = None):
+        """ The local datetime this timespec means at now (by default, the
+            current time). Raises ValueError for dates that don't exist, like
+            February 30. """
+        now = (now or datetime.datetime.now()).replace(second = 0,
+            microsecond = 0)
+        if self.utc:
+            now = datetime.datetime.utcfromtimestamp(time.mktime(
+                now.timetuple()))
+
+        hour, minute = self.time or (now.hour, now.minute)
+        today = now.replace(hour = hour, minute = minute)
+        date = self.date
+
+        try:
+            if date is None:
+                when = today
+                if self.time is not None and when < now:
+                    when += datetime.timedelta(days = 1)
+            elif date == 'today':
+                when = today
+            elif date == 'tomorrow':
+                when = today + datetime.timedelta(days = 1)
+            elif date[0] == 'weekday':
+                when = today + datetime.timedelta(
+                    days = (date[1] - today.weekday()) % 7)
+            else:
+                year, month, day = date[1:]
+                when = today.replace(year = year or today.year, month = month,
+                    day = day)
+                if year is None and when < now:
+                    when = when.replace(year = when.year + 1)
+        except ValueError:
+            raise ValueError('Invalid timespec {0!r}: no such date.'.format(
+                self.spec))
+
+        if self.increment:
+            when = _add(when, *self.increment)
+
+        if self.utc:
+            when = datetime.datetime.fromtimestamp(calendar.timegm(
+                when.timetuple()))
+        return when
+
+def _add(when, count, unit):
+    """ when plus count units. Months and years that overflow the day carry
+        into the next month, like mktime() does: January 31 + 1 month is March
+        2 or 3. """
+    if unit in ('month', 'year'):
+        months = when.month - 1 + count * (12 if unit == 'year' else 1)
+        first = when.replace(year = when.year + months // 12,
+            month = months % 12 + 1, day = 1)
+        return first + datetime.timedelta(days = when.day - 1)
+
+    if unit == 'week':
+        count, unit = count * 7, 'day'
+    return when + datetime.timedelta(**{unit + 's': count})
+
+def parse(spec):
+    """ Parse the timespec spec, returning a Timespec. Raises ValueError if
+        it isn't one `at` would accept. """
+    parsed = _memo.get(spec)
+    if parsed is not None:
+        return parsed
+
+    parsed = _Parser(spec).timespec()
+    if len(_memo) >= TIMESPEC_MEMO_SIZE:
+        _memo.clear()
+    _memo[spec] = parsed
+    return parsed
+
+def resolve(spec, now = None):
+    """ The local datetime the timespec spec means at now (by default, the
+        current time). Raises ValueError if spec is invalid. """
+    return parse(spec).resolve(now)
+
+def parse_datetime(when):
+    """ The datetime when is, if it's in one of WHEN_FORMATS, else None. """
+    for fmt in WHEN_FORMATS:
+        try:
+            return datetime.datetime.strptime(when, fmt)
+        except ValueError:
+            pass
+    return None
+
+class _Parser(object):
+    """ A recursive descent parser for one timespec. """
+    def __init__(self, spec):
+        self.spec = spec
+        self.tokens = list()
+        for number, word, punct, other in _TOKEN.findall(spec.lower()):
+            if other:
+                self.error('unexpected {0!r}'.format(other))
+            self.tokens.append(('number', number) if number else
+                ('word', word) if word else ('punct', punct))
+        self.pos = 0
+
+    def error(self, message):
+        raise ValueError('Invalid timespec {0!r}: {1}.'.format(self.spec,
+            message))
+
+    def peek(self, offset = 0):
+        """ The (kind, text) of the token offset ahead, or (None, None). """
+        if self.pos + offset < len(self.tokens):
+            return self.tokens[self.pos + offset]
+        return (None, None)
+
+    def take(self):
+        token = self.peek()
+        self.pos += 1
+        return token[1]
+
+    def expect(self, kind, what):
+        if self.peek()[0] != kind:
+            self.error('expected {0}'.format(what))
+        return self.take()
+
+    def timespec(self):
+        if self.peek() == ('word', 'now'):
+            self.take()
+            parsed = Timespec(self.spec)
+        else:
+            parsed = Timespec(self.spec)
+            parsed.time = self.time_of_day(parsed)
+            parsed.date = self.date()
+            if parsed.time is None and parsed.date is None:
+                self.error('expected a time, a date or "now"')
+
+        parsed.increment = self.increment()
+        if self.peek()[0] is not None:
+            self.error('unexpected {0!r}'.format(self.peek()[1]))
+        return parsed
+
+    def looks_like_date(self):
+        """ True if the number we're at starts a date, not a time. """
+        kind, text = self.peek(1)
+        return (len(self.peek()[1]) in (6, 8) or
+            (kind == 'punct' and text in '/.') or
+            (kind == 'punct' and text == '-' and len(self.peek()[1]) == 4 and
+                self.peek(3) == ('punct', '-')) or
+            (kind == 'word' and text in MONTHS))
+
+    def time_of_day(self, parsed):
+        kind, text = self.peek()
+        if kind == 'word' and text in TIMES:
+            self.take()
+            hour, minute = TIMES[text]
+        elif kind == 'number' and not self.looks_like_date():
+            digits = self.take()
+            if self.peek() == ('punct', ':'):
+                self.take()
+                hour = int(digits)
+                minute = int(self.expect('number', 'minutes after ":"'))
+            elif len(digits) <= 2:
+                hour, minute = int(digits), 0
+            elif len(digits) <= 4:
+                hour, minute = int(digits[:-2]), int(digits[-2:])
+            else:
+                self.error('{0} is not a time'.format(digits))
+
+            if self.peek() in (('word', 'am'), ('word', 'pm')):
+                if not 1 <= hour <= 12:
+                    self.error('{0} is not an hour on a 12 hour clock'.format(
+                        hour))
+                hour = hour % 12 + (12 if self.take() == 'pm' else 0)
+            if hour > 23 or minute > 59:
+                self.error('{0}:{1:02} is not a time'.format(hour, minute))
+        else:
+            return None
+
+        if self.peek() == ('word', 'utc'):
+            self.take()
+            parsed.utc = True
+        return (hour, minute)
+
+    def date(self):
+        kind, text = self.peek()
+        if kind == 'word':
+            if text in ('today', 'tomorrow'):
+                return self.take()
+            elif text in WEEKDAYS:
+                return ('weekday', WEEKDAYS[self.take()])
+            elif text in MONTHS:
+                month = MONTHS[self.take()]
+                day = int(self.expect('number', 'a day of the month'))
+                if self.peek() == ('punct', ','):
+                    self.take()
+                return ('date', self.year(), month, day)
+            return None
+        elif kind != 'number':
+            return None
+
+        separator = self.peek(1)
+        if separator[0] == 'word' and separator[1] in MONTHS:
+            day = int(self.take())
+            month = MONTHS[self.take()]
+            return ('date', self.year(), month, day)
+        elif separator in (('punct', '/'), ('punct', '.'), ('punct', '-')):
+            first = self.take()
+            self.take()
+            second = int(self.expect('number', 'a date'))
+            if self.take() != separator[1]:
+                self.error('expected {0!r} in the date'.format(separator[1]))
+            third = self.expect('number', 'a date')
+            if separator[1] == '/':
+                return ('date', self.year(third), int(first), second)
+            elif separator[1] == '.':
+                return ('date', self.year(third), second, int(first))
+            return ('date', self.year(first), second, int(third))
+        elif len(text) in (6, 8):
+            self.take()
+            return ('date', self.year(text[4:]), int(text[:2]), int(text[2:4]))
+        self.error('{0} is not a date'.format(text))
+
+    def year(self, digits = None):
+        """ Parse digits, or the next token if it's a number, as a year. """
+        if digits is None:
+            if self.peek()[0] != 'number':
+                return None
+            digits = self.take()
+        if len(digits) == 2:
+            year = int(digits)
+            return year + (1900 if year >= 69 else 2000) # Like strptime's %y
+        elif len(digits) == 4:
+            return int(digits)
+        self.error('{0} is not a year'.format(digits))
+
+    def increment(self):
+        kind, text = self.peek()
+        if (kind, text) in (('punct', '+'), ('punct', '-')):
+            self.take()
+            count = int(self.expect('number', 'a number after {0!r}'.format(
+                text))) * (-1 if text == '-' else 1)
+        elif (kind, text) == ('word', 'next'):
+            self.take()
+            count = 1
+        else:
+            return None
+
+        kind, unit = self.peek()
+        if kind != 'word' or unit not in UNITS:
+            self.error('expected minutes, hours, days, weeks, months or years')
+        self.take()
+        return (count, UNITS[unit])
@@ -0,0 +1,177 @@
+################################################################################
+# atd.py - The Unix at scheduler in Python ################ py2/3k version 0.2 #
+################################################################################
+# Watch the `at` spool for changes, instead of polling `atq`.                  #
+################################################################################
+# On Linux the spool directory is watched with inotify, so nothing is  done    #
+# until  a  job  is added, removed or run.  Elsewhere, or if inotify can't be  #
+# used,   the   directory's   mtime  is  polled   every   watch_poll_interval  #
+# seconds (see config). Either way, AtQueue.update() then applies only what    #
+# changed.                                                                     #
+################################################################################
+##  Written by Fredrick Brennan <copypaste@kittens.ph>. See LICENSE (Expat).  ##
+################################################################################
+
+from __future__ import absolute_import
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import sys
+import time
+
+# Submodules #
+from atd import config
+from atd.atq import AtQueue
+
+# From <sys/inotify.h>
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+
+_IN_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+    IN_CREATE | IN_DELETE)
+
+def _inotify_watch(directory):
+    """ Return an inotify file descriptor watching directory, or None if
+        inotify isn't available or can't watch it. """
+    if not sys.platform.startswith('linux'):
+        return None
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno = True)
+        inotify_init1 = libc.inotify_init1
+        inotify_add_watch = libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+
+    inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+        ctypes.c_uint32]
+
+    fd = inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    if fd < 0:
+        return None
+
+    if inotify_add_watch(fd, directory.encode(sys.getfilesystemencoding()),
+            _IN_MASK) < 0:
+        os.close(fd) # Usually EACCES, the same as reading the spool.
+        return None
+
+    return fd
+
+class SpoolWatcher(object):
+    """ Waits for the spool directory (config.atjobs_dir by default) to
+        change. It doesn't say what changed; use AtQueue.update() for that. """
+    def __init__(self, directory = None, poll_interval = None,
+            use_inotify = True):
+        self.directory = directory or config.atjobs_dir
+        self.poll_interval = (config.watch_poll_interval
+            if poll_interval is None else poll_interval)
+        self._fd = _inotify_watch(self.directory) if use_inotify else None
+        self._mtime = self._directory_mtime()
+
+    @property
+    def inotify(self):
+        """ True if we're using inotify, False if we're polling. """
+        return self._fd is not None
+
+    def fileno(self):
+        """ The inotify file descriptor, for use with select() or an event
+            loop. Raises ValueError if we're polling. """
+        if self._fd is None:
+            raise ValueError('Not using inotify, so there\'s nothing to select'
+                ' on. Call wait() instead.')
+        return self._fd
+
+    def _directory_mtime(self):
+        try:
+            st = os.stat(self.directory)
+        except OSError:
+            return None
+        return (st.st_mtime, st.st_ino)
+
+    def changed(self):
+        """ Return True if the spool changed since the last call to changed()
+            or wait(), without blocking. """
+        if self._fd is not None:
+            return self._drain()
+
+        mtime = self._directory_mtime()
+        if mtime != self._mtime:
+            self._mtime = mtime
+            return True
+        return False
+
+    def _drain(self):
+        """ Read every pending inotify event. Returns True if there were
+            any. """
+        events = False
+        while True:
+            try:
+                if not os.read(self._fd, 65536):
+                    return events
+                events = True
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return events
+                raise
+
+    def wait(self, timeout = None):
+        """ Block until the spool changes, or for at most timeout seconds.
+            Returns True if it changed, or False if we timed out. """
+        if self._fd is not None:
+            select.select([self._fd], [], [], timeout)
+            return self._drain()
+
+        deadline = None if timeout is None else time.time() + timeout
+        while not self.changed():
+            if deadline is None:
+                time.sleep(self.poll_interval)
+                continue
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            time.sleep(min(self.poll_interval, remaining))
+
+        return True
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+def watch(atqueue = None, poll_interval = None):
+    """ Yield (event, job) tuples as jobs are added to, removed from or run
+        out of the queue, forever. event is atq.JOB_ADDED, atq.JOB_REMOVED or
+        atq.JOB_EXECUTED. atqueue is updated in place to match; by default it's
+        a new AtQueue(backend='spool').
+
+        Between changes this just blocks, so steady-state CPU use is close to
+        nothing. For an asyncio version, see atd.aio.awatch(). """
+    if atqueue is None:
+        atqueue = AtQueue(backend = 'spool')
+
+    watcher = SpoolWatcher(poll_interval = poll_interval)
+    try:
+        # Whatever changed between atqueue's last refresh and now.
+        for event in atqueue.update():
+            yield event
+
+        while True:
+            watcher.wait(_pending_timeout(atqueue, watcher))
+            for event in atqueue.update():
+                yield event
+    finally:
+        watcher.close()
+
+def _pending_timeout(atqueue, watcher):
+    """ Making a job executable doesn't change the spool's mtime, so while
+        `at` is still writing a job that we've seen, look again regularly. """
+    if atqueue._spool_pending and not watcher.inotify:
+        return watcher.poll_interval
+    return None